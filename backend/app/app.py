@@ -1,5 +1,6 @@
 """File defining the Metadata. And the basic functions creating the database tables and calling the router"""
 
+import asyncio
 import logging
 import uuid
 from collections.abc import AsyncGenerator, Awaitable, Callable
@@ -8,7 +9,23 @@ from pathlib import Path
 
 from app.dependencies import init_and_get_db_engine
 from app.types.exceptions import ContentHTTPException
-from app.utils import database
+from app.utils import (
+    archival,
+    blob_store,
+    cache_bus,
+    database,
+    idempotency,
+    images,
+    report_cache,
+    report_history,
+    report_stream,
+    trending,
+    user_cache,
+    user_stats,
+    vote_buffer,
+    vote_counters,
+)
+from app.utils.background import run_periodically
 from app.utils.config import Settings
 from app.utils.log import LogConfig
 from fastapi import FastAPI, HTTPException, Request, Response, status
@@ -40,6 +57,11 @@ def init_db(
         points_cimes_error_logger=points_cimes_error_logger,
         drop_db=drop_db,
     )
+    for database_url in settings.REPORT_SHARD_DATABASES.values():
+        database.update_shard_tables(
+            database_url=database_url,
+            points_cimes_error_logger=points_cimes_error_logger,
+        )
 
 
 # We wrap the application in a function to be able to pass the settings and drop_db parameters
@@ -56,8 +78,95 @@ def get_application(settings: Settings, drop_db: bool = False) -> FastAPI:
     # https://fastapi.tiangolo.com/advanced/events/
     @asynccontextmanager
     async def lifespan(app: FastAPI) -> AsyncGenerator:
+        images.init_image_pool(settings=settings)
+        report_cache.init_report_cache(settings=settings)
+        user_cache.init_user_cache(settings=settings)
+        report_stream.init_report_stream(settings=settings)
+        vote_buffer.init_vote_buffer(settings=settings)
+        trending.init_trending(settings=settings)
+        user_stats.init_user_stats(settings=settings)
+        # Report mutations can not be saved before the partition of the current month exists
+        try:
+            await report_history.maintain_report_history_partitions(settings=settings)
+        except Exception:
+            points_cimes_error_logger.exception(
+                "Startup: Could not create the report history partitions"
+            )
+        background_tasks = [
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: idempotency.purge_expired_idempotency_keys(
+                        settings=settings
+                    ),
+                    interval_seconds=settings.IDEMPOTENCY_PURGE_INTERVAL_SECONDS,
+                    name="idempotency keys purge",
+                ),
+            ),
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: blob_store.collect_unreferenced_blobs(
+                        settings=settings
+                    ),
+                    interval_seconds=settings.BLOB_GC_INTERVAL_SECONDS,
+                    name="blob store garbage collection",
+                ),
+            ),
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: archival.archive_expired_reports(settings=settings),
+                    interval_seconds=settings.REPORT_ARCHIVAL_INTERVAL_SECONDS,
+                    name="expired reports archival",
+                ),
+            ),
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: report_history.maintain_report_history_partitions(
+                        settings=settings
+                    ),
+                    interval_seconds=settings.REPORT_HISTORY_MAINTENANCE_INTERVAL_SECONDS,
+                    name="report history partitions maintenance",
+                ),
+            ),
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: vote_counters.reconcile_vote_counters(
+                        settings=settings
+                    ),
+                    interval_seconds=settings.VOTE_COUNTERS_RECONCILE_INTERVAL_SECONDS,
+                    name="vote counters reconciliation",
+                ),
+            ),
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: trending.sync_trending(settings=settings),
+                    interval_seconds=settings.TRENDING_SYNC_INTERVAL_SECONDS,
+                    name="trending reports synchronization",
+                ),
+            ),
+            asyncio.create_task(
+                run_periodically(
+                    job=lambda: user_stats.reconcile_user_stats(settings=settings),
+                    interval_seconds=settings.USER_STATS_RECONCILE_INTERVAL_SECONDS,
+                    name="user stats reconciliation",
+                ),
+            ),
+        ]
+        if settings.VOTE_COUNTERS_WRITE_BEHIND:
+            # Flushed a last time when the task is cancelled on shutdown
+            background_tasks.append(
+                asyncio.create_task(vote_buffer.run_vote_buffer(settings=settings)),
+            )
+        if settings.CACHE_BUS_ENABLED:
+            # Receives the invalidations published by the other workers
+            background_tasks.append(
+                asyncio.create_task(cache_bus.run_cache_bus(settings=settings)),
+            )
         yield
         points_cimes_error_logger.info("Shutting down")
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        images.shutdown_image_pool()
 
     # Initialize app
     app = FastAPI(
@@ -8,16 +8,19 @@ async def get_users(db: Annotated[AsyncSession, Depends(get_db)]):
 """
 
 import logging
-from collections.abc import AsyncGenerator, Callable
+from collections import defaultdict
+from collections.abc import AsyncGenerator, Awaitable, Callable, Sequence
+from contextlib import asynccontextmanager
 from functools import lru_cache
-from typing import Annotated, cast
+from typing import Annotated, Any, TypeVar, cast
 from uuid import UUID
 
 import jwt
 from app.modules.login.schemas_login import TokenPayload
+from app.modules.reports import cruds_reports
 from app.modules.users import cruds_users, models_users
 from app.modules.users.types_users import AccountType
-from app.utils import security
+from app.utils import security, sharding, user_cache
 from app.utils.config import Settings, construct_prod_settings
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
@@ -32,6 +35,8 @@ from sqlalchemy.ext.asyncio import (
 points_cimes_access_logger = logging.getLogger("points-cimes.access")
 points_cimes_error_logger = logging.getLogger("points-cimes.error")
 
+T = TypeVar("T")
+
 engine: AsyncEngine | None = (
     None  # Create a global variable for the database engine, so that it can be instancied in the startup event
 )
@@ -69,13 +74,21 @@ def init_and_get_db_engine(settings: Settings) -> AsyncEngine:
             class_=AsyncSession,
             expire_on_commit=False,
         )
+        sharding.init_shards(settings=settings, default_session_maker=SessionLocal)
     return engine
 
 
-async def get_db_session() -> AsyncGenerator[AsyncSession, None]:
+async def get_db_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
     """
     Return a database session
     """
+    # The write sub-requests of a batch share the session of the batch, see `app.modules.batch`
+    batch_db_session: AsyncSession | None = getattr(
+        request.state, "batch_db_session", None
+    )
+    if batch_db_session is not None:
+        yield batch_db_session
+        return
     if SessionLocal is None:
         points_cimes_error_logger.error("Database engine is not initialized")
         raise HTTPException(
@@ -89,6 +102,60 @@ async def get_db_session() -> AsyncGenerator[AsyncSession, None]:
             await db.close()
 
 
+async def get_report_shard(db_session: AsyncSession, report_id: UUID) -> str:
+    """The shard storing a report, see `app.utils.sharding`"""
+    if not sharding.is_sharded():
+        return sharding.DEFAULT_SHARD
+    report_shards = await cruds_reports.get_report_shards(
+        db_session=db_session, report_ids=[report_id]
+    )
+    return report_shards.get(report_id, sharding.DEFAULT_SHARD)
+
+
+async def get_report_ids_by_shard(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> dict[str, list[UUID]]:
+    """Group reports by the shard storing them"""
+    if not sharding.is_sharded():
+        return {sharding.DEFAULT_SHARD: list(report_ids)}
+    report_shards = await cruds_reports.get_report_shards(
+        db_session=db_session, report_ids=report_ids
+    )
+    report_ids_by_shard: dict[str, list[UUID]] = defaultdict(list)
+    for report_id in report_ids:
+        report_ids_by_shard[
+            report_shards.get(report_id, sharding.DEFAULT_SHARD)
+        ].append(report_id)
+    return report_ids_by_shard
+
+
+async def get_report_db_session(
+    report_id: UUID,
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Return a database session on the shard storing the report of the `report_id` path parameter
+    """
+    shard = await get_report_shard(db_session=db_session, report_id=report_id)
+    if shard == sharding.DEFAULT_SHARD:
+        yield db_session
+        return
+    async with sharding.get_shard_session(shard) as report_db_session:
+        yield report_db_session
+
+
+@asynccontextmanager
+async def get_background_db_session() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Return a database session for code running outside of a request, like background jobs
+    or queries shared by several requests
+    """
+    if SessionLocal is None:
+        raise RuntimeError("Database engine is not initialized")  # noqa: TRY003
+    async with SessionLocal() as db:
+        yield db
+
+
 @lru_cache
 def get_settings() -> Settings:
     """
@@ -100,12 +167,14 @@ def get_settings() -> Settings:
 
 
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl="/login/access-token")
+# Endpoints which are also available to anonymous users do not require a token
+optional_oauth2 = OAuth2PasswordBearer(tokenUrl="/login/access-token", auto_error=False)
 
 
-async def get_current_user(
-    db_session: Annotated[AsyncSession, Depends(get_db_session)],
-    token: Annotated[str, Depends(reusable_oauth2)],
-    settings: Annotated[Settings, Depends(get_settings)],
+async def _get_user_from_token(
+    db_session: AsyncSession,
+    token: str,
+    settings: Settings,
 ) -> models_users.User:
     try:
         payload = jwt.decode(
@@ -117,9 +186,13 @@ async def get_current_user(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials",
         )
-    user = await cruds_users.get_user_by_id(
-        db_session=db_session, user_id=UUID(token_data.sub)
-    )
+    user_id = UUID(token_data.sub)
+    user = user_cache.get_cached_user(user_id)
+    if user is None:
+        loaded_generation = user_cache.generation
+        user = await cruds_users.get_user_by_id(db_session=db_session, user_id=user_id)
+        if user is not None:
+            user_cache.store_user(user, loaded_generation=loaded_generation)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     if not user.is_active:
@@ -128,6 +201,61 @@ async def get_current_user(
     return user
 
 
+def get_batch_user(request: Request) -> models_users.User | None:
+    """
+    The user resolved once for a batch, if the request is a sub-request of a batch made by an authenticated user.
+    Sub-requests are sent with the token of the batch
+    """
+    return getattr(request.state, "batch_user", None)
+
+
+async def get_current_user(
+    request: Request,
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    token: Annotated[str, Depends(reusable_oauth2)],
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> models_users.User:
+    batch_user = get_batch_user(request)
+    if batch_user is not None:
+        return batch_user
+    return await _get_user_from_token(
+        db_session=db_session, token=token, settings=settings
+    )
+
+
+async def get_optional_user(
+    request: Request,
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    token: Annotated[str | None, Depends(optional_oauth2)],
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> models_users.User | None:
+    """
+    Return the user making the request, or None if the request is anonymous.
+    An invalid token is still rejected
+    """
+    if token is None:
+        return None
+    batch_user = get_batch_user(request)
+    if batch_user is not None:
+        return batch_user
+    return await _get_user_from_token(
+        db_session=db_session, token=token, settings=settings
+    )
+
+
+async def run_in_own_session(
+    function: Callable[..., Awaitable[T]], **kwargs: Any
+) -> T:
+    """
+    Run `function(db_session=..., **kwargs)` with a session of its own.
+
+    A session can only run one query at a time: independent reads of a request are run concurrently
+    with `asyncio.gather`, each on its own pooled connection.
+    """
+    async with get_background_db_session() as db_session:
+        return await function(db_session=db_session, **kwargs)
+
+
 def is_user(
     account_type: AccountType | None = None,
 ) -> Callable[[models_users.User], models_users.User]:
@@ -2,18 +2,28 @@
 
 from app.app import get_application
 from app.dependencies import get_settings
+from app.modules.batch import endpoints_batch
 from app.modules.login import endpoints_login
+from app.modules.media import endpoints_media
+from app.modules.metrics import endpoints_metrics
+from app.modules.moderation import endpoints_moderation
 from app.modules.reports import endpoints_reports
 from app.modules.users import endpoints_users
+from app.modules.votes import endpoints_votes
 from app.utils.fastapi import use_route_path_as_operation_ids
 
 # The application is started with the following function call:
 # We dissociate this step from the app.py file so that during tests we can initialize it with the mocked settings
 app = get_application(settings=get_settings())
 
+app.include_router(endpoints_batch.router)
 app.include_router(endpoints_reports.router)
 app.include_router(endpoints_login.router)
+app.include_router(endpoints_media.router)
+app.include_router(endpoints_metrics.router)
+app.include_router(endpoints_moderation.router)
 app.include_router(endpoints_users.router)
+app.include_router(endpoints_votes.router)
 use_route_path_as_operation_ids(app)
 
 
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+from typing import Annotated, Any
+
+from app.dependencies import (
+    get_background_db_session,
+    get_optional_user,
+    get_settings,
+)
+from app.modules.batch import schemas_batch
+from app.modules.users import models_users
+from app.utils.config import Settings
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+
+router = APIRouter(prefix="/batch", tags=["batch"])
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+# Headers of the sub-requests which are set from the batch
+RESERVED_HEADERS = {"authorization", "content-length", "content-type", "host"}
+
+
+@router.post("", response_model=schemas_batch.BatchResponse)
+async def run_batch(
+    request: Request,
+    batch: schemas_batch.BatchRequest,
+    settings: Annotated[Settings, Depends(get_settings)],
+    user: Annotated[models_users.User | None, Depends(get_optional_user)],
+):
+    """
+    Run several requests to the API in a single round trip, and return all their responses.
+
+    Sub-requests are dispatched in process to the endpoints, with the `Authorization` header of the batch.
+    The user is authenticated once for the whole batch. Consecutive `GET` sub-requests run concurrently,
+    each with its own database session. Other sub-requests run one after the other, in order, and share a session.
+    A failing sub-request does not stop the batch: its error is returned as its response.
+    """
+    if len(batch.requests) > settings.BATCH_MAX_REQUESTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch can not contain more than {settings.BATCH_MAX_REQUESTS} requests",
+        )
+    if any(
+        sub_request.path.split("?")[0].rstrip("/") == router.prefix
+        for sub_request in batch.requests
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="Batches can not be nested",
+        )
+
+    responses: list[schemas_batch.BatchSubResponse | None] = [None] * len(
+        batch.requests
+    )
+    read_slots = asyncio.Semaphore(settings.BATCH_MAX_CONCURRENT_READS)
+
+    async def run_read(index: int) -> None:
+        async with read_slots:
+            responses[index] = await _run_sub_request(
+                request=request,
+                sub_request=batch.requests[index],
+                state={"batch_user": user},
+                timeout=settings.BATCH_REQUEST_TIMEOUT_SECONDS,
+            )
+
+    async with get_background_db_session() as write_db_session:
+        pending_reads: list[int] = []
+        for index, sub_request in enumerate(batch.requests):
+            if sub_request.method == "GET":
+                pending_reads.append(index)
+                continue
+            # A write must see the result of the reads sent before it
+            await asyncio.gather(*(run_read(read) for read in pending_reads))
+            pending_reads = []
+            responses[index] = await _run_sub_request(
+                request=request,
+                sub_request=sub_request,
+                state={"batch_user": user, "batch_db_session": write_db_session},
+                timeout=settings.BATCH_REQUEST_TIMEOUT_SECONDS,
+            )
+            await _reset_session(write_db_session)
+        await asyncio.gather(*(run_read(read) for read in pending_reads))
+
+    return schemas_batch.BatchResponse(
+        responses=[response for response in responses if response is not None]
+    )
+
+
+async def _reset_session(db_session: AsyncSession) -> None:
+    """End the transaction left by a failed write, so that the next write starts from a clean session"""
+    if db_session.in_transaction():
+        await db_session.rollback()
+
+
+def _get_body(content_type: str, body: bytes) -> Any:
+    if not body:
+        return None
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    return body.decode(errors="replace")
+
+
+async def _run_sub_request(
+    request: Request,
+    sub_request: schemas_batch.BatchSubRequest,
+    state: dict[str, Any],
+    timeout: float,
+) -> schemas_batch.BatchSubResponse:
+    """Dispatch a sub-request to the application, without going through the network"""
+    path, _, query_string = sub_request.path.partition("?")
+    body = b"" if sub_request.body is None else json.dumps(sub_request.body).encode()
+    headers = {
+        name.lower(): value
+        for name, value in sub_request.headers.items()
+        if name.lower() not in RESERVED_HEADERS
+    }
+    if body:
+        headers["content-type"] = "application/json"
+        headers["content-length"] = str(len(body))
+    authorization = request.headers.get("authorization")
+    if authorization is not None:
+        headers["authorization"] = authorization
+    scope = {
+        "type": "http",
+        "asgi": request.scope["asgi"],
+        "http_version": request.scope.get("http_version", "1.1"),
+        "method": sub_request.method,
+        "scheme": request.url.scheme,
+        "server": request.scope.get("server"),
+        "client": request.scope.get("client"),
+        "root_path": request.scope.get("root_path", ""),
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "headers": [(name.encode(), value.encode()) for name, value in headers.items()],
+        "state": state,
+    }
+
+    body_sent = False
+    response_complete = asyncio.Event()
+    status_code = 500
+    response_headers: dict[str, str] = {}
+    response_body = bytearray()
+
+    async def receive() -> dict[str, Any]:
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Like a server, the client only disconnects once the response is sent
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: dict[str, Any]) -> None:
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+            response_headers.update(
+                (name.decode(), value.decode())
+                for name, value in message.get("headers", [])
+                if name.lower() != b"content-length"
+            )
+        elif message["type"] == "http.response.body":
+            response_body.extend(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_complete.set()
+
+    try:
+        await asyncio.wait_for(request.app(scope, receive, send), timeout=timeout)
+    except TimeoutError:
+        return schemas_batch.BatchSubResponse(
+            status_code=504,
+            headers={},
+            body={"detail": "The request timed out"},
+        )
+    except Exception:
+        # The error response has already been sent by the application, if it could be
+        if not response_complete.is_set():
+            points_cimes_error_logger.exception(
+                f"Batch: {sub_request.method} {path} failed"
+            )
+            return schemas_batch.BatchSubResponse(
+                status_code=500,
+                headers={},
+                body={"detail": "Internal server error"},
+            )
+    return schemas_batch.BatchSubResponse(
+        status_code=status_code,
+        headers=response_headers,
+        body=_get_body(response_headers.get("content-type", ""), bytes(response_body)),
+    )
@@ -0,0 +1,30 @@
+from typing import Any, Literal
+
+from pydantic import BaseModel, Field
+
+
+class BatchSubRequest(BaseModel):
+    method: Literal["GET", "POST", "PUT", "PATCH", "DELETE"]
+    # The path of the endpoint, with its query string, for example `/reports/?location_text=...`
+    path: str = Field(pattern=r"^/")
+    # Sent as the JSON body of the sub-request
+    body: Any = None
+    # Headers of the sub-request, for example `If-None-Match` or `Idempotency-Key`.
+    # The `Authorization` header of the batch is always used
+    headers: dict[str, str] = {}
+
+
+class BatchRequest(BaseModel):
+    requests: list[BatchSubRequest] = Field(min_length=1)
+
+
+class BatchSubResponse(BaseModel):
+    status_code: int
+    headers: dict[str, str]
+    # The parsed JSON body, the text of other bodies, or None if the body is empty
+    body: Any = None
+
+
+class BatchResponse(BaseModel):
+    # In the order of the sub-requests
+    responses: list[BatchSubResponse]
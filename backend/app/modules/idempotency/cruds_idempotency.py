@@ -0,0 +1,115 @@
+from datetime import datetime
+
+from app.modules.idempotency import models_idempotency
+from sqlalchemy import delete, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+async def claim_idempotency_key(
+    db_session: AsyncSession,
+    scope: str,
+    key: str,
+    request_hash: str,
+    expire_on: datetime,
+    now: datetime,
+) -> bool:
+    """
+    Insert a key without response, or take over an expired key.
+
+    Return False if the key is already used.
+    """
+    statement = insert(models_idempotency.IdempotencyKey).values(
+        scope=scope,
+        key=key,
+        request_hash=request_hash,
+        expire_on=expire_on,
+        status_code=None,
+        response_body=None,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[
+            models_idempotency.IdempotencyKey.scope,
+            models_idempotency.IdempotencyKey.key,
+        ],
+        set_={
+            "request_hash": statement.excluded.request_hash,
+            "expire_on": statement.excluded.expire_on,
+            "status_code": None,
+            "response_body": None,
+        },
+        where=models_idempotency.IdempotencyKey.expire_on < now,
+    ).returning(models_idempotency.IdempotencyKey.key)
+    result = await db_session.execute(statement)
+    claimed = result.first() is not None
+    await db_session.commit()
+    return claimed
+
+
+async def get_idempotency_key(
+    db_session: AsyncSession, scope: str, key: str
+) -> models_idempotency.IdempotencyKey | None:
+    result = await db_session.execute(
+        select(models_idempotency.IdempotencyKey).where(
+            models_idempotency.IdempotencyKey.scope == scope,
+            models_idempotency.IdempotencyKey.key == key,
+        )
+    )
+    return result.scalars().first()
+
+
+async def save_idempotency_response(
+    db_session: AsyncSession,
+    scope: str,
+    key: str,
+    status_code: int,
+    response_body: bytes,
+    expire_on: datetime,
+):
+    await db_session.execute(
+        update(models_idempotency.IdempotencyKey)
+        .where(
+            models_idempotency.IdempotencyKey.scope == scope,
+            models_idempotency.IdempotencyKey.key == key,
+        )
+        .values(
+            status_code=status_code,
+            response_body=response_body,
+            expire_on=expire_on,
+        ),
+    )
+    await db_session.commit()
+
+
+async def delete_idempotency_key(db_session: AsyncSession, scope: str, key: str):
+    await db_session.execute(
+        delete(models_idempotency.IdempotencyKey).where(
+            models_idempotency.IdempotencyKey.scope == scope,
+            models_idempotency.IdempotencyKey.key == key,
+        ),
+    )
+    await db_session.commit()
+
+
+async def delete_expired_idempotency_keys(
+    db_session: AsyncSession, now: datetime, limit: int
+) -> int:
+    """Delete at most `limit` expired keys, return the number of deleted keys"""
+    expired_keys = (
+        select(
+            models_idempotency.IdempotencyKey.scope,
+            models_idempotency.IdempotencyKey.key,
+        )
+        .where(models_idempotency.IdempotencyKey.expire_on < now)
+        .limit(limit)
+    )
+    result = await db_session.execute(
+        delete(models_idempotency.IdempotencyKey).where(
+            tuple_(
+                models_idempotency.IdempotencyKey.scope,
+                models_idempotency.IdempotencyKey.key,
+            ).in_(expired_keys)
+        ),
+    )
+    await db_session.commit()
+    return result.rowcount
@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from app.types.sqlalchemy import Base
+from sqlalchemy import String
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+class IdempotencyKey(Base):
+    """
+    The response of a write request sent with an `Idempotency-Key` header.
+
+    A row without `status_code` is claimed by a request which is still being executed.
+    """
+
+    __tablename__ = "idempotency_key"
+
+    scope: Mapped[str] = mapped_column(String(64), primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64))
+    expire_on: Mapped[datetime] = mapped_column(index=True)
+    status_code: Mapped[int | None] = mapped_column(default=None)
+    response_body: Mapped[bytes | None] = mapped_column(default=None)
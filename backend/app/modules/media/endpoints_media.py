@@ -0,0 +1,43 @@
+from pathlib import Path
+from typing import Annotated
+
+from app.dependencies import get_settings
+from app.types.content_type import ContentType
+from app.utils import blob_store
+from app.utils.config import Settings
+from app.utils.etags import etag_matches
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.responses import FileResponse
+
+router = APIRouter(prefix="/media", tags=["media"])
+
+# Blobs are content-addressed, their content never changes for a given url
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@router.get("/{sha256}", response_class=FileResponse)
+async def get_blob(
+    settings: Annotated[Settings, Depends(get_settings)],
+    sha256: str,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    """
+    Download a blob.
+
+    The file is sent with `sendfile` when the server supports it, and `Range` requests are supported.
+    The hash is used as ETag, a request with a matching `If-None-Match` header gets a 304.
+    """
+    if not blob_store.SHA256_PATTERN.match(sha256):
+        raise HTTPException(status_code=404, detail="Blob not found")
+
+    etag = f'"{sha256}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if if_none_match is not None and etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    blob_path = blob_store.get_blob_path(
+        root=Path(settings.BLOB_STORE_DIRECTORY), sha256=sha256
+    )
+    if not blob_path.is_file():
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return FileResponse(blob_path, media_type=ContentType.jpg, headers=headers)
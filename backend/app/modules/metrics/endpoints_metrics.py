@@ -0,0 +1,18 @@
+from app.dependencies import is_user
+from app.modules.users.types_users import AccountType
+from app.utils import metrics
+from fastapi import APIRouter, Depends
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get(
+    "/",
+    dependencies=[Depends(is_user(AccountType.admin))],
+    response_model=dict[str, dict[str, float]],
+)
+async def get_metrics():
+    """
+    Get the metrics of the worker process which handles the request.
+    """
+    return metrics.get_metrics()
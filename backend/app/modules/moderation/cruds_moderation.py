@@ -0,0 +1,147 @@
+from collections.abc import Sequence
+from datetime import datetime
+from uuid import UUID
+
+from app.modules.moderation import schemas_moderation
+from app.modules.reports import cruds_reports, models_reports, types_reports
+from geoalchemy2.functions import ST_X, ST_Y
+from sqlalchemy import (
+    ColumnElement,
+    RowMapping,
+    Uuid,
+    cast,
+    column,
+    literal,
+    or_,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def is_pending_review() -> ColumnElement[bool]:
+    # The status is rendered inline instead of being sent as a parameter,
+    # so that the planner can always use the partial index on pending reports
+    return models_reports.Report.status == literal(
+        types_reports.ReportStatus.PENDING_REVIEW,
+        models_reports.Report.status.type,
+        literal_execute=True,
+    )
+
+
+async def claim_pending_reports(
+    db_session: AsyncSession,
+    moderator_id: UUID,
+    now: datetime,
+    claim_expire_on: datetime,
+    limit: int,
+) -> Sequence[RowMapping]:
+    """
+    Claim the oldest pending reports which are not claimed, or whose claim expired.
+
+    Rows locked by a concurrent claim are skipped instead of waited for,
+    so that concurrent moderators never receive the same reports.
+    """
+    claimable_report_ids = (
+        select(models_reports.Report.id)
+        .where(
+            is_pending_review(),
+            or_(
+                models_reports.Report.claim_expire_on.is_(None),
+                models_reports.Report.claim_expire_on < now,
+            ),
+        )
+        .order_by(models_reports.Report.creation_time)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(models_reports.Report.id.in_(claimable_report_ids))
+        .values(claimed_by_id=moderator_id, claim_expire_on=claim_expire_on)
+        .returning(
+            models_reports.Report.id,
+            models_reports.Report.title,
+            models_reports.Report.report_type,
+            models_reports.Report.description,
+            models_reports.Report.creation_time,
+            models_reports.Report.claim_expire_on,
+            ST_Y(models_reports.Report.location).label("latitude"),
+            ST_X(models_reports.Report.location).label("longitude"),
+        )
+    )
+    claimed_reports = result.mappings().all()
+    await db_session.commit()
+    return sorted(claimed_reports, key=lambda report: report["creation_time"])
+
+
+async def apply_moderation_decisions(
+    db_session: AsyncSession,
+    moderator_id: UUID,
+    now: datetime,
+    decisions: Sequence[schemas_moderation.ModerationDecision],
+) -> Sequence[RowMapping]:
+    """
+    Set the status of reports claimed by the moderator, in a single statement.
+
+    Return the `id`, `status`, `version` and coordinates of the decided reports. Reports which are not pending anymore,
+    or whose claim belongs to another moderator or expired, are left unchanged.
+    """
+    decision_values = values(
+        column("report_id", Uuid()),
+        column("status", models_reports.Report.status.type),
+        name="decision",
+    ).data([(decision.report_id, decision.status) for decision in decisions])
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(
+            models_reports.Report.id == decision_values.c.report_id,
+            is_pending_review(),
+            models_reports.Report.claimed_by_id == moderator_id,
+            models_reports.Report.claim_expire_on >= now,
+        )
+        .values(
+            status=cast(
+                decision_values.c.status, models_reports.Report.status.type
+            ),
+            claimed_by_id=None,
+            claim_expire_on=None,
+            version=models_reports.Report.version + 1,
+        )
+        .returning(*cruds_reports.report_change_columns())
+    )
+    decided_reports = result.mappings().all()
+    await cruds_reports.add_report_history(
+        db_session=db_session,
+        entries=[
+            cruds_reports.get_report_history_entry(
+                report_id=decided_report["id"],
+                action=types_reports.ReportHistoryAction.MODERATION,
+                version=decided_report["version"],
+                changes={"status": decided_report["status"].value},
+                user_id=moderator_id,
+            )
+            for decided_report in decided_reports
+        ],
+    )
+    await cruds_reports.publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.UPDATED,
+        reports=decided_reports,
+    )
+    await db_session.commit()
+    return decided_reports
+
+
+async def release_moderator_claims(db_session: AsyncSession, moderator_id: UUID):
+    """Release all the pending reports claimed by a moderator"""
+    await db_session.execute(
+        update(models_reports.Report)
+        .where(
+            is_pending_review(),
+            models_reports.Report.claimed_by_id == moderator_id,
+        )
+        .values(claimed_by_id=None, claim_expire_on=None),
+    )
+    await db_session.commit()
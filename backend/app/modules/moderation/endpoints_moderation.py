@@ -0,0 +1,148 @@
+from datetime import UTC, datetime, timedelta
+from typing import Annotated, Sequence
+
+from app.dependencies import (
+    get_db_session,
+    get_report_ids_by_shard,
+    get_settings,
+    is_user,
+)
+from app.modules.moderation import cruds_moderation, schemas_moderation
+from app.modules.reports.types_reports import ReportStatus
+from app.modules.users import models_users
+from app.modules.users.types_users import AccountType
+from app.types import standard_responses
+from app.utils import report_cache, sharding
+from app.utils.config import Settings
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+router = APIRouter(prefix="/moderation", tags=["moderation"])
+
+
+@router.post(
+    "/claims",
+    response_model=Sequence[schemas_moderation.ClaimedReport],
+)
+async def claim_pending_reports(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    user: Annotated[models_users.User, Depends(is_user(AccountType.moderator))],
+    limit: int = 10,
+):
+    """
+    Claim the next pending reports of the moderation queue.
+
+    Claimed reports are reserved to the moderator until their lease expires,
+    other moderators claiming at the same time receive different reports.
+    Shards are claimed from one after the other, until enough reports are claimed.
+    """
+    if not 0 < limit <= settings.MODERATION_MAX_CLAIM_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Between 1 and {settings.MODERATION_MAX_CLAIM_SIZE} reports can be claimed at once",
+        )
+    now = datetime.now(UTC)
+    claim_expire_on = now + timedelta(minutes=settings.MODERATION_CLAIM_LEASE_MINUTES)
+    claimed_reports = []
+    for shard in sharding.get_shard_names():
+        if len(claimed_reports) >= limit:
+            break
+        if shard == sharding.DEFAULT_SHARD:
+            claimed_reports += await cruds_moderation.claim_pending_reports(
+                db_session=db_session,
+                moderator_id=user.id,
+                now=now,
+                claim_expire_on=claim_expire_on,
+                limit=limit - len(claimed_reports),
+            )
+        else:
+            claimed_reports += await sharding.run_in_shard_session(
+                shard,
+                cruds_moderation.claim_pending_reports,
+                moderator_id=user.id,
+                now=now,
+                claim_expire_on=claim_expire_on,
+                limit=limit - len(claimed_reports),
+            )
+    return claimed_reports
+
+
+@router.delete("/claims", status_code=204)
+async def release_claims(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    user: Annotated[models_users.User, Depends(is_user(AccountType.moderator))],
+):
+    """
+    Release the reports claimed by the moderator, so that other moderators can claim them.
+    """
+    await cruds_moderation.release_moderator_claims(
+        db_session=db_session, moderator_id=user.id
+    )
+    shards = [
+        shard
+        for shard in sharding.get_shard_names()
+        if shard != sharding.DEFAULT_SHARD
+    ]
+    await sharding.fan_out(
+        shards, cruds_moderation.release_moderator_claims, moderator_id=user.id
+    )
+
+
+@router.post("/decisions", response_model=standard_responses.BatchResult)
+async def submit_decisions(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    user: Annotated[models_users.User, Depends(is_user(AccountType.moderator))],
+    decisions: list[schemas_moderation.ModerationDecision],
+):
+    """
+    Set the status of several claimed reports at once.
+
+    Decisions on reports which are not claimed by the moderator, or whose lease expired, are returned as failed.
+    """
+    if any(decision.status == ReportStatus.PENDING_REVIEW for decision in decisions):
+        raise HTTPException(
+            status_code=400,
+            detail="A decision can not keep a report pending",
+        )
+    if not decisions:
+        return standard_responses.BatchResult(failed={})
+
+    now = datetime.now(UTC)
+    report_ids_by_shard = await get_report_ids_by_shard(
+        db_session=db_session,
+        report_ids=[decision.report_id for decision in decisions],
+    )
+    decided_reports = []
+    for shard, report_ids in report_ids_by_shard.items():
+        shard_report_ids = set(report_ids)
+        shard_decisions = [
+            decision for decision in decisions if decision.report_id in shard_report_ids
+        ]
+        if shard == sharding.DEFAULT_SHARD:
+            decided_reports += await cruds_moderation.apply_moderation_decisions(
+                db_session=db_session,
+                moderator_id=user.id,
+                now=now,
+                decisions=shard_decisions,
+            )
+        else:
+            decided_reports += await sharding.run_in_shard_session(
+                shard,
+                cruds_moderation.apply_moderation_decisions,
+                moderator_id=user.id,
+                now=now,
+                decisions=shard_decisions,
+            )
+    report_cache.invalidate_locations(
+        (decided_report["longitude"], decided_report["latitude"])
+        for decided_report in decided_reports
+    )
+    decided_report_ids = {decided_report["id"] for decided_report in decided_reports}
+    return standard_responses.BatchResult(
+        failed={
+            str(decision.report_id): "Report is not claimed by the moderator or the claim expired"
+            for decision in decisions
+            if decision.report_id not in decided_report_ids
+        },
+    )
@@ -0,0 +1,23 @@
+from datetime import datetime
+from uuid import UUID
+
+from app.modules.reports.types_reports import ReportStatus, ReportType
+from pydantic import BaseModel, ConfigDict
+
+
+class ClaimedReport(BaseModel):
+    id: UUID
+    title: str
+    report_type: ReportType
+    description: str
+    latitude: float
+    longitude: float
+    creation_time: datetime
+    claim_expire_on: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ModerationDecision(BaseModel):
+    report_id: UUID
+    status: ReportStatus
@@ -1,21 +1,254 @@
 import json
-from collections.abc import Sequence
+import uuid
+from collections.abc import Iterable, Mapping, Sequence
+from datetime import UTC, date, datetime, timedelta
+from functools import lru_cache
+from typing import Any
 from uuid import UUID
 
 from app.modules.reports import models_reports, schemas_reports, types_reports
-from geoalchemy2 import WKTElement
+from app.modules.votes import models_votes
+from app.utils import cache_bus
+from geoalchemy2 import Geography, WKBElement, WKTElement
 from geoalchemy2.functions import ST_X, ST_Y
-from sqlalchemy import RowMapping, delete, select, update
+from sqlalchemy import (
+    BigInteger,
+    ColumnElement,
+    Interval,
+    Row,
+    RowMapping,
+    Table,
+    Uuid,
+    and_,
+    any_,
+    case,
+    cast,
+    delete,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    text,
+    true,
+    tuple_,
+    type_coerce,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+# Reports which are still displayed and may thus receive duplicates
+OPEN_REPORT_STATUSES = (
+    types_reports.ReportStatus.ACTIVE,
+    types_reports.ReportStatus.PENDING_REVIEW,
+)
+
+METERS_PER_DEGREE = 111_320
+
+
+def is_open_report(
+    report: type[models_reports.Report] = models_reports.Report,
+) -> ColumnElement[bool]:
+    """
+    Check that a report is open, ie. displayed on the map.
+
+    Statuses are rendered inline instead of being sent as parameters, so that the planner can always
+    use the spatial index, which only covers open reports.
+    """
+    return report.status.in_(
+        [
+            literal(status, models_reports.Report.status.type, literal_execute=True)
+            for status in OPEN_REPORT_STATUSES
+        ]
+    )
+
+
+def report_coordinates(
+    report: type[models_reports.Report] = models_reports.Report,
+    prefix: str = "",
+) -> tuple[ColumnElement[float], ColumnElement[float]]:
+    """The `longitude` and `latitude` columns of a report, to be returned by mutations"""
+    return (
+        ST_X(report.location).label(f"{prefix}longitude"),
+        ST_Y(report.location).label(f"{prefix}latitude"),
+    )
+
+
+def report_change_columns(
+    report: type[models_reports.Report] = models_reports.Report,
+) -> tuple[ColumnElement[Any], ...]:
+    """The columns of a report published to the other workers and the report stream, to be returned by mutations"""
+    return (
+        report.id,
+        report.report_type,
+        report.status,
+        report.version,
+        *report_coordinates(report),
+    )
+
+
+def as_geometry(location: WKBElement | WKTElement) -> ColumnElement:
+    """Bind a location as a geometry so that it can be used in spatial functions and casts"""
+    return type_coerce(location, models_reports.Report.location.type)
+
+
+def within_distance(
+    location: ColumnElement,
+    point: ColumnElement,
+    distance_meters: float,
+) -> ColumnElement[bool]:
+    """
+    Check that `location` is less than `distance_meters` away from `point`.
+
+    The geometry `ST_DWithin` uses the spatial index with a distance in degrees. As a degree of longitude
+    shrinks with the latitude, converting the distance with the size of a longitude degree gives an upper bound.
+    The geography `ST_DWithin` then checks the real distance in meters on the few remaining rows.
+    """
+    bounding_degrees = distance_meters / (
+        METERS_PER_DEGREE
+        * func.greatest(func.cos(func.radians(ST_Y(point))), 0.01)
+    )
+    return and_(
+        func.ST_DWithin(location, point, bounding_degrees),
+        func.ST_DWithin(
+            cast(location, Geography(srid=models_reports.SRID)),
+            cast(point, Geography(srid=models_reports.SRID)),
+            distance_meters,
+        ),
+    )
+
+
+def distance_between(location: ColumnElement, point: ColumnElement) -> ColumnElement:
+    """Distance in meters between two geometries"""
+    return func.ST_Distance(
+        cast(location, Geography(srid=models_reports.SRID)),
+        cast(point, Geography(srid=models_reports.SRID)),
+    )
+
 
 # ========================================
 # REPORTS
 # ========================================
 
 
+def get_report_history_entry(
+    report_id: UUID,
+    action: types_reports.ReportHistoryAction,
+    version: int | None,
+    changes: dict[str, Any],
+    user_id: UUID | None = None,
+) -> dict[str, Any]:
+    """`changes` should only contain the changed fields, serialized as JSON values"""
+    return {
+        "id": uuid.uuid4(),
+        "creation_time": datetime.now(UTC),
+        "report_id": report_id,
+        "action": action,
+        "version": version,
+        "changes": changes,
+        "user_id": user_id,
+    }
+
+
+async def add_report_history(
+    db_session: AsyncSession, entries: Sequence[dict[str, Any]]
+):
+    """
+    Append entries to the history, in the transaction of the mutation they describe.
+    The caller is responsible for the commit.
+    """
+    if entries:
+        await db_session.execute(insert(models_reports.ReportHistory), entries)
+
+
+def get_report_change(
+    action: types_reports.ReportChangeAction, report: Mapping[str, Any]
+) -> dict[str, Any]:
+    """
+    A change of a report, as published to the other workers.
+
+    `report` should contain the `report_change_columns`, and the `previous_longitude` and `previous_latitude`
+    of the report if it may have moved.
+    """
+    change = {
+        "id": str(report["id"]),
+        "action": action.value,
+        "report_type": report["report_type"].value,
+        "status": report["status"].value,
+        "version": report["version"],
+        "longitude": report["longitude"],
+        "latitude": report["latitude"],
+    }
+    if report.get("previous_longitude") is not None and (
+        report["previous_longitude"],
+        report["previous_latitude"],
+    ) != (report["longitude"], report["latitude"]):
+        change["previous_longitude"] = report["previous_longitude"]
+        change["previous_latitude"] = report["previous_latitude"]
+    return change
+
+
+def get_report_change_values(report: models_reports.Report) -> dict[str, Any]:
+    """The `report_change_columns` of a report object"""
+    point = report.get_shapely_location()
+    return {
+        "id": report.id,
+        "report_type": report.report_type,
+        "status": report.status,
+        "version": report.version,
+        "longitude": point.x,
+        "latitude": point.y,
+    }
+
+
+async def publish_report_changes(
+    db_session: AsyncSession,
+    action: types_reports.ReportChangeAction,
+    reports: Iterable[Mapping[str, Any]],
+):
+    """
+    Publish the changes of reports to all workers once the transaction is committed:
+    their cached listings are invalidated and the change is pushed to the report stream subscribers
+    """
+    await cache_bus.publish(
+        db_session=db_session,
+        event_type="reports",
+        items=[get_report_change(action=action, report=report) for report in reports],
+    )
+
+
+def get_report_creation_changes(report: models_reports.Report) -> dict[str, Any]:
+    return {
+        "title": report.title,
+        "report_type": report.report_type.value,
+        "status": report.status.value,
+        "description": report.description,
+        "location": report.get_shapely_location().wkt,
+    }
+
+
 async def create_report(db_session: AsyncSession, new_report: models_reports.Report):
     """Create a full report in db"""
     db_session.add(new_report)
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=new_report.id,
+                action=types_reports.ReportHistoryAction.CREATION,
+                version=new_report.version,
+                changes=get_report_creation_changes(new_report),
+            )
+        ],
+    )
+    await publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.CREATED,
+        reports=[get_report_change_values(new_report)],
+    )
     await db_session.commit()
 
 
@@ -33,48 +266,1080 @@ async def get_report_by_id(
     return result.mappings().first()
 
 
+async def get_report_version(
+    report_id: UUID, db_session: AsyncSession
+) -> int | None:
+    """Get the version of a report, or None if it does not exist. This is cheaper than loading the report"""
+    result = await db_session.execute(
+        select(models_reports.Report.version).where(
+            models_reports.Report.id == report_id
+        )
+    )
+    return result.scalar()
+
+
 async def get_reports_in_location(
     db_session: AsyncSession, location: WKTElement
 ) -> Sequence[RowMapping]:
-    """Get reports in a geometry"""
+    """Get open reports in a geometry, highest score first"""
     result = await db_session.execute(
         select(
             models_reports.Report,
             ST_Y(models_reports.Report.location).label("latitude"),
             ST_X(models_reports.Report.location).label("longitude"),
-        ).filter(models_reports.Report.location.ST_Intersects(location))
+        )
+        .filter(
+            is_open_report(),
+            models_reports.Report.location.ST_Intersects(location),
+        )
+        .order_by(models_reports.Report.score.desc())
+    )
+    return result.mappings().all()
+
+
+@lru_cache(maxsize=1024)
+def get_report_field_columns(fields: frozenset[str]) -> tuple[ColumnElement[Any], ...]:
+    """
+    The columns to select for a set of fields of `schemas_reports.Report`, labelled by field name.
+
+    The id, needed to read the photos, the version and the vote counters, used as ETag, and the score,
+    used to order listings, are always selected.
+    The columns are built once per set of fields, in a stable order, so that their statements
+    are compiled once and then found in the SQLAlchemy compiled cache.
+    """
+    columns = {
+        "id": models_reports.Report.id,
+        "title": models_reports.Report.title,
+        "report_type": models_reports.Report.report_type,
+        "latitude": ST_Y(models_reports.Report.location).label("latitude"),
+        "longitude": ST_X(models_reports.Report.location).label("longitude"),
+        "description": models_reports.Report.description,
+        "creation_time": models_reports.Report.creation_time,
+        "version": models_reports.Report.version,
+        "last_updated_time": models_reports.Report.last_updated_time,
+        "up_count": models_reports.Report.up_count,
+        "down_count": models_reports.Report.down_count,
+        "score": models_reports.Report.score,
+    }
+    return tuple(
+        column
+        for field, column in columns.items()
+        if field in fields
+        or field in ("id", "version", "up_count", "down_count", "score")
+    )
+
+
+async def get_report_fields_by_id(
+    db_session: AsyncSession,
+    report_id: UUID,
+    columns: Sequence[ColumnElement[Any]],
+) -> RowMapping | None:
+    """Get only some columns of a report, see `get_report_field_columns`"""
+    result = await db_session.execute(
+        select(*columns).where(models_reports.Report.id == report_id)
+    )
+    return result.mappings().first()
+
+
+async def get_report_fields_in_location(
+    db_session: AsyncSession,
+    location: WKTElement,
+    columns: Sequence[ColumnElement[Any]],
+) -> Sequence[RowMapping]:
+    """Get only some columns of the open reports in a geometry, highest score first, see `get_report_field_columns`"""
+    result = await db_session.execute(
+        select(*columns)
+        .where(
+            is_open_report(),
+            models_reports.Report.location.ST_Intersects(location),
+        )
+        .order_by(models_reports.Report.score.desc())
+    )
+    return result.mappings().all()
+
+
+async def get_top_reports_in_box(
+    db_session: AsyncSession,
+    cells: Sequence[int],
+    location: WKTElement,
+    ranking: types_reports.ReportRanking,
+    limit: int,
+) -> Sequence[RowMapping]:
+    """
+    Get the `limit` best ranked open reports in a box, covered by the ranking grid `cells`.
+
+    The best reports of each cell are read from the top of its `(cell, score)` or `(cell, hot)` index,
+    then the best of them are kept. The cost depends on the number of cells, not on the number of reports.
+    """
+    cell_table = (
+        func.unnest(literal(list(cells), ARRAY(BigInteger())))
+        .table_valued("cell")
+        .render_derived(name="ranking_cell")
+    )
+    rank = getattr(models_reports.Report, ranking.value)
+    cell_top = (
+        select(models_reports.Report)
+        .where(
+            models_reports.Report.cell == cell_table.c.cell,
+            is_open_report(),
+            models_reports.Report.location.ST_Intersects(location),
+        )
+        .order_by(rank.desc())
+        .limit(limit)
+        .lateral("cell_top")
+    )
+    top_report = aliased(models_reports.Report, cell_top, name="Report")
+    result = await db_session.execute(
+        select(
+            top_report,
+            ST_Y(top_report.location).label("latitude"),
+            ST_X(top_report.location).label("longitude"),
+        )
+        .select_from(cell_table)
+        .join(cell_top, true())
+        .order_by(getattr(top_report, ranking.value).desc())
+        .limit(limit)
     )
     return result.mappings().all()
 
 
+async def get_open_reports_by_ids_in_location(
+    db_session: AsyncSession, report_ids: Sequence[UUID], location: WKTElement
+) -> Sequence[RowMapping]:
+    """Get the open reports in a geometry among `report_ids`, with a single query"""
+    result = await db_session.execute(
+        select(
+            models_reports.Report,
+            ST_Y(models_reports.Report.location).label("latitude"),
+            ST_X(models_reports.Report.location).label("longitude"),
+        ).where(
+            is_in_reports(models_reports.Report.id, report_ids),
+            is_open_report(),
+            models_reports.Report.location.ST_Intersects(location),
+        )
+    )
+    return result.mappings().all()
+
+
+async def get_report_author(
+    db_session: AsyncSession, report_id: UUID
+) -> RowMapping | None:
+    """Get the `author_id` of a report with its coordinates, or None if the report does not exist"""
+    result = await db_session.execute(
+        select(models_reports.Report.author_id, *report_coordinates()).where(
+            models_reports.Report.id == report_id
+        )
+    )
+    return result.mappings().first()
+
+
+async def get_author_stats(
+    db_session: AsyncSession, author_ids: Sequence[UUID], region_precision: int
+) -> Sequence[Row[tuple[UUID, str, int, int]]]:
+    """
+    Count the reports of several authors and the up votes they received, by region.
+    Return `(author_id, region, report_count, upvote_count)` rows, regions are geohashes of `region_precision`
+    """
+    region = func.ST_GeoHash(models_reports.Report.location, region_precision)
+    result = await db_session.execute(
+        select(
+            models_reports.Report.author_id,
+            region,
+            func.count(),
+            func.coalesce(func.sum(models_reports.Report.up_count), 0),
+        )
+        .where(is_in_reports(models_reports.Report.author_id, author_ids))
+        .group_by(models_reports.Report.author_id, region)
+    )
+    return result.all()
+
+
 async def update_report_by_id(
     report_id: UUID,
     db_session: AsyncSession,
     report_edit: schemas_reports.ReportEdit,
-):
-    """Update a report in db"""
-    await db_session.execute(
+    version: int,
+    update_time: datetime,
+) -> RowMapping | None:
+    """
+    Update a report in db if its current version is `version`.
+
+    Return the new `version` and vote counters, with the coordinates of the report before
+    (`previous_longitude`, `previous_latitude`) and after the edit, or None if the report does not exist or was changed in the meantime.
+    The version is checked by the update itself, no row is read or locked beforehand.
+    """
+    # Joining the table to itself gives access to the row as it was before the update
+    previous = aliased(models_reports.Report)
+    report_values = report_edit.model_dump(exclude_none=True, exclude={"version"})
+    if "location" in report_values:
+        report_values["location"] = WKTElement(
+            report_values["location"], srid=models_reports.SRID
+        )
+    result = await db_session.execute(
         update(models_reports.Report)
-        .where(models_reports.Report.id == report_id)
-        .values(**report_edit.model_dump(exclude_none=True)),
+        .where(
+            models_reports.Report.id == report_id,
+            models_reports.Report.version == version,
+            previous.id == models_reports.Report.id,
+        )
+        .values(
+            **report_values,
+            version=models_reports.Report.version + 1,
+            last_updated_time=update_time,
+        )
+        .returning(
+            *report_change_columns(),
+            *report_coordinates(previous, prefix="previous_"),
+            models_reports.Report.up_count,
+            models_reports.Report.down_count,
+        ),
     )
+    updated_report = result.mappings().first()
+    if updated_report is not None:
+        await add_report_history(
+            db_session=db_session,
+            entries=[
+                get_report_history_entry(
+                    report_id=report_id,
+                    action=types_reports.ReportHistoryAction.EDIT,
+                    version=updated_report["version"],
+                    changes=report_edit.model_dump(
+                        mode="json", exclude_none=True, exclude={"version"}
+                    ),
+                )
+            ],
+        )
+        await publish_report_changes(
+            db_session=db_session,
+            action=types_reports.ReportChangeAction.UPDATED,
+            reports=[updated_report],
+        )
+    await db_session.commit()
+    return updated_report
 
 
 async def update_report_status_by_id(
     report_id: UUID,
     db_session: AsyncSession,
     new_report_status: types_reports.ReportStatus,
-):
-    """Update the status of a report in db"""
-    await db_session.execute(
+) -> RowMapping | None:
+    """
+    Update the status of a report in db.
+
+    Return its new `version` and its coordinates, or None if the report does not exist.
+    """
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(models_reports.Report.id == report_id)
+        .values(
+            status=new_report_status,
+            version=models_reports.Report.version + 1,
+        )
+        .returning(*report_change_columns()),
+    )
+    updated_report = result.mappings().first()
+    if updated_report is None:
+        return None
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=report_id,
+                action=types_reports.ReportHistoryAction.STATUS_CHANGE,
+                version=updated_report["version"],
+                changes={"status": new_report_status.value},
+            )
+        ],
+    )
+    await publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.UPDATED,
+        reports=[updated_report],
+    )
+    await db_session.commit()
+    return updated_report
+
+
+async def update_reports_status(
+    db_session: AsyncSession,
+    report_ids: Sequence[UUID],
+    new_report_status: types_reports.ReportStatus,
+) -> Sequence[RowMapping]:
+    """
+    Update the status of several reports in a single statement.
+
+    Return the `id`, `version` and coordinates of the updated reports. The ids are sent as a single array parameter.
+    """
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(
+            models_reports.Report.id
+            == any_(literal(list(report_ids), ARRAY(Uuid())))
+        )
+        .values(
+            status=new_report_status,
+            version=models_reports.Report.version + 1,
+        )
+        .returning(*report_change_columns()),
+    )
+    updated_reports = result.mappings().all()
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=updated_report["id"],
+                action=types_reports.ReportHistoryAction.STATUS_CHANGE,
+                version=updated_report["version"],
+                changes={"status": new_report_status.value},
+            )
+            for updated_report in updated_reports
+        ],
+    )
+    await publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.UPDATED,
+        reports=updated_reports,
+    )
+    await db_session.commit()
+    return updated_reports
+
+
+async def archive_expired_reports(
+    db_session: AsyncSession,
+    report_type: types_reports.ReportType,
+    created_before: datetime,
+    limit: int,
+) -> Sequence[RowMapping]:
+    """
+    Archive at most `limit` active reports of a type created before `created_before`.
+
+    Return the `id`, `version` and coordinates of the archived reports. Rows locked by a concurrent update are skipped.
+    """
+    expired_report_ids = (
+        select(models_reports.Report.id)
+        .where(
+            models_reports.Report.report_type == report_type,
+            models_reports.Report.status
+            == literal(
+                types_reports.ReportStatus.ACTIVE,
+                models_reports.Report.status.type,
+                literal_execute=True,
+            ),
+            models_reports.Report.creation_time < created_before,
+        )
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db_session.execute(
         update(models_reports.Report)
+        .where(models_reports.Report.id.in_(expired_report_ids))
+        .values(
+            status=types_reports.ReportStatus.ARCHIVED,
+            version=models_reports.Report.version + 1,
+        )
+        .returning(*report_change_columns()),
+    )
+    archived_reports = result.mappings().all()
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=archived_report["id"],
+                action=types_reports.ReportHistoryAction.EXPIRATION,
+                version=archived_report["version"],
+                changes={"status": types_reports.ReportStatus.ARCHIVED.value},
+            )
+            for archived_report in archived_reports
+        ],
+    )
+    await publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.UPDATED,
+        reports=archived_reports,
+    )
+    await db_session.commit()
+    return archived_reports
+
+
+async def delete_report_by_id(
+    report_id: UUID, db_session: AsyncSession
+) -> RowMapping | None:
+    """
+    Delete a report from db.
+
+    Return its last `version`, its coordinates, its `author_id` and `up_count`, or None if the report does not exist.
+    """
+    result = await db_session.execute(
+        delete(models_reports.Report)
         .where(models_reports.Report.id == report_id)
-        .values(status=new_report_status),
+        .returning(
+            *report_change_columns(),
+            models_reports.Report.author_id,
+            models_reports.Report.up_count,
+        ),
+    )
+    deleted_report = result.mappings().first()
+    if deleted_report is None:
+        return None
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=report_id,
+                action=types_reports.ReportHistoryAction.DELETION,
+                version=deleted_report["version"],
+                changes={},
+            )
+        ],
+    )
+    await publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.DELETED,
+        reports=[deleted_report],
+    )
+    await db_session.commit()
+    return deleted_report
+
+
+async def get_duplicate_report(
+    db_session: AsyncSession,
+    location: WKBElement,
+    report_type: types_reports.ReportType,
+    created_after: datetime,
+    distance_meters: float,
+) -> RowMapping | None:
+    """Get the closest open report of the same type created recently near a location"""
+    point = as_geometry(location)
+    distance = distance_between(models_reports.Report.location, point)
+    result = await db_session.execute(
+        select(
+            models_reports.Report,
+            ST_Y(models_reports.Report.location).label("latitude"),
+            ST_X(models_reports.Report.location).label("longitude"),
+            distance.label("distance"),
+        )
+        .where(
+            models_reports.Report.report_type == report_type,
+            is_open_report(),
+            models_reports.Report.creation_time >= created_after,
+            within_distance(models_reports.Report.location, point, distance_meters),
+        )
+        .order_by(distance)
+        .limit(1)
+    )
+    return result.mappings().first()
+
+
+async def get_duplicate_report_pairs(
+    db_session: AsyncSession,
+    window: timedelta,
+    distance_meters: float,
+    limit: int,
+) -> Sequence[RowMapping]:
+    """
+    Get open reports which duplicate an older open report of the same type.
+
+    Each duplicate is paired with the oldest report it duplicates.
+    """
+    duplicate = aliased(models_reports.Report, name="Report")
+    original = aliased(models_reports.Report)
+    result = await db_session.execute(
+        select(
+            duplicate,
+            original.id.label("original_id"),
+            ST_Y(duplicate.location).label("latitude"),
+            ST_X(duplicate.location).label("longitude"),
+            distance_between(original.location, duplicate.location).label(
+                "distance"
+            ),
+        )
+        .join(
+            original,
+            and_(
+                original.report_type == duplicate.report_type,
+                is_open_report(original),
+                original.creation_time < duplicate.creation_time,
+                original.creation_time
+                >= duplicate.creation_time - literal(window, Interval()),
+                within_distance(
+                    original.location, duplicate.location, distance_meters
+                ),
+            ),
+        )
+        .where(is_open_report(duplicate))
+        .distinct(duplicate.id)
+        .order_by(duplicate.id, original.creation_time)
+        .limit(limit)
     )
+    return result.mappings().all()
+
 
+# ========================================
+# REPORT MERGES
+# ========================================
 
-async def delete_report_by_id(report_id: UUID, db_session: AsyncSession):
-    """Delete a report in db"""
+
+async def create_report_merge(
+    db_session: AsyncSession, report_merge: models_reports.ReportMerge
+):
+    """Record a submission merged into an existing report"""
+    db_session.add(report_merge)
+    await db_session.commit()
+
+
+async def merge_duplicate_reports(
+    db_session: AsyncSession, report_merges: Sequence[models_reports.ReportMerge]
+):
+    """Archive existing duplicate reports and record their merges"""
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(
+            models_reports.Report.id.in_(
+                [report_merge.duplicate_report_id for report_merge in report_merges]
+            )
+        )
+        .values(
+            status=types_reports.ReportStatus.ARCHIVED,
+            version=models_reports.Report.version + 1,
+        )
+        .returning(*report_change_columns()),
+    )
+    archived_reports = result.mappings().all()
+    versions = {
+        archived_report["id"]: archived_report["version"]
+        for archived_report in archived_reports
+    }
+    db_session.add_all(report_merges)
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=report_merge.duplicate_report_id,
+                action=types_reports.ReportHistoryAction.MERGE,
+                version=versions.get(report_merge.duplicate_report_id),
+                changes={
+                    "status": types_reports.ReportStatus.ARCHIVED.value,
+                    "merged_into": str(report_merge.report_id),
+                },
+            )
+            for report_merge in report_merges
+            if report_merge.duplicate_report_id is not None
+        ],
+    )
+    await publish_report_changes(
+        db_session=db_session,
+        action=types_reports.ReportChangeAction.UPDATED,
+        reports=archived_reports,
+    )
+    await db_session.commit()
+
+
+async def get_report_merges(
+    db_session: AsyncSession,
+    status: types_reports.MergeStatus | None,
+    limit: int,
+    skip: int,
+) -> Sequence[RowMapping]:
+    """Get report merges, oldest first"""
+    query = select(
+        models_reports.ReportMerge,
+        ST_Y(models_reports.ReportMerge.location).label("latitude"),
+        ST_X(models_reports.ReportMerge.location).label("longitude"),
+    )
+    if status is not None:
+        query = query.where(models_reports.ReportMerge.status == status)
+    result = await db_session.execute(
+        query.order_by(models_reports.ReportMerge.creation_time)
+        .limit(limit)
+        .offset(skip)
+    )
+    return result.mappings().all()
+
+
+async def get_report_merge_by_id(
+    db_session: AsyncSession, merge_id: UUID
+) -> models_reports.ReportMerge | None:
+    """Get a report merge by its id"""
+    result = await db_session.execute(
+        select(models_reports.ReportMerge).where(
+            models_reports.ReportMerge.id == merge_id
+        )
+    )
+    return result.scalars().first()
+
+
+async def update_report_merge_status(
+    db_session: AsyncSession,
+    report_merge: models_reports.ReportMerge,
+    new_status: types_reports.MergeStatus,
+    decision_time: datetime,
+    restored_report: models_reports.Report | None = None,
+):
+    """
+    Record a moderation decision on a merge.
+
+    When a merge is reverted, the duplicate becomes a report of its own again:
+    an archived duplicate is reactivated, a merged submission is inserted as `restored_report`.
+    """
+    if new_status == types_reports.MergeStatus.REVERTED:
+        if restored_report is not None:
+            db_session.add(restored_report)
+            report_merge.duplicate_report_id = restored_report.id
+            await add_report_history(
+                db_session=db_session,
+                entries=[
+                    get_report_history_entry(
+                        report_id=restored_report.id,
+                        action=types_reports.ReportHistoryAction.MERGE_REVERT,
+                        version=restored_report.version,
+                        changes=get_report_creation_changes(restored_report),
+                    )
+                ],
+            )
+            await publish_report_changes(
+                db_session=db_session,
+                action=types_reports.ReportChangeAction.CREATED,
+                reports=[get_report_change_values(restored_report)],
+            )
+        elif report_merge.duplicate_report_id is not None:
+            result = await db_session.execute(
+                update(models_reports.Report)
+                .where(models_reports.Report.id == report_merge.duplicate_report_id)
+                .values(
+                    status=types_reports.ReportStatus.ACTIVE,
+                    version=models_reports.Report.version + 1,
+                )
+                .returning(*report_change_columns()),
+            )
+            reactivated_reports = result.mappings().all()
+            await add_report_history(
+                db_session=db_session,
+                entries=[
+                    get_report_history_entry(
+                        report_id=reactivated_report["id"],
+                        action=types_reports.ReportHistoryAction.MERGE_REVERT,
+                        version=reactivated_report["version"],
+                        changes={"status": types_reports.ReportStatus.ACTIVE.value},
+                    )
+                    for reactivated_report in reactivated_reports
+                ],
+            )
+            await publish_report_changes(
+                db_session=db_session,
+                action=types_reports.ReportChangeAction.UPDATED,
+                reports=reactivated_reports,
+            )
+    report_merge.status = new_status
+    report_merge.decision_time = decision_time
+    await db_session.commit()
+
+
+# ========================================
+# REPORT PHOTOS
+# ========================================
+
+
+async def create_report_photo(
+    db_session: AsyncSession, report_photo: models_reports.ReportPhoto
+) -> RowMapping | None:
+    """Create a report photo in db, and return the new `version` and the coordinates of the report"""
+    db_session.add(report_photo)
+    # The photos are part of the report representation
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(models_reports.Report.id == report_photo.report_id)
+        .values(version=models_reports.Report.version + 1)
+        .returning(*report_change_columns()),
+    )
+    updated_report = result.mappings().first()
+    await add_report_history(
+        db_session=db_session,
+        entries=[
+            get_report_history_entry(
+                report_id=report_photo.report_id,
+                action=types_reports.ReportHistoryAction.PHOTO_ADDITION,
+                version=updated_report["version"] if updated_report else None,
+                changes={"photo_id": str(report_photo.id)},
+            )
+        ],
+    )
+    if updated_report is not None:
+        await publish_report_changes(
+            db_session=db_session,
+            action=types_reports.ReportChangeAction.UPDATED,
+            reports=[updated_report],
+        )
+    await db_session.commit()
+    return updated_report
+
+
+async def count_report_photos(db_session: AsyncSession, report_id: UUID) -> int:
+    """Count the photos of a report"""
+    result = await db_session.execute(
+        select(func.count()).where(models_reports.ReportPhoto.report_id == report_id)
+    )
+    return result.scalar_one()
+
+
+async def get_photos_by_report_ids(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> Sequence[models_reports.ReportPhoto]:
+    """Get the photos of several reports, oldest first"""
+    if not report_ids:
+        return []
+    result = await db_session.execute(
+        select(models_reports.ReportPhoto)
+        .where(models_reports.ReportPhoto.report_id.in_(report_ids))
+        .order_by(models_reports.ReportPhoto.creation_time)
+    )
+    return result.scalars().all()
+
+
+async def get_referenced_blob_hashes(
+    db_session: AsyncSession, hashes: Sequence[str]
+) -> set[str]:
+    """Return the hashes, among `hashes`, of blobs used by a report photo"""
+    result = await db_session.execute(
+        select(models_reports.ReportPhoto.photo_sha256)
+        .where(models_reports.ReportPhoto.photo_sha256.in_(hashes))
+        .union(
+            select(models_reports.ReportPhoto.thumbnail_sha256).where(
+                models_reports.ReportPhoto.thumbnail_sha256.in_(hashes)
+            )
+        )
+    )
+    return set(result.scalars().all())
+
+
+# ========================================
+# REPORT HISTORY
+# ========================================
+
+
+async def get_report_history(
+    db_session: AsyncSession,
+    report_id: UUID,
+    limit: int,
+    before: tuple[datetime, UUID] | None = None,
+) -> Sequence[models_reports.ReportHistory]:
+    """
+    Get the history of a report, most recent first.
+
+    The history is paginated with a keyset: `before` is the `(creation_time, id)` of the last entry of the previous page.
+    """
+    query = select(models_reports.ReportHistory).where(
+        models_reports.ReportHistory.report_id == report_id
+    )
+    if before is not None:
+        query = query.where(
+            tuple_(
+                models_reports.ReportHistory.creation_time,
+                models_reports.ReportHistory.id,
+            )
+            < tuple_(
+                literal(before[0], models_reports.ReportHistory.creation_time.type),
+                literal(before[1], Uuid()),
+            )
+        )
+    result = await db_session.execute(
+        query.order_by(
+            models_reports.ReportHistory.creation_time.desc(),
+            models_reports.ReportHistory.id.desc(),
+        ).limit(limit)
+    )
+    return result.scalars().all()
+
+
+async def get_report_history_partitions(db_session: AsyncSession) -> list[str]:
+    """Get the names of the partitions of the history table"""
+    result = await db_session.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = CAST(:parent AS regclass)"
+        ),
+        {"parent": models_reports.ReportHistory.__tablename__},
+    )
+    return list(result.scalars().all())
+
+
+async def create_report_history_partition(
+    db_session: AsyncSession, name: str, start: date, end: date
+):
+    """
+    Create the partition `name` of the history table for entries created from `start` (included) to `end` (excluded).
+
+    DDL statements do not accept parameters: `name` must be generated by the application, never from user input.
+    """
+    await db_session.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {name} "
+            f"PARTITION OF {models_reports.ReportHistory.__tablename__} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    )
+    await db_session.commit()
+
+
+async def drop_report_history_partition(db_session: AsyncSession, name: str):
+    """
+    Detach then drop a partition of the history table. This removes all its entries
+    without scanning them, unlike a DELETE.
+    """
+    await db_session.execute(
+        text(
+            f"ALTER TABLE {models_reports.ReportHistory.__tablename__} DETACH PARTITION {name}"
+        )
+    )
+    await db_session.execute(text(f"DROP TABLE {name}"))
+    await db_session.commit()
+
+
+# ========================================
+# REPORT SHARDS
+# ========================================
+
+# Tables holding a report and the rows attached to it, in insertion order, moved together between shards
+REPORT_TABLES = (
+    models_reports.Report.__table__,
+    models_reports.ReportPhoto.__table__,
+    models_reports.ReportMerge.__table__,
+    models_reports.ReportHistory.__table__,
+    models_votes.Vote.__table__,
+)
+
+
+def is_in_reports(column: ColumnElement[UUID], report_ids: Sequence[UUID]):
+    return column == any_(literal(list(report_ids), ARRAY(Uuid())))
+
+
+async def get_report_shards(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> dict[UUID, str]:
+    """Get the shards of the reports, among `report_ids`, which are not stored in the main database"""
+    result = await db_session.execute(
+        select(
+            models_reports.ReportShard.report_id, models_reports.ReportShard.shard
+        ).where(is_in_reports(models_reports.ReportShard.report_id, report_ids))
+    )
+    return {report_id: shard for report_id, shard in result.all()}
+
+
+async def set_report_shards(
+    db_session: AsyncSession, report_ids: Sequence[UUID], shard: str | None
+):
+    """Record the shard of reports in the directory, None for the main database"""
+    if shard is None:
+        await db_session.execute(
+            delete(models_reports.ReportShard).where(
+                is_in_reports(models_reports.ReportShard.report_id, report_ids)
+            )
+        )
+    else:
+        statement = postgresql_insert(models_reports.ReportShard).values(
+            [{"report_id": report_id, "shard": shard} for report_id in report_ids]
+        )
+        await db_session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[models_reports.ReportShard.report_id],
+                set_={"shard": statement.excluded.shard},
+            )
+        )
+    await db_session.commit()
+
+
+async def get_report_locations(
+    db_session: AsyncSession, after_id: UUID | None, limit: int
+) -> Sequence[RowMapping]:
+    """Get the `id` and coordinates of reports, ordered by id, to scan the table by batches"""
+    query = select(models_reports.Report.id, *report_coordinates())
+    if after_id is not None:
+        query = query.where(models_reports.Report.id > after_id)
+    result = await db_session.execute(
+        query.order_by(models_reports.Report.id).limit(limit)
+    )
+    return result.mappings().all()
+
+
+async def lock_reports_with_merges(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> list[UUID]:
+    """
+    Lock reports with the reports merged with them, until the end of the transaction, and return their ids.
+
+    A merge references two reports, which must be moved together.
+    """
+    merged_report_ids = await db_session.execute(
+        select(
+            models_reports.ReportMerge.report_id,
+            models_reports.ReportMerge.duplicate_report_id,
+        ).where(
+            or_(
+                is_in_reports(models_reports.ReportMerge.report_id, report_ids),
+                is_in_reports(
+                    models_reports.ReportMerge.duplicate_report_id, report_ids
+                ),
+            )
+        )
+    )
+    all_report_ids = set(report_ids)
+    for report_id, duplicate_report_id in merged_report_ids.all():
+        all_report_ids.add(report_id)
+        if duplicate_report_id is not None:
+            all_report_ids.add(duplicate_report_id)
+    result = await db_session.execute(
+        select(models_reports.Report.id)
+        .where(is_in_reports(models_reports.Report.id, list(all_report_ids)))
+        .with_for_update()
+    )
+    return list(result.scalars().all())
+
+
+async def get_report_rows(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> list[tuple[Table, list[dict[str, Any]]]]:
+    """Get the rows of reports and of everything attached to them, to copy them to another shard"""
+    rows = []
+    for table in REPORT_TABLES:
+        column = table.c.id if table.name == "reports" else table.c.report_id
+        result = await db_session.execute(
+            select(table).where(is_in_reports(column, report_ids))
+        )
+        rows.append((table, [dict(row) for row in result.mappings().all()]))
+    return rows
+
+
+async def insert_report_rows(
+    db_session: AsyncSession, rows: Sequence[tuple[Table, list[dict[str, Any]]]]
+):
+    """Insert rows read by `get_report_rows`. Rows which were already copied are skipped"""
+    for table, table_rows in rows:
+        # Generated columns are computed again by the database
+        computed_columns = {
+            column.name for column in table.columns if column.computed is not None
+        }
+        if table_rows:
+            await db_session.execute(
+                postgresql_insert(table).on_conflict_do_nothing(),
+                [
+                    {
+                        name: value
+                        for name, value in row.items()
+                        if name not in computed_columns
+                    }
+                    for row in table_rows
+                ],
+            )
+    await db_session.commit()
+
+
+async def delete_reports_with_rows(db_session: AsyncSession, report_ids: Sequence[UUID]):
+    """Delete reports which were copied to another shard, with everything attached to them"""
+    await db_session.execute(
+        delete(models_reports.ReportHistory).where(
+            is_in_reports(models_reports.ReportHistory.report_id, report_ids)
+        )
+    )
+    # Photos, merges and votes are deleted in cascade
+    await db_session.execute(
+        delete(models_reports.Report).where(
+            is_in_reports(models_reports.Report.id, report_ids)
+        )
+    )
+    await db_session.commit()
+
+
+# ========================================
+# REPORT ACTIVITY
+# ========================================
+
+
+async def get_report_cells(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> dict[UUID, int]:
+    """Get the ranking grid cells of the reports, among `report_ids`, with a single query"""
+    result = await db_session.execute(
+        select(models_reports.Report.id, models_reports.Report.cell).where(
+            is_in_reports(models_reports.Report.id, report_ids)
+        )
+    )
+    return {report_id: cell for report_id, cell in result.all()}
+
+
+async def add_report_activity(
+    db_session: AsyncSession,
+    bucket_start: datetime,
+    activity: Sequence[tuple[UUID, int, int]],
+):
+    """Add `(report_id, cell, count)` activity counts to a time bucket, with a single statement"""
+    statement = postgresql_insert(models_reports.ReportActivity).values(
+        [
+            {
+                "report_id": report_id,
+                "bucket_start": bucket_start,
+                "cell": cell,
+                "count": count,
+            }
+            for report_id, cell, count in activity
+        ]
+    )
+    await db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[
+                models_reports.ReportActivity.report_id,
+                models_reports.ReportActivity.bucket_start,
+            ],
+            set_={
+                "cell": statement.excluded.cell,
+                "count": models_reports.ReportActivity.count
+                + statement.excluded.count,
+            },
+        )
+    )
+    await db_session.commit()
+
+
+async def get_trending_report_activity(
+    db_session: AsyncSession,
+    window_start: datetime,
+    previous_window_start: datetime,
+    limit: int,
+    cells: Sequence[int] | None = None,
+) -> list[tuple[UUID, int]]:
+    """
+    Get the `limit` reports whose activity increased the most between the previous window and the last one,
+    with the increase. With `cells`, only the reports of these ranking grid cells are read,
+    from the `(cell, bucket_start)` index
+    """
+    is_last_window = models_reports.ReportActivity.bucket_start >= window_start
+    trend = func.sum(
+        case(
+            (is_last_window, models_reports.ReportActivity.count),
+            else_=-models_reports.ReportActivity.count,
+        )
+    )
+    query = select(models_reports.ReportActivity.report_id, trend.label("trend")).where(
+        models_reports.ReportActivity.bucket_start >= previous_window_start
+    )
+    if cells is not None:
+        query = query.where(
+            models_reports.ReportActivity.cell
+            == any_(literal(list(cells), ARRAY(BigInteger())))
+        )
+    result = await db_session.execute(
+        query.group_by(models_reports.ReportActivity.report_id)
+        .having(trend > 0)
+        .order_by(trend.desc())
+        .limit(limit)
+    )
+    return [(report_id, trend) for report_id, trend in result.all()]
+
+
+async def delete_report_activity(db_session: AsyncSession, before: datetime):
+    """Delete the activity buckets starting before `before`"""
     await db_session.execute(
-        delete(models_reports.Report).where(models_reports.Report.id == report_id),
+        delete(models_reports.ReportActivity).where(
+            models_reports.ReportActivity.bucket_start < before
+        )
     )
+    await db_session.commit()
@@ -1,131 +1,1047 @@
+import asyncio
+import base64
 import logging
 import uuid
-from datetime import UTC, datetime
+from collections import defaultdict
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
 from typing import Annotated, Sequence
 from uuid import UUID
 
+import shapely
+import shapely.errors
 import shapely.wkt
-from app.dependencies import get_db_session
+from app.dependencies import (
+    get_db_session,
+    get_optional_user,
+    get_report_db_session,
+    get_report_ids_by_shard,
+    get_report_shard,
+    get_settings,
+    is_user,
+    run_in_own_session,
+)
 from app.modules.reports import (cruds_reports, models_reports,
                                  schemas_reports, types_reports)
-from fastapi import APIRouter, Depends, HTTPException
+from app.modules.users import models_users
+from app.modules.users.types_users import AccountType
+from app.modules.votes import cruds_votes, schemas_votes
+from app.types import standard_responses
+from app.types.content_type import ContentType
+from app.utils import (
+    blob_store,
+    etags,
+    idempotency,
+    images,
+    report_cache,
+    report_stream,
+    sharding,
+    trending,
+    user_stats,
+)
+from app.utils.config import Settings
+from app.utils.singleflight import SingleFlight
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import StreamingResponse
 from geoalchemy2 import WKBElement, WKTElement
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
 points_cimes_error_logger = logging.getLogger("points-cimes.error")
 
+ACCEPTED_PHOTO_CONTENT_TYPES = (ContentType.jpg, ContentType.png, ContentType.webp)
 
-@router.patch("/{report_id}/status", status_code=204)
-async def change_report_status(
+reports_adapter = TypeAdapter(list[schemas_reports.Report])
+reports_in_location_flight: SingleFlight[bytes] = SingleFlight("reports_in_location")
+
+
+def parse_report_fields(fields: str | None) -> frozenset[str] | None:
+    """Parse a comma separated `fields` parameter, checking it against the allow-list"""
+    if fields is None:
+        return None
+    report_fields = frozenset(field.strip() for field in fields.split(","))
+    unknown_fields = report_fields - schemas_reports.REPORT_FIELDS
+    if unknown_fields or not report_fields:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid fields, allowed fields are {', '.join(sorted(schemas_reports.REPORT_FIELDS))}",
+        )
+    return report_fields
+
+
+ReportFields = Annotated[
+    str | None,
+    Query(
+        description="Comma separated fields of the reports to return, all by default",
+        examples=["id,report_type,latitude,longitude"],
+    ),
+]
+
+
+def get_photo_schema(
+    report_photo: models_reports.ReportPhoto,
+) -> schemas_reports.ReportPhoto:
+    return schemas_reports.ReportPhoto(
+        id=report_photo.id,
+        url=blob_store.get_blob_url(report_photo.photo_sha256),
+        thumbnail_url=blob_store.get_blob_url(report_photo.thumbnail_sha256),
+    )
+
+
+async def add_photos_to_reports(db_session: AsyncSession, reports: list[dict]) -> None:
+    """Add the photos urls to serialized reports, using a single query"""
+    photos = await cruds_reports.get_photos_by_report_ids(
+        db_session=db_session, report_ids=[report["id"] for report in reports]
+    )
+    photos_by_report_id = defaultdict(list)
+    for photo in photos:
+        photos_by_report_id[photo.report_id].append(get_photo_schema(photo))
+    for report in reports:
+        report["photos"] = photos_by_report_id[report["id"]]
+
+
+@router.get(
+    "/merges",
+    dependencies=[Depends(is_user(AccountType.moderator))],
+    response_model=Sequence[schemas_reports.ReportMerge],
+)
+async def get_report_merges(
     db_session: Annotated[AsyncSession, Depends(get_db_session)],
-    report_id: UUID,
-    new_status: types_reports.ReportStatus,
+    status: types_reports.MergeStatus | None = types_reports.MergeStatus.PENDING_REVIEW,
+    skip: int = 0,
+    limit: int = 100,
 ):
-    report = await cruds_reports.get_report_by_id(
-        db_session=db_session, report_id=report_id
+    """
+    List the submissions and reports which were merged as duplicates, so that moderators can review them.
+    """
+    if sharding.is_sharded():
+        # Each shard returns its first merges, the page is cut from their union
+        shards_data = await sharding.fan_out(
+            sharding.get_shard_names(),
+            cruds_reports.get_report_merges,
+            status=status,
+            limit=skip + limit,
+            skip=0,
+        )
+        data = sorted(
+            (merge_row for shard_data in shards_data for merge_row in shard_data),
+            key=lambda merge_row: merge_row["ReportMerge"].creation_time,
+        )[skip : skip + limit]
+    else:
+        data = await cruds_reports.get_report_merges(
+            db_session=db_session, status=status, limit=limit, skip=skip
+        )
+    return [
+        {
+            **merge_row["ReportMerge"].__dict__,
+            "latitude": merge_row["latitude"],
+            "longitude": merge_row["longitude"],
+        }
+        for merge_row in data
+    ]
+
+
+@router.patch(
+    "/merges/{merge_id}",
+    dependencies=[Depends(is_user(AccountType.moderator))],
+    status_code=204,
+)
+async def decide_report_merge(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    merge_id: UUID,
+    decision: schemas_reports.ReportMergeDecision,
+):
+    """
+    Confirm a merge, or revert it so that the duplicate becomes a report of its own again.
+    """
+    if decision.status == types_reports.MergeStatus.PENDING_REVIEW:
+        raise HTTPException(
+            status_code=400,
+            detail="A merge decision must confirm or revert the merge",
+        )
+    shard = sharding.DEFAULT_SHARD
+    if sharding.is_sharded():
+        # A merge is stored on the shard of its report
+        shard_names = sharding.get_shard_names()
+        shard_merges = await sharding.fan_out(
+            shard_names, cruds_reports.get_report_merge_by_id, merge_id=merge_id
+        )
+        shard = next(
+            (
+                shard_name
+                for shard_name, shard_merge in zip(shard_names, shard_merges)
+                if shard_merge is not None
+            ),
+            sharding.DEFAULT_SHARD,
+        )
+    if shard == sharding.DEFAULT_SHARD:
+        await _decide_report_merge(
+            db_session=db_session,
+            report_db_session=db_session,
+            shard=shard,
+            merge_id=merge_id,
+            decision=decision,
+        )
+        return
+    async with sharding.get_shard_session(shard) as report_db_session:
+        await _decide_report_merge(
+            db_session=db_session,
+            report_db_session=report_db_session,
+            shard=shard,
+            merge_id=merge_id,
+            decision=decision,
+        )
+
+
+async def _decide_report_merge(
+    db_session: AsyncSession,
+    report_db_session: AsyncSession,
+    shard: str,
+    merge_id: UUID,
+    decision: schemas_reports.ReportMergeDecision,
+) -> None:
+    report_merge = await cruds_reports.get_report_merge_by_id(
+        db_session=report_db_session, merge_id=merge_id
     )
-    if report is None:
+    if report_merge is None:
         raise HTTPException(
             status_code=404,
-            detail="Report not found",
+            detail="Merge not found",
+        )
+    if report_merge.status != types_reports.MergeStatus.PENDING_REVIEW:
+        raise HTTPException(
+            status_code=409,
+            detail="Merge was already decided",
+        )
+
+    restored_report = None
+    if (
+        decision.status == types_reports.MergeStatus.REVERTED
+        and report_merge.duplicate_report_id is None
+    ):
+        # The submission was never inserted, we create it now
+        report_row = await cruds_reports.get_report_by_id(
+            db_session=report_db_session, report_id=report_merge.report_id
+        )
+        if report_row is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Report not found",
+            )
+        restored_report = models_reports.Report(
+            id=uuid.uuid4(),
+            title=report_merge.title,
+            location=report_merge.location,
+            report_type=report_row["Report"].report_type,
+            description=report_merge.description,
+            creation_time=report_merge.creation_time,
+            status=types_reports.ReportStatus.ACTIVE,
+        )
+        if shard != sharding.DEFAULT_SHARD:
+            # The restored report stays with the report it duplicated
+            await cruds_reports.set_report_shards(
+                db_session=db_session, report_ids=[restored_report.id], shard=shard
+            )
+
+    await cruds_reports.update_report_merge_status(
+        db_session=report_db_session,
+        report_merge=report_merge,
+        new_status=decision.status,
+        decision_time=datetime.now(UTC),
+        restored_report=restored_report,
+    )
+    if decision.status == types_reports.MergeStatus.REVERTED:
+        # The merge location is the location of the restored duplicate
+        report_cache.invalidate_wkb_locations([report_merge.location])
+
+
+@router.post(
+    "/merges/deduplicate",
+    dependencies=[Depends(is_user(AccountType.admin))],
+    response_model=schemas_reports.DeduplicationResult,
+)
+async def deduplicate_reports(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+):
+    """
+    Merge existing duplicate reports into the oldest report they duplicate.
+
+    Duplicates are archived and their merges are listed for moderation. Reports are processed in batches,
+    shard by shard: duplicates stored on different shards are not detected.
+    """
+    merged_count = 0
+    for shard in sharding.get_shard_names():
+        if shard == sharding.DEFAULT_SHARD:
+            merged_count += await _deduplicate_shard_reports(
+                db_session=db_session, settings=settings
+            )
+            continue
+        async with sharding.get_shard_session(shard) as shard_db_session:
+            merged_count += await _deduplicate_shard_reports(
+                db_session=shard_db_session, settings=settings
+            )
+
+    points_cimes_error_logger.info(f"Deduplication: {merged_count} reports merged")
+    return schemas_reports.DeduplicationResult(merged_count=merged_count)
+
+
+async def _deduplicate_shard_reports(db_session: AsyncSession, settings: Settings) -> int:
+    merged_count = 0
+    while True:
+        duplicate_rows = await cruds_reports.get_duplicate_report_pairs(
+            db_session=db_session,
+            window=timedelta(hours=settings.REPORT_DUPLICATE_WINDOW_HOURS),
+            distance_meters=settings.REPORT_DUPLICATE_DISTANCE_METERS,
+            limit=settings.REPORT_DEDUPLICATION_BATCH_SIZE,
         )
+        if not duplicate_rows:
+            break
+
+        report_merges = [
+            models_reports.ReportMerge(
+                id=uuid.uuid4(),
+                report_id=duplicate_row["original_id"],
+                duplicate_report_id=duplicate_row["Report"].id,
+                title=duplicate_row["Report"].title,
+                description=duplicate_row["Report"].description,
+                location=duplicate_row["Report"].location,
+                creation_time=duplicate_row["Report"].creation_time,
+                distance=duplicate_row["distance"],
+                status=types_reports.MergeStatus.PENDING_REVIEW,
+            )
+            for duplicate_row in duplicate_rows
+        ]
+        await cruds_reports.merge_duplicate_reports(
+            db_session=db_session, report_merges=report_merges
+        )
+        report_cache.invalidate_wkb_locations(
+            report_merge.location for report_merge in report_merges
+        )
+        merged_count += len(report_merges)
+
+        if len(duplicate_rows) < settings.REPORT_DEDUPLICATION_BATCH_SIZE:
+            break
+    return merged_count
+
+
+@router.post(
+    "/shards/rebalance",
+    dependencies=[Depends(is_user(AccountType.admin))],
+    response_model=schemas_reports.ReshardResult,
+)
+async def rebalance_report_shards(
+    settings: Annotated[Settings, Depends(get_settings)],
+):
+    """
+    Move the reports which are not stored on the shard of their location, after the shard map was changed.
+
+    Reports are moved in batches, with everything attached to them. A report and the reports merged with it
+    are moved together, to the shard of the first one. The reports of a batch are locked on their former shard
+    until they are deleted from it, writes routed there in the meantime fail as if the reports did not exist.
+    """
+    moved_count = 0
+    for shard in sharding.get_shard_names():
+        moved_count += await _rebalance_shard(shard=shard, settings=settings)
+    points_cimes_error_logger.info(f"Resharding: {moved_count} reports moved")
+    return schemas_reports.ReshardResult(moved_count=moved_count)
+
+
+async def _rebalance_shard(shard: str, settings: Settings) -> int:
+    moved_count = 0
+    after_id = None
+    async with sharding.get_shard_session(shard) as db_session:
+        while True:
+            report_locations = await cruds_reports.get_report_locations(
+                db_session=db_session,
+                after_id=after_id,
+                limit=settings.REPORT_RESHARD_BATCH_SIZE,
+            )
+            await db_session.rollback()
+            if not report_locations:
+                break
+            after_id = report_locations[-1]["id"]
+
+            report_ids_by_target: dict[str, list[UUID]] = defaultdict(list)
+            for report_location in report_locations:
+                target = sharding.get_location_shard(
+                    report_location["longitude"], report_location["latitude"]
+                )
+                if target != shard:
+                    report_ids_by_target[target].append(report_location["id"])
+
+            for target, report_ids in report_ids_by_target.items():
+                locked_report_ids = await cruds_reports.lock_reports_with_merges(
+                    db_session=db_session, report_ids=report_ids
+                )
+                if not locked_report_ids:
+                    await db_session.rollback()
+                    continue
+                rows = await cruds_reports.get_report_rows(
+                    db_session=db_session, report_ids=locked_report_ids
+                )
+                await sharding.run_in_shard_session(
+                    target, cruds_reports.insert_report_rows, rows=rows
+                )
+                # The directory is updated in its own transaction, the reports stay locked until they are deleted
+                await sharding.run_in_shard_session(
+                    sharding.DEFAULT_SHARD,
+                    cruds_reports.set_report_shards,
+                    report_ids=locked_report_ids,
+                    shard=None if target == sharding.DEFAULT_SHARD else target,
+                )
+                await cruds_reports.delete_reports_with_rows(
+                    db_session=db_session, report_ids=locked_report_ids
+                )
+                moved_count += len(locked_report_ids)
+
+            if len(report_locations) < settings.REPORT_RESHARD_BATCH_SIZE:
+                break
+    return moved_count
+
+
+@router.patch(
+    "/status",
+    dependencies=[Depends(is_user(AccountType.moderator))],
+    response_model=standard_responses.BatchResult,
+)
+async def change_reports_status(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    status_update: schemas_reports.ReportStatusBulkUpdate,
+):
+    """
+    Change the status of several reports with a single query per shard.
+
+    Reports which do not exist are returned as failed.
+    """
+    report_ids_by_shard = await get_report_ids_by_shard(
+        db_session=db_session, report_ids=status_update.report_ids
+    )
+    updated_reports = []
+    for shard, report_ids in report_ids_by_shard.items():
+        if shard == sharding.DEFAULT_SHARD:
+            updated_reports += await cruds_reports.update_reports_status(
+                db_session=db_session,
+                report_ids=report_ids,
+                new_report_status=status_update.status,
+            )
+        else:
+            updated_reports += await sharding.run_in_shard_session(
+                shard,
+                cruds_reports.update_reports_status,
+                report_ids=report_ids,
+                new_report_status=status_update.status,
+            )
+    report_cache.invalidate_locations(
+        (updated_report["longitude"], updated_report["latitude"])
+        for updated_report in updated_reports
+    )
+    updated_report_ids = {updated_report["id"] for updated_report in updated_reports}
+    return standard_responses.BatchResult(
+        failed={
+            str(report_id): "Report not found"
+            for report_id in status_update.report_ids
+            if report_id not in updated_report_ids
+        },
+    )
 
-    await cruds_reports.update_report_status_by_id(
+
+@router.patch("/{report_id}/status", status_code=204)
+async def change_report_status(
+    db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
+    report_id: UUID,
+    new_status: types_reports.ReportStatus,
+):
+    updated_report = await cruds_reports.update_report_status_by_id(
         db_session=db_session,
         report_id=report_id,
         new_report_status=new_status,
     )
+    if updated_report is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Report not found",
+        )
+    report_cache.invalidate_locations(
+        [(updated_report["longitude"], updated_report["latitude"])]
+    )
 
 
 @router.patch("/{report_id}", status_code=204)
 async def edit_report(
-    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
     report_id: UUID,
     report_edit: schemas_reports.ReportEdit,
+    response: Response,
+    if_match: Annotated[str | None, Header()] = None,
 ):
-    report = await cruds_reports.get_report_by_id(
-        db_session=db_session, report_id=report_id
-    )
-    if report is None:
+    """
+    Edit a report.
+
+    The version the edit is based on must be sent, either in the body or as an `If-Match` header
+    containing the ETag of the report. If the report was changed since, a 409 is returned
+    and the client should fetch the report again before retrying.
+    """
+    version = report_edit.version
+    if version is None and if_match is not None:
+        version = etags.parse_version_etag(if_match)
+    if version is None:
         raise HTTPException(
-            status_code=404,
-            detail="Report not found",
+            status_code=428,
+            detail="The version of the edited report is required",
         )
+    if report_edit.location is not None:
+        try:
+            shapely.wkt.loads(report_edit.location)
+        except shapely.errors.ShapelyError:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid location",
+            )
 
-    await cruds_reports.update_report_by_id(
-        db_session=db_session, report_id=report_id, report_edit=report_edit
+    updated_report = await cruds_reports.update_report_by_id(
+        db_session=db_session,
+        report_id=report_id,
+        report_edit=report_edit,
+        version=version,
+        update_time=datetime.now(UTC),
+    )
+    if updated_report is None:
+        # Only failed edits need to know why they failed
+        current_version = await cruds_reports.get_report_version(
+            db_session=db_session, report_id=report_id
+        )
+        if current_version is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Report not found",
+            )
+        raise HTTPException(
+            status_code=409,
+            detail="The report was changed since this version",
+            headers={"ETag": etags.get_version_etag(current_version)},
+        )
+    report_cache.invalidate_locations(
+        [
+            (updated_report["previous_longitude"], updated_report["previous_latitude"]),
+            (updated_report["longitude"], updated_report["latitude"]),
+        ]
+    )
+    response.headers["ETag"] = etags.get_report_etag(
+        updated_report["version"],
+        updated_report["up_count"],
+        updated_report["down_count"],
     )
 
 
 @router.delete("/{report_id}", status_code=204)
 async def delete_report(
     db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    report_db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
     report_id: UUID,
 ):
-    report = await cruds_reports.get_report_by_id(
-        db_session=db_session, report_id=report_id
+    deleted_report = await cruds_reports.delete_report_by_id(
+        db_session=report_db_session,
+        report_id=report_id,
     )
-    if report is None:
+    if deleted_report is None:
         raise HTTPException(
             status_code=404,
             detail="Report not found",
         )
-
-    await cruds_reports.delete_report_by_id(
+    report_cache.invalidate_locations(
+        [(deleted_report["longitude"], deleted_report["latitude"])]
+    )
+    await user_stats.add_contribution(
         db_session=db_session,
-        report_id=report_id,
+        author_id=deleted_report["author_id"],
+        longitude=deleted_report["longitude"],
+        latitude=deleted_report["latitude"],
+        report_count_change=-1,
+        upvote_count_change=-deleted_report["up_count"],
     )
 
 
 @router.get("/", response_model=Sequence[schemas_reports.Report])
-async def get_reports_in_location(
-    db_session: Annotated[AsyncSession, Depends(get_db_session)], location_text: str
-):
-    location = WKTElement(location_text, srid=models_reports.SRID)
+async def get_reports_in_location(location_text: str, fields: ReportFields = None):
+    """
+    Get the open reports in a geometry, given as WKT, highest score first.
+
+    Only the columns of the requested `fields` are read and returned.
+    Results are cached until a report of the geometry is written. Votes do not invalidate them:
+    the scores of a cached result may be as old as the cache time to live.
+    Identical concurrent requests share a single database query, and its serialized result.
+    """
+    report_fields = parse_report_fields(fields)
+    try:
+        geometry = shapely.normalize(shapely.wkt.loads(location_text))
+    except shapely.errors.ShapelyError:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid location",
+        )
+    # Equivalent geometries written differently (vertices order, spacing...) share the same key
+    normalized_location_text = shapely.to_wkt(geometry, rounding_precision=-1)
+    key = (
+        normalized_location_text
+        if report_fields is None
+        else f"{normalized_location_text}|{','.join(sorted(report_fields))}"
+    )
+    content = report_cache.get_cached_listing(key)
+    if content is None:
+        content = await reports_in_location_flight.run(
+            key=key,
+            function=lambda: report_cache.fill_listing(
+                key=key,
+                geometry=geometry,
+                query=lambda: _get_serialized_reports_in_location(
+                    WKTElement(normalized_location_text, srid=models_reports.SRID),
+                    report_fields=report_fields,
+                ),
+            ),
+        )
+    return Response(content=content, media_type="application/json")
+
+
+async def _get_serialized_reports_in_location(
+    location: WKTElement, report_fields: frozenset[str] | None
+) -> bytes:
+    # The query is shared by several requests, it can not use the session of one of them.
+    # The shards covering the geometry are read concurrently
+    shards = sharding.get_geometry_shards(shapely.wkt.loads(location.data))
+    shards_data = await sharding.fan_out(
+        shards,
+        _get_reports_in_location,
+        location=location,
+        report_fields=report_fields,
+    )
+    data = [report for shard_data in shards_data for report in shard_data]
+    if len(shards_data) > 1:
+        data.sort(key=lambda report: report["score"], reverse=True)
+    if report_fields is not None:
+        adapter = schemas_reports.get_partial_reports_adapter(report_fields)
+        return adapter.dump_json(adapter.validate_python(data))
+    return reports_adapter.dump_json(reports_adapter.validate_python(data))
+
+
+async def _get_reports_in_location(
+    db_session: AsyncSession,
+    location: WKTElement,
+    report_fields: frozenset[str] | None,
+) -> list[dict]:
+    if report_fields is not None:
+        rows = await cruds_reports.get_report_fields_in_location(
+            db_session=db_session,
+            location=location,
+            columns=cruds_reports.get_report_field_columns(report_fields),
+        )
+        partial_reports = [dict(row) for row in rows]
+        if "photos" in report_fields:
+            await add_photos_to_reports(db_session=db_session, reports=partial_reports)
+        return partial_reports
+
     data = await cruds_reports.get_reports_in_location(
         db_session=db_session, location=location
     )
     data = [
         {
-            **report_row[
-                "Report"
-            ].__dict__,  # Unpack the attributes from the Report object
+            **report_row["Report"].__dict__,  # Unpack the attributes from the Report object
             "latitude": report_row["latitude"],
             "longitude": report_row["longitude"],
         }
         for report_row in data
     ]
+    await add_photos_to_reports(db_session=db_session, reports=data)
+    return data
+
 
+@router.get("/stream", response_class=StreamingResponse)
+async def stream_report_changes(
+    settings: Annotated[Settings, Depends(get_settings)],
+    min_longitude: Annotated[float, Query(ge=-180, le=180)],
+    min_latitude: Annotated[float, Query(ge=-90, le=90)],
+    max_longitude: Annotated[float, Query(ge=-180, le=180)],
+    max_latitude: Annotated[float, Query(ge=-90, le=90)],
+    report_types: Annotated[list[types_reports.ReportType] | None, Query()] = None,
+):
+    """
+    Receive the changes of reports in a bounding box as server-sent events, instead of polling `GET /reports/`.
+
+    `created`, `updated` and `deleted` events contain the id, type, status, version and location of the report,
+    and its previous location if it moved. A `resync` event is sent when changes may have been missed:
+    the client should then reload the reports of its viewport.
+    """
+    if min_longitude > max_longitude or min_latitude > max_latitude:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid bounding box",
+        )
+    # Changes are received through the cache bus
+    if not settings.CACHE_BUS_ENABLED:
+        raise HTTPException(
+            status_code=503,
+            detail="The report stream is not available",
+        )
+    if report_stream.is_full():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many clients are subscribed, please retry later",
+            headers={"Retry-After": "30"},
+        )
+    subscription = report_stream.Subscription(
+        min_longitude=min_longitude,
+        min_latitude=min_latitude,
+        max_longitude=max_longitude,
+        max_latitude=max_latitude,
+        report_types=(
+            frozenset(report_type.value for report_type in report_types)
+            if report_types
+            else None
+        ),
+    )
+    return StreamingResponse(
+        report_stream.stream_events(
+            subscription=subscription,
+            keepalive_seconds=settings.REPORT_STREAM_KEEPALIVE_SECONDS,
+        ),
+        media_type="text/event-stream",
+        # Proxies must not buffer the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/top", response_model=Sequence[schemas_reports.Report])
+async def get_top_reports(
+    settings: Annotated[Settings, Depends(get_settings)],
+    min_longitude: Annotated[float, Query(ge=-180, le=180)],
+    min_latitude: Annotated[float, Query(ge=-90, le=90)],
+    max_longitude: Annotated[float, Query(ge=-180, le=180)],
+    max_latitude: Annotated[float, Query(ge=-90, le=90)],
+    ranking: types_reports.ReportRanking = types_reports.ReportRanking.SCORE,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    """
+    Get the best open reports in a bounding box, by vote score or by `hot` rank, the score decayed with the age
+    of the report.
+
+    The time to answer does not depend on the number of reports in the box, but on its size.
+    """
+    if min_longitude > max_longitude or min_latitude > max_latitude:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid bounding box",
+        )
+    # Counted from the corner cells, so that large boxes are refused without listing their cells
+    if (
+        models_reports.count_rank_cells(
+            min_longitude, min_latitude, max_longitude, max_latitude
+        )
+        > settings.REPORT_TOP_MAX_CELLS
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="The bounding box is too large",
+        )
+    cells = models_reports.get_rank_cells(
+        min_longitude, min_latitude, max_longitude, max_latitude
+    )
+    geometry = shapely.box(min_longitude, min_latitude, max_longitude, max_latitude)
+    shards_data = await sharding.fan_out(
+        sharding.get_geometry_shards(geometry),
+        _get_top_reports,
+        cells=cells,
+        location=WKTElement(geometry.wkt, srid=models_reports.SRID),
+        ranking=ranking,
+        limit=limit,
+    )
+    data = [report for shard_data in shards_data for report in shard_data]
+    data.sort(key=lambda report: report[ranking.value], reverse=True)
+    return data[:limit]
+
+
+async def _get_top_reports(
+    db_session: AsyncSession,
+    cells: list[int],
+    location: WKTElement,
+    ranking: types_reports.ReportRanking,
+    limit: int,
+) -> list[dict]:
+    data = await cruds_reports.get_top_reports_in_box(
+        db_session=db_session,
+        cells=cells,
+        location=location,
+        ranking=ranking,
+        limit=limit,
+    )
+    data = [
+        {
+            **report_row["Report"].__dict__,  # Unpack the attributes from the Report object
+            "latitude": report_row["latitude"],
+            "longitude": report_row["longitude"],
+        }
+        for report_row in data
+    ]
+    await add_photos_to_reports(db_session=db_session, reports=data)
+    return data
+
+
+@router.get("/trending", response_model=Sequence[schemas_reports.Report])
+async def get_trending_reports(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    min_longitude: Annotated[float, Query(ge=-180, le=180)],
+    min_latitude: Annotated[float, Query(ge=-90, le=90)],
+    max_longitude: Annotated[float, Query(ge=-180, le=180)],
+    max_latitude: Annotated[float, Query(ge=-90, le=90)],
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    """
+    Get the open reports of a bounding box whose activity, votes and views, increased the most
+    between the previous window and the last one, most trending first.
+
+    Activity is counted in memory and synchronized between the workers every few seconds. The trends of boxes
+    of at most `REPORT_TOP_MAX_CELLS` ranking cells are read from the activity of their cells. Larger boxes only
+    get the reports of the box among the `TRENDING_TOP_SIZE` trending reports of all the regions.
+    """
+    if min_longitude > max_longitude or min_latitude > max_latitude:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid bounding box",
+        )
+    if (
+        models_reports.count_rank_cells(
+            min_longitude, min_latitude, max_longitude, max_latitude
+        )
+        <= settings.REPORT_TOP_MAX_CELLS
+    ):
+        trends = dict(
+            await trending.get_trending_in_cells(
+                db_session=db_session,
+                settings=settings,
+                cells=models_reports.get_rank_cells(
+                    min_longitude, min_latitude, max_longitude, max_latitude
+                ),
+            )
+        )
+    else:
+        trends = dict(trending.get_trending())
+    if not trends:
+        return []
+    geometry = shapely.box(min_longitude, min_latitude, max_longitude, max_latitude)
+    location = WKTElement(geometry.wkt, srid=models_reports.SRID)
+    report_ids_by_shard = await get_report_ids_by_shard(
+        db_session=db_session, report_ids=list(trends)
+    )
+    shards_data = await asyncio.gather(
+        *(
+            sharding.run_in_shard_session(
+                shard,
+                _get_trending_reports,
+                report_ids=report_ids,
+                location=location,
+            )
+            for shard, report_ids in report_ids_by_shard.items()
+        )
+    )
+    data = [report for shard_data in shards_data for report in shard_data]
+    data.sort(key=lambda report: trends[report["id"]], reverse=True)
+    return data[:limit]
+
+
+async def _get_trending_reports(
+    db_session: AsyncSession,
+    report_ids: list[UUID],
+    location: WKTElement,
+) -> list[dict]:
+    data = await cruds_reports.get_open_reports_by_ids_in_location(
+        db_session=db_session, report_ids=report_ids, location=location
+    )
+    data = [
+        {
+            **report_row["Report"].__dict__,  # Unpack the attributes from the Report object
+            "latitude": report_row["latitude"],
+            "longitude": report_row["longitude"],
+        }
+        for report_row in data
+    ]
+    await add_photos_to_reports(db_session=db_session, reports=data)
     return data
 
 
 @router.post("/", response_model=schemas_reports.Report)
 async def create_report(
     db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    user: Annotated[models_users.User | None, Depends(get_optional_user)],
     report_creation: schemas_reports.ReportCreation,
+    idempotency_key: idempotency.IdempotencyKey = None,
 ):
-    report_id = uuid.uuid4()
-    creation_time = datetime.now(UTC)
+    """
+    Create a report. The logged in user is recorded as its author, and credited on the leaderboards.
+
+    If an open report of the same type was recently created nearby, the submission is merged into it
+    and the existing report is returned instead.
+
+    Retries sent with the same `Idempotency-Key` header are answered with the first response.
+    The header is only accepted from logged in users, as keys are scoped to their user.
+    The report is stored on the shard of its location.
+    """
+    if idempotency_key is not None and user is None:
+        # Anonymous clients could not be told apart, and would be answered with the report of another client
+        raise HTTPException(
+            status_code=400,
+            detail="The Idempotency-Key header requires authentication",
+        )
+    return await idempotency.run_idempotent(
+        db_session=db_session,
+        settings=settings,
+        scope=f"create_report:{user.id}" if user is not None else "create_report",
+        key=idempotency_key,
+        request_hash=idempotency.hash_request(report_creation),
+        write=lambda: _create_report(
+            db_session=db_session,
+            settings=settings,
+            report_creation=report_creation,
+            author_id=user.id if user is not None else None,
+        ),
+        response_model=schemas_reports.Report,
+    )
+
+
+async def _create_report(
+    db_session: AsyncSession,
+    settings: Settings,
+    report_creation: schemas_reports.ReportCreation,
+    author_id: UUID | None,
+) -> dict:
     geometry_obj = shapely.wkt.loads(report_creation.location)
+    shard = sharding.get_location_shard(geometry_obj.x, geometry_obj.y)
+    if shard == sharding.DEFAULT_SHARD:
+        return await _create_shard_report(
+            db_session=db_session,
+            report_db_session=db_session,
+            shard=shard,
+            settings=settings,
+            report_creation=report_creation,
+            geometry_obj=geometry_obj,
+            author_id=author_id,
+        )
+    async with sharding.get_shard_session(shard) as report_db_session:
+        return await _create_shard_report(
+            db_session=db_session,
+            report_db_session=report_db_session,
+            shard=shard,
+            settings=settings,
+            report_creation=report_creation,
+            geometry_obj=geometry_obj,
+            author_id=author_id,
+        )
+
+
+async def _create_shard_report(
+    db_session: AsyncSession,
+    report_db_session: AsyncSession,
+    shard: str,
+    settings: Settings,
+    report_creation: schemas_reports.ReportCreation,
+    geometry_obj: shapely.Point,
+    author_id: UUID | None,
+) -> dict:
+    creation_time = datetime.now(UTC)
+    location = WKBElement(geometry_obj.wkb, srid=models_reports.SRID)
+
+    duplicate_row = await cruds_reports.get_duplicate_report(
+        db_session=report_db_session,
+        location=location,
+        report_type=report_creation.report_type,
+        created_after=creation_time
+        - timedelta(hours=settings.REPORT_DUPLICATE_WINDOW_HOURS),
+        distance_meters=settings.REPORT_DUPLICATE_DISTANCE_METERS,
+    )
+    if duplicate_row is not None:
+        report_merge = models_reports.ReportMerge(
+            id=uuid.uuid4(),
+            report_id=duplicate_row["Report"].id,
+            duplicate_report_id=None,
+            title=report_creation.title,
+            description=report_creation.description,
+            location=location,
+            creation_time=creation_time,
+            distance=duplicate_row["distance"],
+            status=types_reports.MergeStatus.PENDING_REVIEW,
+        )
+        await cruds_reports.create_report_merge(
+            db_session=report_db_session, report_merge=report_merge
+        )
+        return {
+            **duplicate_row["Report"].__dict__,
+            "latitude": duplicate_row["latitude"],
+            "longitude": duplicate_row["longitude"],
+        }
+
     report = models_reports.Report(
-        id=report_id,
+        id=uuid.uuid4(),
         title=report_creation.title,
-        location=WKBElement(geometry_obj.wkb, srid=models_reports.SRID),
+        location=location,
         report_type=report_creation.report_type,
         description=report_creation.description,
         creation_time=creation_time,
         status=types_reports.ReportStatus.ACTIVE,
+        author_id=author_id,
     )
-    await cruds_reports.create_report(db_session=db_session, new_report=report)
+    if shard != sharding.DEFAULT_SHARD:
+        # Recorded first, so that the report can never be stored on a shard without being found
+        await cruds_reports.set_report_shards(
+            db_session=db_session, report_ids=[report.id], shard=shard
+        )
+    await cruds_reports.create_report(db_session=report_db_session, new_report=report)
+    report_cache.invalidate_locations([(geometry_obj.x, geometry_obj.y)])
+    await user_stats.add_contribution(
+        db_session=db_session,
+        author_id=author_id,
+        longitude=geometry_obj.x,
+        latitude=geometry_obj.y,
+        report_count_change=1,
+    )
+    return {
+        **report.__dict__,
+        "latitude": geometry_obj.y,
+        "longitude": geometry_obj.x,
+    }
 
 
 @router.get("/{report_id}", response_model=schemas_reports.Report)
 async def get_report_by_id(
-    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
     report_id: UUID,
+    response: Response,
+    fields: ReportFields = None,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
+    """
+    Get a report. The version and the vote counters of the report are used as ETag:
+    votes change the counters without changing the version.
+
+    Only the columns of the requested `fields` are read and returned.
+    """
+    report_fields = parse_report_fields(fields)
+    if report_fields is not None:
+        return await _get_partial_report(
+            db_session=db_session,
+            report_id=report_id,
+            report_fields=report_fields,
+            if_none_match=if_none_match,
+        )
     report_row = await cruds_reports.get_report_by_id(
         db_session=db_session, report_id=report_id
     )
@@ -134,8 +1050,272 @@ async def get_report_by_id(
             status_code=404,
             detail="Report not found",
         )
-    return {
+    trending.record(report_id)
+    etag = etags.get_report_etag(
+        report_row["Report"].version,
+        report_row["Report"].up_count,
+        report_row["Report"].down_count,
+    )
+    if if_none_match is not None and etags.etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    report = {
         **report_row["Report"].__dict__,  # Unpack the attributes from the Report object
         "latitude": report_row["latitude"],
         "longitude": report_row["longitude"],
     }
+    await add_photos_to_reports(db_session=db_session, reports=[report])
+    return report
+
+
+async def _get_partial_report(
+    db_session: AsyncSession,
+    report_id: UUID,
+    report_fields: frozenset[str],
+    if_none_match: str | None,
+) -> Response:
+    report_row = await cruds_reports.get_report_fields_by_id(
+        db_session=db_session,
+        report_id=report_id,
+        columns=cruds_reports.get_report_field_columns(report_fields),
+    )
+    if report_row is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Report not found",
+        )
+    trending.record(report_id)
+    etag = etags.get_report_etag(
+        report_row["version"], report_row["up_count"], report_row["down_count"]
+    )
+    if if_none_match is not None and etags.etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    report = dict(report_row)
+    if "photos" in report_fields:
+        await add_photos_to_reports(db_session=db_session, reports=[report])
+    partial_report = schemas_reports.get_partial_report_model(report_fields)
+    return Response(
+        content=partial_report.model_validate(report).model_dump_json(),
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
+
+
+@router.get("/{report_id}/details", response_model=schemas_reports.ReportDetails)
+async def get_report_details(
+    report_id: UUID,
+    user: Annotated[models_users.User | None, Depends(get_optional_user)],
+):
+    """
+    Get a report with its vote tally and the vote of the user, in a single request.
+
+    The reads are independent, they run concurrently on separate connections to the shard of the report.
+    The tally is read from the vote counters of the report.
+    """
+    shard = await run_in_own_session(get_report_shard, report_id=report_id)
+    reads = [
+        sharding.run_in_shard_session(
+            shard, cruds_reports.get_report_by_id, report_id=report_id
+        ),
+        sharding.run_in_shard_session(
+            shard, cruds_reports.get_photos_by_report_ids, report_ids=[report_id]
+        ),
+    ]
+    if user is not None:
+        reads.append(
+            sharding.run_in_shard_session(
+                shard,
+                cruds_votes.get_vote_by_report_and_user_id,
+                user_id=user.id,
+                report_id=report_id,
+            )
+        )
+    report_row, photos, *my_vote = await asyncio.gather(*reads)
+    if report_row is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Report not found",
+        )
+    trending.record(report_id)
+    report = {
+        **report_row["Report"].__dict__,  # Unpack the attributes from the Report object
+        "latitude": report_row["latitude"],
+        "longitude": report_row["longitude"],
+        "photos": [get_photo_schema(photo) for photo in photos],
+    }
+    return schemas_reports.ReportDetails(
+        report=schemas_reports.Report.model_validate(report),
+        votes=schemas_votes.VoteTally.model_validate(report_row["Report"]),
+        my_vote=my_vote[0].vote_value if my_vote and my_vote[0] else None,
+    )
+
+
+def encode_history_cursor(entry: models_reports.ReportHistory) -> str:
+    return base64.urlsafe_b64encode(
+        f"{entry.creation_time.isoformat()}|{entry.id}".encode()
+    ).decode()
+
+
+def decode_history_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        creation_time, entry_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        )
+        return datetime.fromisoformat(creation_time), UUID(entry_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid cursor",
+        )
+
+
+@router.get(
+    "/{report_id}/history",
+    dependencies=[Depends(is_user(AccountType.moderator))],
+    response_model=schemas_reports.ReportHistoryPage,
+)
+async def get_report_history(
+    db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
+    report_id: UUID,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+):
+    """
+    Get the history of a report, most recent first: its creation, edits and status changes.
+
+    Pass the `next_cursor` of a page as `cursor` to get the next one.
+    The history of deleted reports is kept until its retention expires.
+    """
+    entries = await cruds_reports.get_report_history(
+        db_session=db_session,
+        report_id=report_id,
+        limit=limit,
+        before=decode_history_cursor(cursor) if cursor is not None else None,
+    )
+    return schemas_reports.ReportHistoryPage(
+        entries=[
+            schemas_reports.ReportHistoryEntry.model_validate(entry)
+            for entry in entries
+        ],
+        next_cursor=encode_history_cursor(entries[-1])
+        if len(entries) == limit
+        else None,
+    )
+
+
+@router.post(
+    "/{report_id}/photos",
+    response_model=schemas_reports.ReportPhoto,
+    status_code=201,
+    # The body is received by the endpoint, it is described here for the documentation
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "photo": {"type": "string", "format": "binary"}
+                        },
+                        "required": ["photo"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def upload_report_photo(
+    db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    report_id: UUID,
+    request: Request,
+):
+    """
+    Attach a photo, the `photo` file of a multipart body, to a report.
+
+    The upload is copied to disk chunk by chunk, then the photo is resized and its thumbnail generated
+    in the image processing pool. Requests are refused before their body is received if the pool is saturated (503),
+    if the declared size is too large (413) or if the photo could not be attached to the report anyway.
+    """
+    if images.is_image_pool_saturated():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many photos are being processed, please retry later",
+            headers={"Retry-After": "5"},
+        )
+    report_version = await cruds_reports.get_report_version(
+        db_session=db_session, report_id=report_id
+    )
+    if report_version is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Report not found",
+        )
+    photos_count = await cruds_reports.count_report_photos(
+        db_session=db_session, report_id=report_id
+    )
+    if photos_count >= settings.REPORT_PHOTO_MAX_COUNT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A report can not have more than {settings.REPORT_PHOTO_MAX_COUNT} photos",
+        )
+
+    max_size = settings.REPORT_PHOTO_MAX_SIZE_MB * 1024 * 1024
+    photo = await images.receive_upload_file(
+        request=request, field="photo", max_size=max_size
+    )
+    blob_store_root = Path(settings.BLOB_STORE_DIRECTORY)
+    photo_id = uuid.uuid4()
+    upload_path = blob_store.get_temporary_path(blob_store_root, f"{photo_id}.upload")
+    photo_path = blob_store.get_temporary_path(blob_store_root, f"{photo_id}.jpg")
+    thumbnail_path = blob_store.get_temporary_path(
+        blob_store_root, f"{photo_id}_thumbnail.jpg"
+    )
+    try:
+        if photo.content_type not in ACCEPTED_PHOTO_CONTENT_TYPES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file format, supported {[content_type.value for content_type in ACCEPTED_PHOTO_CONTENT_TYPES]}",
+            )
+        await images.save_upload_file(
+            upload_file=photo,
+            destination=upload_path,
+            max_size=max_size,
+        )
+    finally:
+        await photo.close()
+    try:
+        photo_sha256, thumbnail_sha256 = await images.create_photo_and_thumbnail(
+            source=upload_path,
+            photo_destination=photo_path,
+            thumbnail_destination=thumbnail_path,
+            settings=settings,
+        )
+    finally:
+        upload_path.unlink(missing_ok=True)
+
+    photo_size = photo_path.stat().st_size
+    await blob_store.add_blob(
+        root=blob_store_root, source=photo_path, sha256=photo_sha256
+    )
+    await blob_store.add_blob(
+        root=blob_store_root, source=thumbnail_path, sha256=thumbnail_sha256
+    )
+
+    report_photo = models_reports.ReportPhoto(
+        id=photo_id,
+        report_id=report_id,
+        photo_sha256=photo_sha256,
+        thumbnail_sha256=thumbnail_sha256,
+        size=photo_size,
+        creation_time=datetime.now(UTC),
+    )
+    updated_report = await cruds_reports.create_report_photo(
+        db_session=db_session, report_photo=report_photo
+    )
+    if updated_report is not None:
+        report_cache.invalidate_locations(
+            [(updated_report["longitude"], updated_report["latitude"])]
+        )
+    return get_photo_schema(report_photo)
@@ -1,26 +1,149 @@
+import math
 from datetime import datetime
+from typing import Any
+from uuid import UUID
 
-from app.modules.reports.types_reports import ReportStatus, ReportType
+from app.modules.reports.types_reports import (
+    MergeStatus,
+    ReportHistoryAction,
+    ReportStatus,
+    ReportType,
+)
 from app.types.sqlalchemy import Base, PrimaryKey
 from geoalchemy2 import Geometry, WKBElement
 from geoalchemy2.shape import to_shape
+from sqlalchemy import BigInteger, Computed, Double, ForeignKey, Index, String, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column
 
 SRID = 4326
 
+# Reports are ranked by cells of a grid of RANK_CELL_DEGREES, numbered row by row from (-180, -90)
+RANK_CELL_DEGREES = 0.1
+RANK_GRID_ROWS = math.floor(180 / RANK_CELL_DEGREES) + 1
+RANK_CELL_EXPRESSION = (
+    f"(floor(ST_X(location) / {RANK_CELL_DEGREES}) + {math.floor(180 / RANK_CELL_DEGREES)}) * {RANK_GRID_ROWS}"
+    f" + floor(ST_Y(location) / {RANK_CELL_DEGREES}) + {math.floor(90 / RANK_CELL_DEGREES)}"
+)
+# The score decays with the age of the report: a report must have 10 times the score of a report
+# 12.5 hours younger to be ranked above it. Unlike a decay computed from the current time,
+# the order of the reports only changes with their votes, so that it can be indexed
+HOT_RANK_EXPRESSION = (
+    "sign(score) * log(greatest(abs(score), 1)) + extract(epoch from creation_time) / 45000"
+)
+
+
+def get_rank_cell(longitude: float, latitude: float) -> int:
+    """The ranking grid cell of a location, as computed by the `cell` column"""
+    return (
+        math.floor(longitude / RANK_CELL_DEGREES) + math.floor(180 / RANK_CELL_DEGREES)
+    ) * RANK_GRID_ROWS + (
+        math.floor(latitude / RANK_CELL_DEGREES) + math.floor(90 / RANK_CELL_DEGREES)
+    )
+
+
+def get_rank_cell_bounds(
+    min_longitude: float, min_latitude: float, max_longitude: float, max_latitude: float
+) -> tuple[int, int, int, int]:
+    """The `(min_column, min_row, max_column, max_row)` of the ranking grid cells covering a bounding box"""
+    min_column, min_row = divmod(
+        get_rank_cell(min_longitude, min_latitude), RANK_GRID_ROWS
+    )
+    max_column, max_row = divmod(
+        get_rank_cell(max_longitude, max_latitude), RANK_GRID_ROWS
+    )
+    return min_column, min_row, max_column, max_row
+
+
+def count_rank_cells(
+    min_longitude: float, min_latitude: float, max_longitude: float, max_latitude: float
+) -> int:
+    """The number of ranking grid cells covering a bounding box, without listing them"""
+    min_column, min_row, max_column, max_row = get_rank_cell_bounds(
+        min_longitude, min_latitude, max_longitude, max_latitude
+    )
+    return (max_column - min_column + 1) * (max_row - min_row + 1)
+
+
+def get_rank_cells(
+    min_longitude: float, min_latitude: float, max_longitude: float, max_latitude: float
+) -> list[int]:
+    """The ranking grid cells covering a bounding box"""
+    min_column, min_row, max_column, max_row = get_rank_cell_bounds(
+        min_longitude, min_latitude, max_longitude, max_latitude
+    )
+    return [
+        column * RANK_GRID_ROWS + row
+        for column in range(min_column, max_column + 1)
+        for row in range(min_row, max_row + 1)
+    ]
+
 
 class Report(Base):
     __tablename__ = "reports"
+    __table_args__ = (
+        # Map queries only display open reports. Indexing only them keeps the spatial index small
+        # while resolved, archived and rejected reports pile up in the table
+        Index(
+            "ix_reports_location_open",
+            "location",
+            postgresql_using="gist",
+            postgresql_where=text("status IN ('ACTIVE', 'PENDING_REVIEW')"),
+        ),
+        # The moderation queue only reads pending reports, which are a small fraction of the table
+        Index(
+            "ix_reports_pending_review",
+            "creation_time",
+            postgresql_where=text("status = 'PENDING_REVIEW'"),
+        ),
+        # The best reports of a viewport are read from the top of each of its cells
+        Index(
+            "ix_reports_cell_score_open",
+            "cell",
+            "score",
+            postgresql_where=text("status IN ('ACTIVE', 'PENDING_REVIEW')"),
+        ),
+        Index(
+            "ix_reports_cell_hot_open",
+            "cell",
+            "hot",
+            postgresql_where=text("status IN ('ACTIVE', 'PENDING_REVIEW')"),
+        ),
+    )
 
     id: Mapped[PrimaryKey]
     title: Mapped[str] = mapped_column(nullable=False)
     creation_time: Mapped[datetime]
     location: Mapped[WKBElement] = mapped_column(
-        Geometry(geometry_type="POINT", srid=SRID), nullable=False
+        Geometry(geometry_type="POINT", srid=SRID, spatial_index=False),
+        nullable=False,
     )
     report_type: Mapped[ReportType]
     status: Mapped[ReportStatus]
     description: Mapped[str]
+    # A moderator claims pending reports from the moderation queue until `claim_expire_on`
+    claimed_by_id: Mapped[UUID | None] = mapped_column(
+        ForeignKey("user.id", ondelete="SET NULL"), default=None
+    )
+    claim_expire_on: Mapped[datetime | None] = mapped_column(default=None)
+    # Reports created without being logged in have no author
+    author_id: Mapped[UUID | None] = mapped_column(
+        ForeignKey("user.id", ondelete="SET NULL"), default=None, index=True
+    )
+    # Incremented by every change of the report, edits are only applied if the client saw the current version
+    version: Mapped[int] = mapped_column(default=1)
+    last_updated_time: Mapped[datetime | None] = mapped_column(default=None)
+    # Counts of the votes on the report, updated by the statements writing votes
+    up_count: Mapped[int] = mapped_column(default=0)
+    down_count: Mapped[int] = mapped_column(default=0)
+    score: Mapped[int] = mapped_column(default=0)
+    # Computed by the database
+    cell: Mapped[int] = mapped_column(
+        BigInteger, Computed(RANK_CELL_EXPRESSION), init=False
+    )
+    hot: Mapped[float] = mapped_column(
+        Double, Computed(HOT_RANK_EXPRESSION), init=False
+    )
 
     def __repr__(self) -> str:
         """String representation for debugging."""
@@ -36,3 +159,109 @@ class Report(Base):
             # When retrieved from DB, self.location will be a WKBElement
             return to_shape(self.location)
         return None
+
+
+class ReportMerge(Base):
+    """
+    A report which was detected as a duplicate of an existing report.
+
+    When a submission is merged on creation, no report is inserted and `duplicate_report_id` is None:
+    the submitted content is only kept here so that a moderator can revert the merge.
+    When an existing report is merged by the deduplication job, `duplicate_report_id` references the archived report.
+    """
+
+    __tablename__ = "report_merge"
+
+    id: Mapped[PrimaryKey]
+    report_id: Mapped[UUID] = mapped_column(
+        ForeignKey("reports.id", ondelete="CASCADE"), index=True
+    )
+    duplicate_report_id: Mapped[UUID | None] = mapped_column(
+        ForeignKey("reports.id", ondelete="CASCADE")
+    )
+    title: Mapped[str]
+    description: Mapped[str]
+    location: Mapped[WKBElement] = mapped_column(
+        Geometry(geometry_type="POINT", srid=SRID, spatial_index=False),
+        nullable=False,
+    )
+    creation_time: Mapped[datetime]
+    distance: Mapped[float]
+    status: Mapped[MergeStatus] = mapped_column(index=True)
+    decision_time: Mapped[datetime | None] = mapped_column(default=None)
+
+
+class ReportPhoto(Base):
+    """
+    A photo attached to a report. The resized photo and its thumbnail are JPEG files stored in the blob store,
+    and referenced by the SHA-256 of their content.
+    """
+
+    __tablename__ = "report_photo"
+
+    id: Mapped[PrimaryKey]
+    report_id: Mapped[UUID] = mapped_column(
+        ForeignKey("reports.id", ondelete="CASCADE"), index=True
+    )
+    photo_sha256: Mapped[str] = mapped_column(String(64), index=True)
+    thumbnail_sha256: Mapped[str] = mapped_column(String(64), index=True)
+    size: Mapped[int]
+    creation_time: Mapped[datetime]
+
+
+class ReportHistory(Base):
+    """
+    An entry of the append-only history of a report: its creation, edits and status changes.
+
+    The table is partitioned by month on `creation_time`, so that old entries are removed by dropping
+    a whole partition instead of with a DELETE. Partitions are created ahead by `app.utils.report_history`.
+    There is no foreign key to `reports`: the history of a deleted report is kept.
+    """
+
+    __tablename__ = "report_history"
+    __table_args__ = (
+        Index("ix_report_history_report_id", "report_id", "creation_time", "id"),
+        {"postgresql_partition_by": "RANGE (creation_time)"},
+    )
+
+    # The partition key must be part of the primary key
+    id: Mapped[UUID] = mapped_column(primary_key=True)
+    creation_time: Mapped[datetime] = mapped_column(primary_key=True)
+    report_id: Mapped[UUID]
+    action: Mapped[ReportHistoryAction]
+    # The version of the report after the change
+    version: Mapped[int | None]
+    # Only the changed fields, with their new value
+    changes: Mapped[dict[str, Any]] = mapped_column(JSONB)
+    user_id: Mapped[UUID | None] = mapped_column(default=None)
+
+
+class ReportShard(Base):
+    """
+    The directory of the reports stored on a shard other than the main database, see `app.utils.sharding`.
+
+    It is only stored in the main database. Reports which are not listed are stored in the main database.
+    """
+
+    __tablename__ = "report_shard"
+
+    report_id: Mapped[UUID] = mapped_column(primary_key=True)
+    shard: Mapped[str]
+
+
+class ReportActivity(Base):
+    """
+    The activity (votes and views) of a report during a time bucket, summed over all the workers, see `app.utils.trending`.
+
+    Only the most active reports of each worker are recorded, and buckets older than two windows are deleted.
+    The ranking grid cell of the report is copied, so that the trending reports of a viewport are read from its cells.
+    It is only stored in the main database.
+    """
+
+    __tablename__ = "report_activity"
+    __table_args__ = (Index("ix_report_activity_cell_bucket_start", "cell", "bucket_start"),)
+
+    report_id: Mapped[UUID] = mapped_column(primary_key=True)
+    bucket_start: Mapped[datetime] = mapped_column(primary_key=True, index=True)
+    cell: Mapped[int] = mapped_column(BigInteger)
+    count: Mapped[int]
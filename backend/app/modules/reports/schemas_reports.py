@@ -1,11 +1,19 @@
 from datetime import datetime
-from typing import Any, Dict
+from functools import lru_cache
+from typing import Any
 from uuid import UUID
 
-from app.modules.reports.types_reports import ReportType
+from app.modules.reports.types_reports import (
+    MergeStatus,
+    ReportHistoryAction,
+    ReportStatus,
+    ReportType,
+)
+from app.modules.votes.schemas_votes import VoteTally
+from app.modules.votes.types_votes import VoteValue
 from geoalchemy2 import WKBElement
 from geoalchemy2.types import Geometry
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, create_model
 
 
 class ReportSimple(BaseModel):
@@ -22,10 +30,52 @@ class Location(BaseModel):
     text: str
 
 
+class ReportPhoto(BaseModel):
+    id: UUID
+    url: str
+    thumbnail_url: str
+
+
 class Report(ReportSimple):
     description: str
     creation_time: datetime
-    # last_updated_time: datetime | None
+    photos: list[ReportPhoto] = []
+    version: int
+    last_updated_time: datetime | None = None
+    up_count: int = 0
+    down_count: int = 0
+    score: int = 0
+
+
+# Fields which can be requested with the `fields` parameter of the report read endpoints
+REPORT_FIELDS = frozenset(Report.model_fields)
+
+
+@lru_cache(maxsize=1024)
+def get_partial_report_model(fields: frozenset[str]) -> type[BaseModel]:
+    """A model of reports restricted to `fields`, built once per set of fields"""
+    return create_model(
+        "PartialReport",
+        **{
+            field: (field_info.annotation, field_info)
+            for field, field_info in Report.model_fields.items()
+            if field in fields
+        },
+    )
+
+
+@lru_cache(maxsize=1024)
+def get_partial_reports_adapter(fields: frozenset[str]) -> TypeAdapter[list[Any]]:
+    return TypeAdapter(list[get_partial_report_model(fields)])  # type: ignore[misc]
+
+
+class ReportDetails(BaseModel):
+    """Everything displayed when a report is opened, returned by a single request"""
+
+    report: Report
+    votes: VoteTally
+    # None for anonymous requests, or if the user did not vote
+    my_vote: VoteValue | None = None
 
 
 class ReportCreation(BaseModel):
@@ -35,9 +85,61 @@ class ReportCreation(BaseModel):
     description: str
 
 
+class ReportStatusBulkUpdate(BaseModel):
+    report_ids: list[UUID] = Field(min_length=1, max_length=1000)
+    status: ReportStatus
+
+
 class ReportEdit(BaseModel):
-    title: str | None
-    report_type: ReportType | None
-    location: Dict[str, Any] | None
-    description: str | None
-    last_updated_time: datetime
+    title: str | None = None
+    report_type: ReportType | None = None
+    location: str | None = None
+    description: str | None = None
+    # The version the edit is based on, it can also be sent as an `If-Match` header
+    version: int | None = None
+
+
+class ReportMerge(BaseModel):
+    id: UUID
+    report_id: UUID
+    duplicate_report_id: UUID | None
+    title: str
+    description: str
+    latitude: float
+    longitude: float
+    creation_time: datetime
+    distance: float
+    status: MergeStatus
+    decision_time: datetime | None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ReportMergeDecision(BaseModel):
+    status: MergeStatus
+
+
+class DeduplicationResult(BaseModel):
+    merged_count: int
+
+
+class ReshardResult(BaseModel):
+    moved_count: int
+
+
+class ReportHistoryEntry(BaseModel):
+    id: UUID
+    report_id: UUID
+    creation_time: datetime
+    action: ReportHistoryAction
+    version: int | None
+    changes: dict[str, Any]
+    user_id: UUID | None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ReportHistoryPage(BaseModel):
+    entries: list[ReportHistoryEntry]
+    # Pass it as `cursor` to get the next, older, entries. None on the last page
+    next_cursor: str | None
@@ -13,3 +13,34 @@ class ReportStatus(str, Enum):
     RESOLVED = "resolved"
     ARCHIVED = "archived"
     REJECTED = "rejected"
+
+
+class MergeStatus(str, Enum):
+    PENDING_REVIEW = "pending_review"
+    CONFIRMED = "confirmed"
+    REVERTED = "reverted"
+
+
+class ReportHistoryAction(str, Enum):
+    CREATION = "creation"
+    EDIT = "edit"
+    STATUS_CHANGE = "status_change"
+    EXPIRATION = "expiration"
+    MERGE = "merge"
+    MERGE_REVERT = "merge_revert"
+    MODERATION = "moderation"
+    PHOTO_ADDITION = "photo_addition"
+    DELETION = "deletion"
+
+
+class ReportRanking(str, Enum):
+    # By vote score
+    SCORE = "score"
+    # By vote score, decayed with the age of the report
+    HOT = "hot"
+
+
+class ReportChangeAction(str, Enum):
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
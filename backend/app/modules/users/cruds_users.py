@@ -1,13 +1,22 @@
-from collections.abc import Sequence
+from collections.abc import Mapping, Sequence
 from uuid import UUID
 
 from app.modules.users import models_users, schemas_users
-from app.modules.users.types_users import AccountType
-from sqlalchemy import and_, delete, not_, or_, select, update
+from app.modules.users.types_users import AccountType, LeaderboardRanking
+from app.utils import cache_bus
+from sqlalchemy import RowMapping, and_, delete, not_, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
+async def publish_user_invalidation(db_session: AsyncSession, user_id: UUID):
+    """Evict the user from the caches of all workers, once the transaction is committed"""
+    await cache_bus.publish(
+        db_session=db_session, event_type="users", items=[str(user_id)]
+    )
+
+
 async def count_users(db_session: AsyncSession) -> int:
     """Return the number of users in the database"""
 
@@ -98,13 +107,26 @@ async def update_user(
     db_session: AsyncSession,
     user_id: UUID,
     user_update: schemas_users.UserUpdateAdmin | schemas_users.UserUpdate,
-):
-    await db_session.execute(
-        update(models_users.User)
-        .where(models_users.User.id == user_id)
-        .values(**user_update.model_dump(exclude_none=True)),
-    )
-    await db_session.commit()
+) -> models_users.User | None:
+    """
+    Update a user and return it, or None if it does not exist.
+
+    An IntegrityError is raised if the new email is already used.
+    """
+    try:
+        result = await db_session.execute(
+            update(models_users.User)
+            .where(models_users.User.id == user_id)
+            .values(**user_update.model_dump(exclude_none=True))
+            .returning(models_users.User),
+        )
+        user = result.scalars().first()
+        await publish_user_invalidation(db_session=db_session, user_id=user_id)
+        await db_session.commit()
+    except IntegrityError:
+        await db_session.rollback()
+        raise
+    return user
 
 
 async def create_unconfirmed_user(
@@ -160,13 +182,18 @@ async def create_user(
         return user
 
 
-async def delete_user_by_id(db_session: AsyncSession, user_id: UUID):
-    """Delete a user from database by id"""
+async def delete_user_by_id(db_session: AsyncSession, user_id: UUID) -> bool:
+    """Delete a user from database by id, return False if it does not exist"""
 
-    await db_session.execute(
-        delete(models_users.User).where(models_users.User.id == user_id),
+    result = await db_session.execute(
+        delete(models_users.User)
+        .where(models_users.User.id == user_id)
+        .returning(models_users.User.id),
     )
+    deleted = result.scalar() is not None
+    await publish_user_invalidation(db_session=db_session, user_id=user_id)
     await db_session.commit()
+    return deleted
 
 
 async def create_user_recover_request(
@@ -216,4 +243,147 @@ async def update_user_password_by_id(
         .where(models_users.User.id == user_id)
         .values(password_hash=new_password_hash),
     )
+    await publish_user_invalidation(db_session=db_session, user_id=user_id)
+    await db_session.commit()
+
+
+async def get_user_ids(
+    db_session: AsyncSession, after_id: UUID | None, limit: int
+) -> Sequence[UUID]:
+    """Get the ids of the next `limit` users, ordered by id"""
+    query = select(models_users.User.id)
+    if after_id is not None:
+        query = query.where(models_users.User.id > after_id)
+    result = await db_session.execute(
+        query.order_by(models_users.User.id).limit(limit)
+    )
+    return result.scalars().all()
+
+
+async def add_user_stats_changes(
+    db_session: AsyncSession, changes: Sequence[tuple[UUID, str, int, int]]
+):
+    """
+    Apply `(user_id, region, report_count_change, upvote_count_change)` changes to the stats of users,
+    in a single statement. Rows are created as needed
+    """
+    statement = postgresql_insert(models_users.UserStats).values(
+        [
+            {
+                "user_id": user_id,
+                "region": region,
+                "report_count": report_count_change,
+                "upvote_count": upvote_count_change,
+            }
+            # Rows are locked in the same order by all the writers
+            for user_id, region, report_count_change, upvote_count_change in sorted(
+                changes
+            )
+        ]
+    )
+    await db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[
+                models_users.UserStats.user_id,
+                models_users.UserStats.region,
+            ],
+            set_={
+                "report_count": models_users.UserStats.report_count
+                + statement.excluded.report_count,
+                "upvote_count": models_users.UserStats.upvote_count
+                + statement.excluded.upvote_count,
+            },
+        )
+    )
+    await db_session.commit()
+
+
+async def get_leaderboard(
+    db_session: AsyncSession,
+    region: str,
+    ranking: LeaderboardRanking,
+    after: tuple[int, UUID] | None,
+    limit: int,
+) -> Sequence[RowMapping]:
+    """
+    Get the `limit` best users of a region, after the `(count, user_id)` of the last user of the previous page.
+
+    Users with the same count are ordered by id, the page is read from the `(region, count, user_id)` index.
+    """
+    count = (
+        models_users.UserStats.report_count
+        if ranking == LeaderboardRanking.REPORTS
+        else models_users.UserStats.upvote_count
+    )
+    query = (
+        select(
+            models_users.UserStats.user_id,
+            models_users.User.name,
+            models_users.UserStats.report_count,
+            models_users.UserStats.upvote_count,
+        )
+        .join(models_users.User, models_users.User.id == models_users.UserStats.user_id)
+        .where(models_users.UserStats.region == region, count > 0)
+    )
+    if after is not None:
+        query = query.where(tuple_(count, models_users.UserStats.user_id) < after)
+    result = await db_session.execute(
+        query.order_by(count.desc(), models_users.UserStats.user_id.desc()).limit(limit)
+    )
+    return result.mappings().all()
+
+
+async def replace_user_stats(
+    db_session: AsyncSession,
+    user_ids: Sequence[UUID],
+    stats: Mapping[tuple[UUID, str], tuple[int, int]],
+) -> int:
+    """
+    Replace the stats of users by `stats`, `(user_id, region) -> (report_count, upvote_count)`.
+    Return the number of rows which changed
+    """
+    result = await db_session.execute(
+        select(
+            models_users.UserStats.user_id,
+            models_users.UserStats.region,
+            models_users.UserStats.report_count,
+            models_users.UserStats.upvote_count,
+        )
+        .where(models_users.UserStats.user_id.in_(user_ids))
+        .with_for_update()
+    )
+    previous_stats = {
+        (user_id, region): (report_count, upvote_count)
+        for user_id, region, report_count, upvote_count in result.all()
+    }
+    changed_keys = {
+        key
+        for key in previous_stats.keys() | stats.keys()
+        if previous_stats.get(key, (0, 0)) != stats.get(key, (0, 0))
+    }
+    if not changed_keys:
+        await db_session.rollback()
+        return 0
+    await db_session.execute(
+        delete(models_users.UserStats).where(
+            tuple_(models_users.UserStats.user_id, models_users.UserStats.region).in_(
+                changed_keys
+            )
+        )
+    )
+    new_rows = [
+        {
+            "user_id": user_id,
+            "region": region,
+            "report_count": stats[user_id, region][0],
+            "upvote_count": stats[user_id, region][1],
+        }
+        for user_id, region in changed_keys
+        if (user_id, region) in stats
+    ]
+    if new_rows:
+        await db_session.execute(
+            postgresql_insert(models_users.UserStats).values(new_rows)
+        )
     await db_session.commit()
+    return len(changed_keys)
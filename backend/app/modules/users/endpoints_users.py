@@ -1,3 +1,4 @@
+import base64
 import logging
 import uuid
 from datetime import UTC, datetime, timedelta
@@ -5,12 +6,13 @@ from typing import Annotated, Sequence
 
 from app.dependencies import get_db_session, get_settings, is_user
 from app.modules.users import cruds_users, models_users, schemas_users
-from app.modules.users.types_users import AccountType
+from app.modules.users.types_users import AccountType, LeaderboardRanking
 from app.types import standard_responses
-from app.utils import mail
+from app.utils import mail, sharding
 from app.utils.config import Settings
 from app.utils.security import get_password_hash, verify_password
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 points_cimes_access_logger = logging.getLogger("points-cimes.access")
@@ -94,19 +96,16 @@ async def update_user_me(
     Update own user.
     """
 
-    # Allow email migrations without verification
-    if user_update.email:
-        existing_user = await cruds_users.get_user_by_email(
-            db_session=db_session, email=user_update.email
+    # Allow email migrations without verification.
+    # An email already used by another user is rejected by the unique constraint, and silently ignored
+    try:
+        await cruds_users.update_user(
+            db_session=db_session,
+            user_id=user.id,
+            user_update=user_update,
         )
-        if existing_user and existing_user.id != user.id:
-            return
-
-    await cruds_users.update_user(
-        db_session=db_session,
-        user_id=user.id,
-        user_update=user_update,
-    )
+    except IntegrityError:
+        return
 
 
 @router.post(
@@ -233,6 +232,68 @@ async def register_user(
         )
 
 
+def encode_leaderboard_cursor(count: int, user_id: uuid.UUID) -> str:
+    return base64.urlsafe_b64encode(f"{count}|{user_id}".encode()).decode()
+
+
+def decode_leaderboard_cursor(cursor: str) -> tuple[int, uuid.UUID]:
+    try:
+        count, user_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return int(count), uuid.UUID(user_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid cursor",
+        )
+
+
+@router.get("/leaderboard", response_model=schemas_users.LeaderboardPage)
+async def get_leaderboard(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    ranking: LeaderboardRanking = LeaderboardRanking.REPORTS,
+    region: str | None = None,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    """
+    Get the users who created the most reports, or received the most up votes, best first.
+
+    Without `region`, contributions in all regions are counted. A region is the geohash, of
+    `LEADERBOARD_REGION_PRECISION` characters, of the location of the reports.
+
+    Pages are read from an index, pass the `next_cursor` of a page as `cursor` to get the next one.
+    """
+    if region is not None and (
+        len(region) != settings.LEADERBOARD_REGION_PRECISION
+        or any(character not in sharding.GEOHASH_ALPHABET for character in region)
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"The region must be a geohash of {settings.LEADERBOARD_REGION_PRECISION} characters",
+        )
+    entries = await cruds_users.get_leaderboard(
+        db_session=db_session,
+        region=region if region is not None else models_users.GLOBAL_REGION,
+        ranking=ranking,
+        after=decode_leaderboard_cursor(cursor) if cursor is not None else None,
+        limit=limit,
+    )
+    next_cursor = None
+    if len(entries) == limit:
+        last_entry = entries[-1]
+        next_cursor = encode_leaderboard_cursor(
+            last_entry["report_count"]
+            if ranking == LeaderboardRanking.REPORTS
+            else last_entry["upvote_count"],
+            last_entry["user_id"],
+        )
+    return schemas_users.LeaderboardPage(
+        entries=[schemas_users.LeaderboardEntry(**entry) for entry in entries],
+        next_cursor=next_cursor,
+    )
+
+
 @router.get(
     "/{user_id}",
     dependencies=[Depends(is_user(AccountType.admin))],
@@ -251,43 +312,36 @@ async def read_user_by_id(
 
 @router.patch(
     "/{user_id}",
-    dependencies=[Depends(is_user(AccountType.admin))],
     response_model=schemas_users.User,
 )
 async def update_user(
     db_session: Annotated[AsyncSession, Depends(get_db_session)],
     user_id: uuid.UUID,
     user_update: schemas_users.UserUpdateAdmin,
+    user: Annotated[models_users.User, Depends(is_user(AccountType.admin))],
 ):
     """
     Update a user.
     """
-
-    user = await cruds_users.get_user_by_id(db_session=db_session, user_id=user_id)
-    if not user:
-        raise HTTPException(
-            status_code=404,
-            detail="The user with this id does not exist in the system",
-        )
-
     if user.id == user_id:
         raise HTTPException(
             status_code=409, detail="Admins must modify themselves as normal users"
         )
 
-    if user_update.email:
-        existing_user = await cruds_users.get_user_by_email(
-            db_session=db_session, email=user_update.email
+    try:
+        updated_user = await cruds_users.update_user(
+            db_session=db_session, user_id=user_id, user_update=user_update
         )
-        if existing_user and existing_user.id != user_id:
-            raise HTTPException(
-                status_code=409, detail="User with this email already exists"
-            )
-
-    db_session_user = await cruds_users.update_user(
-        db_session=db_session, user_id=user_id, user_update=user_update
-    )
-    return db_session_user
+    except IntegrityError:
+        raise HTTPException(
+            status_code=409, detail="User with this email already exists"
+        )
+    if updated_user is None:
+        raise HTTPException(
+            status_code=404,
+            detail="The user with this id does not exist in the system",
+        )
+    return updated_user
 
 
 @router.delete("/{user_id}", dependencies=[])
@@ -299,14 +353,15 @@ async def delete_user(
     """
     Delete a user.
     """
-    db_user = await cruds_users.get_user_by_id(db_session=db_session, user_id=user_id)
-    if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    if user == db_user:
+    if user.id == user_id:
         raise HTTPException(
             status_code=403, detail="Super users are not allowed to delete themselves"
         )
 
-    await cruds_users.delete_user_by_id(db_session=db_session, user_id=user_id)
+    deleted = await cruds_users.delete_user_by_id(
+        db_session=db_session, user_id=user_id
+    )
+    if not deleted:
+        raise HTTPException(status_code=404, detail="User not found")
 
     return standard_responses.Message(message="User deleted successfully")
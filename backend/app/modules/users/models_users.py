@@ -3,8 +3,12 @@ from uuid import UUID
 
 from app.modules.users.types_users import AccountType
 from app.types.sqlalchemy import Base
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column
 
+# Region of the stats summed over all the regions
+GLOBAL_REGION = ""
+
 
 class User(Base):
     __tablename__ = "user"
@@ -41,3 +45,28 @@ class UserRecoverRequest(Base):
     reset_token: Mapped[str] = mapped_column(primary_key=True)
     created_on: Mapped[datetime]
     expire_on: Mapped[datetime]
+
+
+class UserStats(Base):
+    """
+    Contributions of a user in a region, the geohash of the location of the reports, or in all regions.
+    Updated by the writes of reports and votes, and recomputed by `app.utils.user_stats`.
+    """
+
+    __tablename__ = "user_stats"
+    __table_args__ = (
+        # Leaderboards are read by walking these indexes backwards
+        Index("ix_user_stats_region_report_count", "region", "report_count", "user_id"),
+        Index(
+            "ix_user_stats_region_upvote_count", "region", "upvote_count", "user_id"
+        ),
+    )
+
+    user_id: Mapped[UUID] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    region: Mapped[str] = mapped_column(primary_key=True)
+    # Reports created by the user
+    report_count: Mapped[int] = mapped_column(default=0)
+    # Up votes received by these reports
+    upvote_count: Mapped[int] = mapped_column(default=0)
@@ -130,3 +130,18 @@ class ResetPasswordRequest(BaseModel):
 
 class MailMigrationRequest(BaseModel):
     new_email: str
+
+
+class LeaderboardEntry(BaseModel):
+    user_id: UUID
+    name: str
+    report_count: int
+    upvote_count: int
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class LeaderboardPage(BaseModel):
+    entries: list[LeaderboardEntry]
+    # Pass it as `cursor` to get the next entries. None on the last page
+    next_cursor: str | None
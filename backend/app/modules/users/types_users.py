@@ -5,3 +5,8 @@ class AccountType(str, Enum):
     user = "user"
     moderator = "moderator"
     admin = "admin"
+
+
+class LeaderboardRanking(str, Enum):
+    REPORTS = "reports"
+    UPVOTES = "upvotes"
@@ -1,16 +1,171 @@
+from collections.abc import Sequence
 from uuid import UUID
 
+from app.modules.reports import cruds_reports, models_reports
 from app.modules.votes import models_votes
 from app.modules.votes.types_votes import VoteValue
-from sqlalchemy import delete, select, update
+from app.utils import cache_bus
+from sqlalchemy import (
+    ColumnElement,
+    Integer,
+    RowMapping,
+    Uuid,
+    column,
+    delete,
+    exists,
+    func,
+    or_,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
-async def create_vote(
-    db_session: AsyncSession, vote: models_votes.Vote
-) -> models_votes.Vote | None:
-    await db_session.add(vote)
+async def publish_vote_invalidation(db_session: AsyncSession, report_id: UUID):
+    """Invalidate the votes of the report cached by all workers, once the transaction is committed"""
+    await cache_bus.publish(
+        db_session=db_session, event_type="votes", items=[str(report_id)]
+    )
+
+
+def get_vote_counter_values(
+    up_change: int | ColumnElement[int], down_change: int | ColumnElement[int]
+) -> dict[str, ColumnElement[int]]:
+    """The values incrementing the vote counters of a report"""
+    return {
+        "up_count": models_reports.Report.up_count + up_change,
+        "down_count": models_reports.Report.down_count + down_change,
+        "score": models_reports.Report.score + up_change - down_change,
+    }
+
+
+def count_vote_values(votes, vote_value: VoteValue) -> ColumnElement[int]:
+    """The number of votes of `vote_value` among the rows of a CTE, 0 or 1 for the vote of a user"""
+    return (
+        select(func.count())
+        .select_from(votes)
+        .where(votes.c.vote_value == vote_value)
+        .scalar_subquery()
+    )
+
+
+def get_vote_changes(
+    vote_value: VoteValue | None, previous_vote_value: VoteValue | None
+) -> tuple[int, int]:
+    """The changes of the `up_count` and `down_count` of a report when a vote changes"""
+    return (
+        int(vote_value == VoteValue.UP) - int(previous_vote_value == VoteValue.UP),
+        int(vote_value == VoteValue.DOWN) - int(previous_vote_value == VoteValue.DOWN),
+    )
+
+
+async def add_vote_counter_changes(
+    db_session: AsyncSession, changes: Sequence[tuple[UUID, int, int]]
+) -> Sequence[RowMapping]:
+    """
+    Apply `(report_id, up_change, down_change)` changes to the vote counters of several reports, in a single statement.
+    Return the `author_id`, coordinates and `up_change` of the updated reports
+    """
+    change_values = values(
+        column("report_id", Uuid()),
+        column("up_change", Integer()),
+        column("down_change", Integer()),
+        name="vote_change",
+    ).data(sorted(changes))
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(models_reports.Report.id == change_values.c.report_id)
+        .values(
+            get_vote_counter_values(
+                up_change=change_values.c.up_change,
+                down_change=change_values.c.down_change,
+            )
+        )
+        .returning(
+            models_reports.Report.author_id,
+            *cruds_reports.report_coordinates(),
+            change_values.c.up_change,
+        )
+    )
+    updated_reports = result.mappings().all()
     await db_session.commit()
+    return updated_reports
+
+
+async def upsert_vote(
+    db_session: AsyncSession, vote: models_votes.Vote, update_counters: bool = True
+) -> VoteValue | None:
+    """
+    Set the vote of a user on a report with a single statement, and return the previous value of the vote.
+    An IntegrityError is raised if the report does not exist.
+
+    The existing vote is locked while it is read, so that concurrent votes of the user are applied one after the other
+    and each one gets the value it replaced. Unless `update_counters` is False, the vote counters of the report
+    are changed by the same statement, from the difference between the new and the previous value.
+    """
+    previous_vote = (
+        select(models_votes.Vote.vote_value)
+        .where(
+            models_votes.Vote.user_id == vote.user_id,
+            models_votes.Vote.report_id == vote.report_id,
+        )
+        .with_for_update()
+        .cte("previous_vote")
+    )
+    insert_vote = postgresql_insert(models_votes.Vote).values(
+        id=vote.id,
+        user_id=vote.user_id,
+        report_id=vote.report_id,
+        vote_value=vote.vote_value,
+    )
+    upserted_vote = (
+        insert_vote.on_conflict_do_update(
+            constraint="uq_vote_user_id_report_id",
+            set_={"vote_value": insert_vote.excluded.vote_value},
+            # A vote inserted concurrently was not seen, and thus not locked: it is left unchanged
+            where=exists(previous_vote.select()),
+        )
+        .returning(models_votes.Vote.id)
+        .cte("upserted_vote")
+    )
+    updated_counters = (
+        update(models_reports.Report)
+        .where(
+            models_reports.Report.id == vote.report_id,
+            exists(upserted_vote.select()),
+        )
+        .values(
+            get_vote_counter_values(
+                up_change=int(vote.vote_value == VoteValue.UP)
+                - count_vote_values(previous_vote, VoteValue.UP),
+                down_change=int(vote.vote_value == VoteValue.DOWN)
+                - count_vote_values(previous_vote, VoteValue.DOWN),
+            )
+        )
+        .cte("updated_counters")
+    )
+    statement = select(
+        exists(upserted_vote.select()).label("written"),
+        previous_vote.select().scalar_subquery().label("previous_vote_value"),
+    )
+    if update_counters:
+        statement = statement.add_cte(updated_counters)
+    await publish_vote_invalidation(db_session=db_session, report_id=vote.report_id)
+    try:
+        while True:
+            result = await db_session.execute(statement)
+            written, previous_vote_value = result.one()
+            # The concurrent vote is committed, it is seen and locked when the statement is run again
+            if written:
+                break
+        await db_session.commit()
+    except IntegrityError:
+        await db_session.rollback()
+        raise
+    return previous_vote_value
 
 
 async def get_vote_by_report_and_user_id(
@@ -25,27 +180,119 @@ async def get_vote_by_report_and_user_id(
     return result.scalars().first()
 
 
-async def update_vote_by_report_and_user_id(
-    db_session: AsyncSession, user_id: UUID, report_id: UUID, vote_value: VoteValue
-) -> models_votes.Vote | None:
-    await db_session.execute(
-        update(models_votes.Vote)
-        .where(
+async def get_user_votes_by_report_ids(
+    db_session: AsyncSession, user_id: UUID, report_ids: Sequence[UUID]
+) -> dict[UUID, VoteValue]:
+    """
+    Get the votes of a user on several reports with a single query, using the `(user_id, report_id)` unique index
+    """
+    result = await db_session.execute(
+        select(models_votes.Vote.report_id, models_votes.Vote.vote_value).where(
             models_votes.Vote.user_id == user_id,
-            models_votes.Vote.report_id == report_id,
+            cruds_reports.is_in_reports(models_votes.Vote.report_id, report_ids),
+        )
+    )
+    return {report_id: vote_value for report_id, vote_value in result.all()}
+
+
+async def reconcile_vote_counters(
+    db_session: AsyncSession, after_id: UUID | None, limit: int
+) -> tuple[UUID | None, int]:
+    """
+    Recompute the vote counters of the next `limit` reports, ordered by id, from their votes.
+
+    Return the id of the last report of the batch, None once all reports were processed,
+    and the number of reports whose counters had drifted.
+
+    The reports are locked before their votes are counted: a vote written concurrently either is counted,
+    or changes the counters once they are recomputed.
+    """
+    query = select(models_reports.Report.id)
+    if after_id is not None:
+        query = query.where(models_reports.Report.id > after_id)
+    result = await db_session.execute(
+        query.order_by(models_reports.Report.id).limit(limit).with_for_update()
+    )
+    report_ids = result.scalars().all()
+    if not report_ids:
+        await db_session.rollback()
+        return None, 0
+
+    up_count = func.count().filter(models_votes.Vote.vote_value == VoteValue.UP)
+    down_count = func.count().filter(models_votes.Vote.vote_value == VoteValue.DOWN)
+    tally = (
+        select(
+            models_reports.Report.id.label("report_id"),
+            up_count.label("up_count"),
+            down_count.label("down_count"),
+        )
+        .outerjoin(
+            models_votes.Vote,
+            models_votes.Vote.report_id == models_reports.Report.id,
+        )
+        .where(models_reports.Report.id.in_(report_ids))
+        .group_by(models_reports.Report.id)
+        .subquery("tally")
+    )
+    result = await db_session.execute(
+        update(models_reports.Report)
+        .where(
+            models_reports.Report.id == tally.c.report_id,
+            or_(
+                models_reports.Report.up_count != tally.c.up_count,
+                models_reports.Report.down_count != tally.c.down_count,
+            ),
+        )
+        .values(
+            up_count=tally.c.up_count,
+            down_count=tally.c.down_count,
+            score=tally.c.up_count - tally.c.down_count,
         )
-        .values({"vote_value": vote_value})
+        .returning(models_reports.Report.id)
     )
+    drifted_count = len(result.all())
     await db_session.commit()
+    return report_ids[-1], drifted_count
 
 
 async def delete_vote_by_report_and_user_id(
-    db_session: AsyncSession, user_id: UUID, report_id: UUID
-) -> models_votes.Vote | None:
-    await db_session.execute(
-        delete(models_votes.Vote).where(
+    db_session: AsyncSession,
+    user_id: UUID,
+    report_id: UUID,
+    update_counters: bool = True,
+) -> VoteValue | None:
+    """
+    Delete a vote, and return its value. None is returned if the user did not vote on the report.
+    Unless `update_counters` is False, the vote counters of the report are decremented by the same statement.
+    """
+    deleted_vote = (
+        delete(models_votes.Vote)
+        .where(
             models_votes.Vote.user_id == user_id,
             models_votes.Vote.report_id == report_id,
         )
+        .returning(models_votes.Vote.vote_value)
+        .cte("deleted_vote")
+    )
+    updated_counters = (
+        update(models_reports.Report)
+        .where(
+            models_reports.Report.id == report_id,
+            exists(deleted_vote.select()),
+        )
+        .values(
+            get_vote_counter_values(
+                up_change=-count_vote_values(deleted_vote, VoteValue.UP),
+                down_change=-count_vote_values(deleted_vote, VoteValue.DOWN),
+            )
+        )
+        .cte("updated_counters")
     )
+    statement = select(deleted_vote.c.vote_value)
+    if update_counters:
+        statement = statement.add_cte(updated_counters)
+    result = await db_session.execute(statement)
+    previous_vote_value = result.scalar()
+    await publish_vote_invalidation(db_session=db_session, report_id=report_id)
     await db_session.commit()
+    return previous_vote_value
@@ -1,17 +1,34 @@
+import asyncio
 import logging
 import uuid
 from datetime import UTC, datetime, timedelta
 from typing import Annotated, Sequence
 
-from app.dependencies import get_db_session, get_settings, is_user
+from app.dependencies import (
+    get_db_session,
+    get_report_db_session,
+    get_report_ids_by_shard,
+    get_report_shard,
+    get_settings,
+    is_user,
+)
+from app.modules.reports import cruds_reports
 from app.modules.users import models_users
 from app.modules.users.types_users import AccountType
 from app.modules.votes import cruds_votes, models_votes, schemas_votes, types_votes
 from app.types import standard_responses
-from app.utils import mail
+from app.utils import (
+    idempotency,
+    mail,
+    sharding,
+    trending,
+    user_stats,
+    vote_buffer,
+)
 from app.utils.config import Settings
 from app.utils.security import get_password_hash, verify_password
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 points_cimes_access_logger = logging.getLogger("points-cimes.access")
@@ -28,6 +45,16 @@ async def get_specific_vote(
     db_session: Annotated[AsyncSession, Depends(get_db_session)],
     specific_vote: schemas_votes.SpecificVote,
 ):
+    shard = await get_report_shard(
+        db_session=db_session, report_id=specific_vote.report_id
+    )
+    if shard != sharding.DEFAULT_SHARD:
+        return await sharding.run_in_shard_session(
+            shard,
+            cruds_votes.get_vote_by_report_and_user_id,
+            user_id=specific_vote.user_id,
+            report_id=specific_vote.report_id,
+        )
     vote = await cruds_votes.get_vote_by_report_and_user_id(
         db_session=db_session,
         user_id=specific_vote.user_id,
@@ -36,12 +63,57 @@ async def get_specific_vote(
     return vote
 
 
+@router.post(
+    "/mine",
+    response_model=schemas_votes.MyVotes,
+)
+async def get_my_votes(
+    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    user: Annotated[models_users.User, Depends(is_user())],
+    my_votes_request: schemas_votes.MyVotesRequest,
+):
+    """
+    Get the votes of the user on several reports, for example the reports displayed on the map.
+
+    The votes are read with a single query per shard. Reports the user did not vote on are not included.
+    """
+    if len(my_votes_request.report_ids) > settings.MY_VOTES_MAX_REPORTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"The votes of at most {settings.MY_VOTES_MAX_REPORTS} reports can be read at once",
+        )
+    report_ids_by_shard = await get_report_ids_by_shard(
+        db_session=db_session, report_ids=my_votes_request.report_ids
+    )
+    votes = {}
+    if sharding.DEFAULT_SHARD in report_ids_by_shard:
+        votes = await cruds_votes.get_user_votes_by_report_ids(
+            db_session=db_session,
+            user_id=user.id,
+            report_ids=report_ids_by_shard.pop(sharding.DEFAULT_SHARD),
+        )
+    for shard_votes in await asyncio.gather(
+        *(
+            sharding.run_in_shard_session(
+                shard,
+                cruds_votes.get_user_votes_by_report_ids,
+                user_id=user.id,
+                report_ids=report_ids,
+            )
+            for shard, report_ids in report_ids_by_shard.items()
+        )
+    ):
+        votes.update(shard_votes)
+    return schemas_votes.MyVotes(votes=votes)
+
+
 @router.get(
     "/{report_id}",
     response_model=schemas_votes.Vote,
 )
 async def get_my_vote(
-    db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
     user: Annotated[models_users.User, Depends(is_user())],
     report_id: uuid.UUID,
 ):
@@ -56,37 +128,105 @@ async def get_my_vote(
 @router.put("/{report_id}", status_code=204)
 async def upsert_my_vote(
     db_session: Annotated[AsyncSession, Depends(get_db_session)],
+    report_db_session: Annotated[AsyncSession, Depends(get_report_db_session)],
+    settings: Annotated[Settings, Depends(get_settings)],
     user: Annotated[models_users.User, Depends(is_user())],
     report_id: uuid.UUID,
     vote_value: types_votes.VoteValue | None,
+    idempotency_key: idempotency.IdempotencyKey = None,
 ):
-    existing_vote = await cruds_votes.get_vote_by_report_and_user_id(
-        db_session=db_session, user_id=user.id, report_id=report_id
+    """
+    Set or clear (with a null value) the vote of the user on a report.
+
+    Retries sent with the same `Idempotency-Key` header are answered with the first response.
+    The vote is stored on the shard of the report, the idempotency keys in the main database.
+    """
+    # The shard is only needed to buffer the vote counters
+    shard = (
+        await get_report_shard(db_session=db_session, report_id=report_id)
+        if vote_buffer.enabled
+        else sharding.DEFAULT_SHARD
     )
-    if not existing_vote:
-        if vote_value:
-            vote = models_votes.Vote(
-                id=uuid.uuid4(),
-                user_id=user.id,
-                report_id=report_id,
-                vote_value=vote_value,
-            )
-            await cruds_votes.create_vote(db_session=db_session, vote=vote)
-            return
-        else:
-            return
+    return await idempotency.run_idempotent(
+        db_session=db_session,
+        settings=settings,
+        scope=f"upsert_my_vote:{user.id}",
+        key=idempotency_key,
+        request_hash=idempotency.hash_request(report_id, vote_value),
+        write=lambda: _upsert_vote(
+            db_session=db_session,
+            report_db_session=report_db_session,
+            shard=shard,
+            user_id=user.id,
+            report_id=report_id,
+            vote_value=vote_value,
+        ),
+        status_code=204,
+    )
+
 
-    if existing_vote.vote_value == vote_value:
-        return
+async def _upsert_vote(
+    db_session: AsyncSession,
+    report_db_session: AsyncSession,
+    shard: str,
+    user_id: uuid.UUID,
+    report_id: uuid.UUID,
+    vote_value: types_votes.VoteValue | None,
+):
+    """
+    Apply the vote with a single statement: an upsert on the `(user_id, report_id)` constraint,
+    or a delete to clear the vote.
 
+    In write-behind mode, the statement does not update the vote counters of the report:
+    their changes are added to the buffer once the vote is committed.
+    The up votes received by the author of the report are then updated in the main database,
+    or with the buffer flushes in write-behind mode.
+    """
+    buffered = vote_buffer.reserve(shard=shard, report_id=report_id)
     if not vote_value:
-        await cruds_votes.delete_vote_by_report_and_user_id(
-            db_session=db_session, user_id=user.id, report_id=report_id
+        previous_vote_value = await cruds_votes.delete_vote_by_report_and_user_id(
+            db_session=report_db_session,
+            user_id=user_id,
+            report_id=report_id,
+            update_counters=not buffered,
         )
     else:
-        await cruds_votes.update_vote_by_report_and_user_id(
-            db_session=db_session,
-            user_id=user.id,
+        vote = models_votes.Vote(
+            id=uuid.uuid4(),
+            user_id=user_id,
             report_id=report_id,
             vote_value=vote_value,
         )
+        try:
+            previous_vote_value = await cruds_votes.upsert_vote(
+                db_session=report_db_session, vote=vote, update_counters=not buffered
+            )
+        except IntegrityError:
+            raise HTTPException(
+                status_code=404,
+                detail="Report not found",
+            )
+    up_change, down_change = cruds_votes.get_vote_changes(
+        vote_value=vote_value, previous_vote_value=previous_vote_value
+    )
+    if buffered:
+        vote_buffer.add(
+            shard=shard,
+            report_id=report_id,
+            up_change=up_change,
+            down_change=down_change,
+        )
+    if vote_value and vote_value != previous_vote_value:
+        trending.record(report_id, weight=trending.VOTE_WEIGHT)
+    if up_change and not buffered:
+        report_author = await cruds_reports.get_report_author(
+            db_session=report_db_session, report_id=report_id
+        )
+        if report_author is not None:
+            await user_stats.add_contribution(
+                db_session=db_session,
+                author_id=report_author["author_id"],
+                longitude=report_author["longitude"],
+                latitude=report_author["latitude"],
+                upvote_count_change=up_change,
+            )
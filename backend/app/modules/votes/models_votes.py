@@ -3,14 +3,20 @@ from uuid import UUID
 
 from app.modules.votes.types_votes import VoteValue
 from app.types.sqlalchemy import Base
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column
 
 
 class Vote(Base):
     __tablename__ = "vote"
+    __table_args__ = (
+        # A user has a single vote per report, votes are upserted on this constraint
+        UniqueConstraint("user_id", "report_id", name="uq_vote_user_id_report_id"),
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
     user_id: Mapped[UUID] = mapped_column(ForeignKey("user.id"))
-    report_id: Mapped[UUID] = mapped_column(ForeignKey("report.id"))
-    vote_value: VoteValue
+    report_id: Mapped[UUID] = mapped_column(
+        ForeignKey("reports.id", ondelete="CASCADE")
+    )
+    vote_value: Mapped[VoteValue]
@@ -1,14 +1,35 @@
 from uuid import UUID
 
-from pydantic import BaseModel
+from app.modules.votes.types_votes import VoteValue
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class Vote(BaseModel):
     id: UUID
     user_id: UUID
     report_id: UUID
+    vote_value: VoteValue
+
+    model_config = ConfigDict(from_attributes=True)
 
 
 class SpecificVote(BaseModel):
     user_id: UUID
     report_id: UUID
+
+
+class MyVotesRequest(BaseModel):
+    report_ids: list[UUID] = Field(min_length=1)
+
+
+class MyVotes(BaseModel):
+    # The vote of the user by report id. Reports the user did not vote on are not included
+    votes: dict[UUID, VoteValue]
+
+
+class VoteTally(BaseModel):
+    up_count: int
+    down_count: int
+    score: int
+
+    model_config = ConfigDict(from_attributes=True)
@@ -0,0 +1,42 @@
+import logging
+from datetime import UTC, datetime, timedelta
+
+from app.modules.reports import cruds_reports
+from app.modules.reports.types_reports import ReportType
+from app.utils import report_cache, sharding
+from app.utils.config import Settings
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+
+async def archive_expired_reports(settings: Settings) -> None:
+    """
+    Archive active reports older than the time to live of their type.
+
+    Reports are archived in small batches, each in its own transaction, so that the sweeper never holds
+    many row locks. Archived reports leave the spatial index used by map queries. Shards are swept one after the other.
+    """
+    now = datetime.now(UTC)
+    for shard in sharding.get_shard_names():
+        async with sharding.get_shard_session(shard) as db_session:
+            for report_type_value, time_to_live in settings.REPORT_TIME_TO_LIVE_HOURS.items():
+                report_type = ReportType(report_type_value)
+                archived_count = 0
+                while True:
+                    archived_reports = await cruds_reports.archive_expired_reports(
+                        db_session=db_session,
+                        report_type=report_type,
+                        created_before=now - timedelta(hours=time_to_live),
+                        limit=settings.REPORT_ARCHIVAL_BATCH_SIZE,
+                    )
+                    report_cache.invalidate_locations(
+                        (archived_report["longitude"], archived_report["latitude"])
+                        for archived_report in archived_reports
+                    )
+                    archived_count += len(archived_reports)
+                    if len(archived_reports) < settings.REPORT_ARCHIVAL_BATCH_SIZE:
+                        break
+                if archived_count:
+                    points_cimes_error_logger.info(
+                        f"Archival: {archived_count} expired {report_type.value} reports archived on shard {shard}"
+                    )
@@ -0,0 +1,24 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+
+async def run_periodically(
+    job: Callable[[], Awaitable[None]],
+    interval_seconds: float,
+    name: str,
+) -> None:
+    """
+    Run `job` every `interval_seconds` until the task is cancelled.
+
+    Errors are logged so that a failing run does not stop the next ones.
+    This coroutine is intended to be started as a task in the application lifespan.
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await job()
+        except Exception:
+            points_cimes_error_logger.exception(f"Background job {name} failed")
@@ -0,0 +1,151 @@
+"""
+A local content-addressed blob store.
+
+Blobs are named after the SHA-256 of their content, so storing the same content twice keeps a single file.
+Files are sharded in two levels of directories (`ab/cd/abcd...`) to keep directories small.
+As a blob content never changes, it can be cached forever by clients.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+from app.modules.reports import cruds_reports
+from app.utils import sharding
+from app.utils.config import Settings
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Report photos and thumbnails are all stored as JPEG files
+BLOB_SUFFIX = ".jpg"
+
+# Files being written before their move to the store
+TEMPORARY_DIRECTORY = "tmp"
+
+
+def get_blob_url(sha256: str) -> str:
+    """The url of the blob download endpoint"""
+    return f"/media/{sha256}"
+
+
+def get_blob_path(root: Path, sha256: str) -> Path:
+    return root / sha256[:2] / sha256[2:4] / f"{sha256}{BLOB_SUFFIX}"
+
+
+def get_temporary_path(root: Path, name: str) -> Path:
+    """A path to write a file which will be added to the store, on the same filesystem"""
+    return root / TEMPORARY_DIRECTORY / name
+
+
+def _add_blob(root: Path, source: Path, sha256: str) -> None:
+    destination = get_blob_path(root=root, sha256=sha256)
+    if destination.exists():
+        # The content is already stored
+        source.unlink()
+        # Refresh the modification time so that the garbage collector grace period also protects the reused blob
+        os.utime(destination)
+        return
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    # The move is atomic, readers never see a partially written blob
+    source.replace(destination)
+
+
+async def add_blob(root: Path, source: Path, sha256: str) -> None:
+    """
+    Move the file `source`, whose content hash is `sha256`, to the store
+    """
+    await asyncio.to_thread(_add_blob, root, source, sha256)
+
+
+def _iter_blob_hashes(root: Path) -> Iterator[tuple[str, float]]:
+    """Yield the hash and modification time of all stored blobs"""
+    for first_level in os.scandir(root):
+        if not first_level.is_dir() or first_level.name == TEMPORARY_DIRECTORY:
+            continue
+        for second_level in os.scandir(first_level.path):
+            if not second_level.is_dir():
+                continue
+            for entry in os.scandir(second_level.path):
+                sha256 = entry.name.removesuffix(BLOB_SUFFIX)
+                if entry.is_file() and SHA256_PATTERN.match(sha256):
+                    yield sha256, entry.stat().st_mtime
+
+
+def _list_blob_batch(
+    blob_iterator: Iterator[tuple[str, float]],
+    batch_size: int,
+    modified_before: float,
+) -> list[str]:
+    batch: list[str] = []
+    for sha256, modification_time in blob_iterator:
+        if modification_time < modified_before:
+            batch.append(sha256)
+            if len(batch) >= batch_size:
+                break
+    return batch
+
+
+def _delete_stale_temporary_files(root: Path, modified_before: float) -> None:
+    temporary_directory = root / TEMPORARY_DIRECTORY
+    if not temporary_directory.is_dir():
+        return
+    for entry in os.scandir(temporary_directory):
+        if entry.is_file() and entry.stat().st_mtime < modified_before:
+            Path(entry.path).unlink(missing_ok=True)
+
+
+def _delete_blobs(root: Path, hashes: list[str]) -> None:
+    for sha256 in hashes:
+        get_blob_path(root=root, sha256=sha256).unlink(missing_ok=True)
+
+
+async def collect_unreferenced_blobs(settings: Settings) -> None:
+    """
+    Delete blobs which are not referenced by any report photo anymore.
+
+    The store is scanned in batches and each batch is checked with a single query.
+    Recent blobs are kept, as they may belong to an upload which is not saved in the database yet.
+    A blob is kept if a photo of any shard references it.
+    """
+    root = Path(settings.BLOB_STORE_DIRECTORY)
+    if not root.is_dir():
+        return
+
+    modified_before = time.time() - settings.BLOB_GC_GRACE_PERIOD_SECONDS
+    # Temporary files left by interrupted uploads
+    await asyncio.to_thread(_delete_stale_temporary_files, root, modified_before)
+
+    blob_iterator = _iter_blob_hashes(root)
+    deleted_count = 0
+    while True:
+        batch = await asyncio.to_thread(
+            _list_blob_batch,
+            blob_iterator,
+            settings.BLOB_GC_BATCH_SIZE,
+            modified_before,
+        )
+        if not batch:
+            break
+        # Each check runs in a session of its own, so that no snapshot is held during the deletion
+        shards_referenced_hashes = await sharding.fan_out(
+            sharding.get_shard_names(),
+            cruds_reports.get_referenced_blob_hashes,
+            hashes=batch,
+        )
+        referenced_hashes = set().union(*shards_referenced_hashes)
+        unreferenced_hashes = [
+            sha256 for sha256 in batch if sha256 not in referenced_hashes
+        ]
+        await asyncio.to_thread(_delete_blobs, root, unreferenced_hashes)
+        deleted_count += len(unreferenced_hashes)
+
+    if deleted_count:
+        points_cimes_error_logger.info(
+            f"Blob store: {deleted_count} unreferenced blobs deleted"
+        )
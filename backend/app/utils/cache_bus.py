@@ -0,0 +1,200 @@
+"""
+Invalidation of the in-process caches of all workers, with Postgres `LISTEN`/`NOTIFY`.
+
+Mutations publish compact events with `pg_notify` in their transaction, so that events are only delivered
+once the mutation is committed. Every worker keeps a dedicated connection listening to the channel,
+and evicts the matching entries of its local caches.
+
+Events sent while a worker is not listening are lost: caches are not used while the connection is down,
+and all of them are flushed when it is established again.
+
+Notifications are only delivered to the listeners of the database they are sent on: a worker listens
+to the main database and to every report shard.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections.abc import Callable, Sequence
+from typing import Any
+
+import asyncpg
+from app.utils import metrics
+from app.utils.config import Settings
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+CHANNEL = "points_cimes_cache"
+
+# A notification payload must be shorter than 8000 bytes, large events are split
+MAX_PAYLOAD_BYTES = 7000
+
+# Functions evicting the entries matching the items of an event, by event type
+_handlers: dict[str, list[Callable[[list[Any]], None]]] = {}
+# Functions clearing a whole cache
+_flushes: list[Callable[[], None]] = []
+
+enabled = False
+listened_database_count = 0
+# Names of the databases whose connection is listening, `main` or the name of a shard
+_listening: set[str] = set()
+received_events = 0
+reconnections = 0
+last_lag_seconds = 0.0
+max_lag_seconds = 0.0
+
+
+def register_cache(
+    flush: Callable[[], None],
+    handlers: dict[str, Callable[[list[Any]], None]],
+) -> None:
+    """Register a local cache, with the functions invalidating its entries for each event type"""
+    _flushes.append(flush)
+    for event_type, handler in handlers.items():
+        _handlers.setdefault(event_type, []).append(handler)
+
+
+def is_coherent() -> bool:
+    """
+    Whether local caches can be used: invalidation events are received, or there is no other worker
+    """
+    return not enabled or len(_listening) == listened_database_count
+
+
+def _split_items(items: Sequence[Any]) -> list[list[Any]]:
+    """Split the items of an event so that each part fits in a notification"""
+    chunks: list[list[Any]] = []
+    chunk_size = 0
+    for item in items:
+        item_size = len(json.dumps(item, separators=(",", ":")))
+        if not chunks or chunk_size + item_size > MAX_PAYLOAD_BYTES:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(item)
+        chunk_size += item_size + 1
+    return chunks
+
+
+async def publish(db_session: AsyncSession, event_type: str, items: Sequence[Any]):
+    """
+    Publish an invalidation event in the transaction of the mutation. The caller is responsible for the commit
+    """
+    for chunk in _split_items(items):
+        payload = json.dumps(
+            {"type": event_type, "items": chunk, "sent_at": round(time.time(), 3)},
+            separators=(",", ":"),
+        )
+        await db_session.execute(select(func.pg_notify(CHANNEL, payload)))
+
+
+def flush_all() -> None:
+    for flush in _flushes:
+        flush()
+
+
+def _on_notification(
+    connection: asyncpg.Connection, pid: int, channel: str, payload: str
+) -> None:
+    global received_events, last_lag_seconds, max_lag_seconds
+    try:
+        event = json.loads(payload)
+        for handler in _handlers.get(event["type"], ()):
+            handler(event["items"])
+    except Exception:
+        # We can not know which entries are stale
+        points_cimes_error_logger.exception(f"Cache bus: invalid event {payload}")
+        flush_all()
+        return
+    received_events += 1
+    # The clocks of the hosts are assumed to be synchronized
+    last_lag_seconds = max(time.time() - event["sent_at"], 0)
+    max_lag_seconds = max(max_lag_seconds, last_lag_seconds)
+
+
+def _get_databases(settings: Settings) -> dict[str, dict[str, Any]]:
+    """The connection parameters of the databases events can be published on, by name"""
+    databases: dict[str, dict[str, Any]] = {
+        "main": {
+            "host": settings.POSTGRES_HOST,
+            "port": settings.POSTGRES_PORT,
+            "user": settings.POSTGRES_USER,
+            "password": settings.POSTGRES_PASSWORD,
+            "database": settings.POSTGRES_DB,
+        }
+    }
+    for shard, database_url in settings.REPORT_SHARD_DATABASES.items():
+        databases[shard] = {"dsn": database_url}
+    return databases
+
+
+async def _listen(
+    settings: Settings, database: str, connection_parameters: dict[str, Any]
+) -> None:
+    """Listen to the channel of a database until the connection is lost"""
+    connection = await asyncpg.connect(**connection_parameters)
+    try:
+        await connection.add_listener(CHANNEL, _on_notification)
+        # Events published before we were listening were missed
+        flush_all()
+        _listening.add(database)
+        while not connection.is_closed():
+            await asyncio.sleep(settings.CACHE_BUS_HEALTH_CHECK_SECONDS)
+            # A connection lost without being closed is only detected when it is used
+            await asyncio.wait_for(
+                connection.fetchval("SELECT 1"),
+                timeout=settings.CACHE_BUS_HEALTH_CHECK_SECONDS,
+            )
+    finally:
+        _listening.discard(database)
+        flush_all()
+        connection.terminate()
+
+
+async def _run_listener(
+    settings: Settings, database: str, connection_parameters: dict[str, Any]
+) -> None:
+    global reconnections
+    while True:
+        try:
+            await _listen(settings, database, connection_parameters)
+        except Exception:
+            points_cimes_error_logger.warning(
+                f"Cache bus: connection to the {database} database lost, local caches are disabled until it is established again",
+                exc_info=True,
+            )
+        reconnections += 1
+        await asyncio.sleep(settings.CACHE_BUS_RECONNECT_DELAY_SECONDS)
+
+
+async def run_cache_bus(settings: Settings) -> None:
+    """
+    Listen to invalidation events on every database, reconnecting when a connection is lost.
+    This coroutine is intended to be started as a task in the application lifespan.
+    """
+    global enabled, listened_database_count
+    databases = _get_databases(settings)
+    listened_database_count = len(databases)
+    enabled = True
+    await asyncio.gather(
+        *(
+            _run_listener(settings, database, connection_parameters)
+            for database, connection_parameters in databases.items()
+        )
+    )
+
+
+def get_metrics() -> dict[str, float]:
+    return {
+        "listening": int(enabled and len(_listening) == listened_database_count),
+        "listening_databases": len(_listening),
+        "received_events": received_events,
+        "reconnections": reconnections,
+        "last_lag_seconds": last_lag_seconds,
+        "max_lag_seconds": max_lag_seconds,
+    }
+
+
+metrics.register_metrics("cache_bus", get_metrics)
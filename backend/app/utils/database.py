@@ -4,6 +4,7 @@ import alembic.command as alembic_command
 import alembic.config as alembic_config
 import alembic.migration as alembic_migration
 from app.types.sqlalchemy import Base
+from app.utils import sharding
 from app.utils.config import Settings
 from sqlalchemy import Engine, MetaData, create_engine
 from sqlalchemy.engine import Connection
@@ -20,6 +21,50 @@ def get_sync_db_engine(settings: Settings) -> Engine:
     return engine
 
 
+# Tables stored on each shard database, see `app.utils.sharding`
+SHARD_TABLES = ("reports", "report_photo", "report_merge", "report_history", "vote")
+
+
+def get_shard_metadata() -> MetaData:
+    """
+    The tables of a shard database.
+
+    Foreign keys to the users are not kept, as the users are only stored in the main database.
+    """
+    metadata = MetaData()
+    for table_name in SHARD_TABLES:
+        table = Base.metadata.tables[table_name].to_metadata(metadata)
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split(".")[0] not in SHARD_TABLES:
+                table.constraints.discard(constraint)
+                for foreign_key in constraint.elements:
+                    foreign_key.parent.foreign_keys.discard(foreign_key)
+                    table.foreign_keys.discard(foreign_key)
+    return metadata
+
+
+def update_shard_tables(
+    database_url: str,
+    points_cimes_error_logger: logging.Logger,
+) -> None:
+    """
+    Create the missing tables of a shard database. Shards are not managed by alembic
+    """
+    sync_engine = create_engine(
+        sharding.get_database_url(database_url, driver="psycopg")
+    )
+    try:
+        with sync_engine.begin() as conn:
+            get_shard_metadata().create_all(conn)
+    except Exception as error:
+        points_cimes_error_logger.fatal(
+            f"Startup: Could not create tables in the shard database: {error}",
+        )
+        raise
+    finally:
+        sync_engine.dispose()
+
+
 def init_engine(settings: Settings) -> AsyncEngine:
     """
     Return the (asynchronous) database engine, if the engine doesn't exit yet it will create one based on the settings
@@ -0,0 +1,27 @@
+"""
+Helpers for the `ETag`, `If-None-Match` and `If-Match` headers.
+"""
+
+
+def etag_matches(etag: str, header: str) -> bool:
+    """Check if `etag` is one of the entity tags listed in an `If-None-Match` or `If-Match` header"""
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def get_version_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def get_report_etag(version: int, up_count: int, down_count: int) -> str:
+    """
+    The ETag of a report: votes change its counters without changing its version
+    """
+    return f'"{version}.{up_count}.{down_count}"'
+
+
+def parse_version_etag(header: str) -> int | None:
+    """Get the version from an `If-Match` header containing a single version or report ETag"""
+    tag = header.strip().removeprefix("W/").strip('"').split(".")[0]
+    return int(tag) if tag.isdigit() else None
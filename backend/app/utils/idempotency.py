@@ -0,0 +1,181 @@
+"""
+Support of the `Idempotency-Key` header on write endpoints.
+
+Mobile clients retry requests on bad connections. When a write is sent with an `Idempotency-Key` header,
+its response is stored and retries using the same key are answered with it, without executing the write again.
+"""
+
+import hashlib
+import logging
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime, timedelta
+from typing import Annotated, Any
+
+from app.dependencies import get_background_db_session
+from app.modules.idempotency import cruds_idempotency
+from app.utils.config import Settings
+from cachetools import TTLCache
+from fastapi import Header, HTTPException, Response
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+# A claimed key whose request did not complete (the worker crashed, the client disconnected)
+# can be claimed again after this delay
+CLAIM_TIMEOUT = timedelta(seconds=60)
+
+# Retries usually come within a few seconds, recent responses are kept in memory
+# so that they are answered without querying the database
+_response_cache: TTLCache[tuple[str, str], tuple[str, int, bytes]] = TTLCache(
+    maxsize=10_000,
+    ttl=600,
+)
+
+IdempotencyKey = Annotated[
+    str | None,
+    Header(alias="Idempotency-Key", max_length=255),
+]
+
+
+def hash_request(*parts: Any) -> str:
+    """
+    Hash the content of a request, to detect a key reused for a different request
+    """
+    payload = "|".join(
+        part.model_dump_json() if isinstance(part, BaseModel) else str(part)
+        for part in parts
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _stored_response(status_code: int, body: bytes) -> Response:
+    if not body:
+        return Response(status_code=status_code)
+    return Response(
+        content=body,
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+async def _get_stored_response(
+    db_session: AsyncSession,
+    scope: str,
+    key: str,
+    request_hash: str,
+) -> Response | None:
+    """
+    Claim the key, or return the response of the request which already used it
+    """
+    cached = _response_cache.get((scope, key))
+    if cached is None:
+        now = datetime.now(UTC)
+        claimed = await cruds_idempotency.claim_idempotency_key(
+            db_session=db_session,
+            scope=scope,
+            key=key,
+            request_hash=request_hash,
+            expire_on=now + CLAIM_TIMEOUT,
+            now=now,
+        )
+        if claimed:
+            return None
+
+        idempotency_key = await cruds_idempotency.get_idempotency_key(
+            db_session=db_session, scope=scope, key=key
+        )
+        if idempotency_key is None or idempotency_key.status_code is None:
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this idempotency key is already being processed",
+            )
+        cached = (
+            idempotency_key.request_hash,
+            idempotency_key.status_code,
+            idempotency_key.response_body or b"",
+        )
+        _response_cache[(scope, key)] = cached
+
+    stored_request_hash, status_code, body = cached
+    if stored_request_hash != request_hash:
+        raise HTTPException(
+            status_code=422,
+            detail="This idempotency key was already used for a different request",
+        )
+    return _stored_response(status_code=status_code, body=body)
+
+
+async def run_idempotent(
+    db_session: AsyncSession,
+    settings: Settings,
+    scope: str,
+    key: str | None,
+    request_hash: str,
+    write: Callable[[], Awaitable[Any]],
+    response_model: type[BaseModel] | None = None,
+    status_code: int = 200,
+) -> Any:
+    """
+    Execute `write` only once for a given idempotency `key`.
+
+    `scope` identifies the endpoint (and the user if the endpoint is authenticated) so that keys chosen by different clients do not collide.
+    The result of `write` is serialized with `response_model`, or an empty response is stored if there is none.
+    Without key, `write` is executed and its result returned as is.
+    """
+    if key is None:
+        return await write()
+
+    stored_response = await _get_stored_response(
+        db_session=db_session, scope=scope, key=key, request_hash=request_hash
+    )
+    if stored_response is not None:
+        return stored_response
+
+    try:
+        result = await write()
+    except Exception:
+        # The request can be retried with the same key
+        await db_session.rollback()
+        await cruds_idempotency.delete_idempotency_key(
+            db_session=db_session, scope=scope, key=key
+        )
+        raise
+
+    body = (
+        response_model.model_validate(result).model_dump_json().encode()
+        if response_model is not None
+        else b""
+    )
+    await cruds_idempotency.save_idempotency_response(
+        db_session=db_session,
+        scope=scope,
+        key=key,
+        status_code=status_code,
+        response_body=body,
+        expire_on=datetime.now(UTC)
+        + timedelta(hours=settings.IDEMPOTENCY_KEY_EXPIRE_HOURS),
+    )
+    _response_cache[(scope, key)] = (request_hash, status_code, body)
+    return _stored_response(status_code=status_code, body=body)
+
+
+async def purge_expired_idempotency_keys(settings: Settings) -> None:
+    """
+    Delete expired keys in batches, so that the purge never holds long locks
+    """
+    deleted_count = 0
+    async with get_background_db_session() as db_session:
+        while True:
+            deleted = await cruds_idempotency.delete_expired_idempotency_keys(
+                db_session=db_session,
+                now=datetime.now(UTC),
+                limit=settings.IDEMPOTENCY_PURGE_BATCH_SIZE,
+            )
+            deleted_count += deleted
+            if deleted < settings.IDEMPOTENCY_PURGE_BATCH_SIZE:
+                break
+    if deleted_count:
+        points_cimes_error_logger.info(
+            f"Idempotency: {deleted_count} expired keys purged"
+        )
@@ -0,0 +1,225 @@
+"""
+Image processing, executed in a pool of processes so that it never blocks the event loop.
+
+Decoding and resizing a photo is CPU bound and can take hundreds of milliseconds for large pictures.
+The pool is bounded: when too many photos are waiting to be processed, new ones are refused
+instead of piling up in memory.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from collections.abc import AsyncGenerator
+
+import anyio
+from app.utils.config import Settings
+from fastapi import HTTPException, Request
+from PIL import Image, ImageOps, UnidentifiedImageError
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+# Size of the chunks read from uploaded files
+CHUNK_SIZE = 1024 * 1024
+# Room left around an uploaded file for the boundaries and headers of the multipart body
+MULTIPART_OVERHEAD = 64 * 1024
+
+image_pool: ProcessPoolExecutor | None = None
+image_pool_slots: asyncio.Semaphore | None = None
+image_pool_capacity = 0
+image_pool_waiting = 0
+
+
+def init_image_pool(settings: Settings) -> None:
+    """
+    Start the image processing pool, this should be called in the application lifespan
+    """
+    global image_pool, image_pool_slots, image_pool_capacity
+
+    # Processes are spawned rather than forked, as forking a process running an event loop is not safe
+    image_pool = ProcessPoolExecutor(
+        max_workers=settings.IMAGE_POOL_SIZE,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    image_pool_slots = asyncio.Semaphore(settings.IMAGE_POOL_SIZE)
+    image_pool_capacity = settings.IMAGE_POOL_SIZE + settings.IMAGE_POOL_QUEUE_SIZE
+
+
+def shutdown_image_pool() -> None:
+    global image_pool
+    if image_pool is not None:
+        image_pool.shutdown(wait=True, cancel_futures=True)
+        image_pool = None
+
+
+def is_image_pool_saturated() -> bool:
+    return image_pool_waiting >= image_pool_capacity
+
+
+async def _limit_stream(
+    stream: AsyncGenerator[bytes, None], max_size: int
+) -> AsyncGenerator[bytes, None]:
+    size = 0
+    async for chunk in stream:
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Request body is larger than {max_size} bytes",
+            )
+        yield chunk
+
+
+async def receive_upload_file(
+    request: Request, field: str, max_size: int
+) -> UploadFile:
+    """
+    Receive the file `field` of a multipart request.
+
+    An `UploadFile` endpoint parameter is received entirely before the endpoint runs. The body is only
+    received when this is called, so that the endpoint can refuse the request first. A 413 is raised
+    from the `Content-Length` header, or as soon as the body is larger than `max_size` bytes and the multipart overhead.
+    The caller is responsible for closing the file.
+    """
+    max_body_size = max_size + MULTIPART_OVERHEAD
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_body_size:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File is larger than {max_size} bytes",
+        )
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(
+            status_code=400,
+            detail="A multipart/form-data body is expected",
+        )
+    parser = MultiPartParser(
+        request.headers,
+        _limit_stream(request.stream(), max_body_size),
+        max_files=1,
+        max_fields=10,
+    )
+    try:
+        form = await parser.parse()
+    except MultiPartException as error:
+        raise HTTPException(status_code=400, detail=error.message)
+    upload_file = form.get(field)
+    if not isinstance(upload_file, UploadFile):
+        await form.close()
+        raise HTTPException(
+            status_code=400,
+            detail=f"The file {field} is missing",
+        )
+    return upload_file
+
+
+async def save_upload_file(
+    upload_file: UploadFile,
+    destination: Path,
+    max_size: int,
+) -> int:
+    """
+    Copy an uploaded file to `destination` chunk by chunk, and return its size.
+
+    Only one chunk is held in memory at a time. A 413 is raised if the file is larger than `max_size` bytes.
+    """
+    size = 0
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        async with await anyio.open_file(destination, "wb") as file:
+            while chunk := await upload_file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File is larger than {max_size} bytes",
+                    )
+                await file.write(chunk)
+    except BaseException:
+        destination.unlink(missing_ok=True)
+        raise
+    return size
+
+
+def _save_jpeg(image: Image.Image, destination: Path, quality: int) -> str:
+    """Save the image as a JPEG file and return the SHA-256 of the file"""
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, optimize=True)
+    destination.write_bytes(buffer.getbuffer())
+    return hashlib.sha256(buffer.getbuffer()).hexdigest()
+
+
+def resize_photo(
+    source: Path,
+    photo_destination: Path,
+    thumbnail_destination: Path,
+    photo_max_dimension: int,
+    thumbnail_max_dimension: int,
+) -> tuple[str, str]:
+    """
+    Save a resized JPEG version of the photo and its thumbnail, and return their SHA-256.
+
+    The photo is rotated according to its EXIF orientation, and its metadata are stripped.
+    This function is executed in the image pool.
+    """
+    with Image.open(source) as image:
+        photo = ImageOps.exif_transpose(image).convert("RGB")
+    photo.thumbnail((photo_max_dimension, photo_max_dimension))
+    photo_sha256 = _save_jpeg(photo, photo_destination, quality=85)
+    photo.thumbnail((thumbnail_max_dimension, thumbnail_max_dimension))
+    thumbnail_sha256 = _save_jpeg(photo, thumbnail_destination, quality=80)
+    return photo_sha256, thumbnail_sha256
+
+
+async def create_photo_and_thumbnail(
+    source: Path,
+    photo_destination: Path,
+    thumbnail_destination: Path,
+    settings: Settings,
+) -> tuple[str, str]:
+    """
+    Resize the photo in the image pool, waiting for a free process, and return the SHA-256 of the photo and its thumbnail.
+
+    A 503 is raised if the pool is saturated and a 400 if the file is not a valid image.
+    """
+    global image_pool_waiting
+
+    if image_pool is None or image_pool_slots is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Image processing is not available",
+        )
+    if is_image_pool_saturated():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many photos are being processed, please retry later",
+            headers={"Retry-After": "5"},
+        )
+
+    image_pool_waiting += 1
+    try:
+        async with image_pool_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                image_pool,
+                resize_photo,
+                source,
+                photo_destination,
+                thumbnail_destination,
+                settings.REPORT_PHOTO_MAX_DIMENSION,
+                settings.REPORT_THUMBNAIL_MAX_DIMENSION,
+            )
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        photo_destination.unlink(missing_ok=True)
+        thumbnail_destination.unlink(missing_ok=True)
+        raise HTTPException(
+            status_code=400,
+            detail="The file is not a valid image",
+        )
+    finally:
+        image_pool_waiting -= 1
@@ -0,0 +1,19 @@
+"""
+A registry of in-process metrics, exposed by the `/metrics` endpoint.
+
+Components register a function returning their current values. Metrics are per worker process.
+"""
+
+from collections.abc import Callable
+
+MetricsSource = Callable[[], dict[str, float]]
+
+_sources: dict[str, MetricsSource] = {}
+
+
+def register_metrics(name: str, source: MetricsSource) -> None:
+    _sources[name] = source
+
+
+def get_metrics() -> dict[str, dict[str, float]]:
+    return {name: source() for name, source in _sources.items()}
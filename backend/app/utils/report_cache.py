@@ -0,0 +1,200 @@
+"""
+Cache of the serialized report listings.
+
+Listings are keyed by their normalized geometry, and indexed by the cells of a grid covering the bounding box
+of the geometry. When a report is written, only the listings indexed under the cells containing its old and
+new locations are invalidated, so that a cache hit is never stale.
+
+A listing whose query was running while one of its cells was invalidated is not stored, as its result may
+predate the write. The cache is local to the worker process, writes made by other workers are received
+through the cache bus.
+"""
+
+import math
+from collections import defaultdict
+from collections.abc import Awaitable, Callable, Iterable
+
+from app.utils import cache_bus, metrics
+from app.utils.config import Settings
+from cachetools import TTLCache
+from geoalchemy2 import WKBElement
+from geoalchemy2.shape import to_shape
+from shapely.geometry.base import BaseGeometry
+
+Cell = tuple[int, int]
+
+
+class ReportListingCache(TTLCache[str, bytes]):
+    """A TTL and LRU cache which keeps an index of its entries by cell"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.entry_cells: dict[str, list[Cell]] = {}
+        self.cell_entries: defaultdict[Cell, set[str]] = defaultdict(set)
+        self.evictions = 0
+
+    def store(self, key: str, value: bytes, cells: list[Cell]) -> None:
+        self.discard(key)
+        self[key] = value
+        self.entry_cells[key] = cells
+        for cell in cells:
+            self.cell_entries[cell].add(key)
+
+    def discard(self, key: str) -> None:
+        self.pop(key, None)
+        self._unindex(key)
+
+    def popitem(self):
+        # Called when the cache is full, to evict the least recently used entry
+        key, value = super().popitem()
+        self.evictions += 1
+        self._unindex(key)
+        return key, value
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, _ in expired:
+            self._unindex(key)
+        return expired
+
+    def _unindex(self, key: str) -> None:
+        for cell in self.entry_cells.pop(key, ()):
+            entries = self.cell_entries.get(cell)
+            if entries is not None:
+                entries.discard(key)
+                if not entries:
+                    del self.cell_entries[cell]
+
+
+cache: ReportListingCache | None = None
+cell_degrees = 0.01
+max_cells_per_entry = 0
+hits = 0
+misses = 0
+
+# The cells of the listings being queried, and whether one of them was invalidated since the query started
+_pending_fills: list[tuple[set[Cell], list[bool]]] = []
+
+
+def init_report_cache(settings: Settings) -> None:
+    """
+    Create the cache, this should be called in the application lifespan
+    """
+    global cache, cell_degrees, max_cells_per_entry
+    cache = ReportListingCache(
+        maxsize=settings.REPORT_CACHE_MAX_ENTRIES,
+        ttl=settings.REPORT_CACHE_TTL_SECONDS,
+    )
+    cell_degrees = settings.REPORT_CACHE_CELL_DEGREES
+    max_cells_per_entry = settings.REPORT_CACHE_MAX_CELLS_PER_ENTRY
+
+
+def get_cell(longitude: float, latitude: float) -> Cell:
+    return math.floor(longitude / cell_degrees), math.floor(latitude / cell_degrees)
+
+
+def get_geometry_cells(geometry: BaseGeometry) -> list[Cell] | None:
+    """The cells covering the bounding box of the geometry, or None if there are too many of them"""
+    min_longitude, min_latitude, max_longitude, max_latitude = geometry.bounds
+    min_x, min_y = get_cell(min_longitude, min_latitude)
+    max_x, max_y = get_cell(max_longitude, max_latitude)
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > max_cells_per_entry:
+        return None
+    return [
+        (x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)
+    ]
+
+
+def get_cached_listing(key: str) -> bytes | None:
+    global hits, misses
+    content = (
+        cache.get(key) if cache is not None and cache_bus.is_coherent() else None
+    )
+    if content is None:
+        misses += 1
+    else:
+        hits += 1
+    return content
+
+
+async def fill_listing(
+    key: str,
+    geometry: BaseGeometry,
+    query: Callable[[], Awaitable[bytes]],
+) -> bytes:
+    """
+    Run the query of a listing and store its result, unless a report of its cells was written during the query
+    """
+    cells = get_geometry_cells(geometry)
+    if cache is None or cells is None:
+        return await query()
+
+    invalidated = [False]
+    pending_fill = (set(cells), invalidated)
+    _pending_fills.append(pending_fill)
+    try:
+        content = await query()
+    finally:
+        _pending_fills.remove(pending_fill)
+    if not invalidated[0] and cache_bus.is_coherent():
+        cache.store(key, content, cells)
+    return content
+
+
+def invalidate_locations(locations: Iterable[tuple[float, float]]) -> None:
+    """
+    Invalidate the listings which may contain a report at one of the `(longitude, latitude)` locations.
+
+    It must be called after a report is created, changed or deleted, with its location before and after the write.
+    """
+    cells = {get_cell(longitude, latitude) for longitude, latitude in locations}
+    for pending_cells, invalidated in _pending_fills:
+        if not pending_cells.isdisjoint(cells):
+            invalidated[0] = True
+    if cache is None:
+        return
+    for cell in cells:
+        for key in list(cache.cell_entries.get(cell, ())):
+            cache.discard(key)
+
+
+def flush() -> None:
+    for _, invalidated in _pending_fills:
+        invalidated[0] = True
+    if cache is not None:
+        cache.clear()
+        cache.entry_cells.clear()
+        cache.cell_entries.clear()
+
+
+def invalidate_wkb_locations(locations: Iterable[WKBElement]) -> None:
+    invalidate_locations(
+        (point.x, point.y) for point in (to_shape(location) for location in locations)
+    )
+
+
+def invalidate_report_changes(changes: list[dict]) -> None:
+    """Invalidate the listings affected by report changes published on the cache bus"""
+    locations = [(change["longitude"], change["latitude"]) for change in changes]
+    locations.extend(
+        (change["previous_longitude"], change["previous_latitude"])
+        for change in changes
+        if "previous_longitude" in change
+    )
+    invalidate_locations(locations)
+
+
+def get_metrics() -> dict[str, float]:
+    return {
+        "hits": hits,
+        "misses": misses,
+        "evictions": cache.evictions if cache is not None else 0,
+        "entries": len(cache) if cache is not None else 0,
+    }
+
+
+metrics.register_metrics("report_cache", get_metrics)
+cache_bus.register_cache(
+    flush=flush,
+    handlers={"reports": invalidate_report_changes},
+)
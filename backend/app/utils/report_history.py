@@ -0,0 +1,85 @@
+"""
+Maintenance of the partitions of the report history.
+
+The history is range-partitioned by month on the entry creation time, in tables named `report_history_YYYY_MM`.
+An insertion fails if the partition of its month does not exist, so partitions are created ahead.
+Expired partitions are detached and dropped, which is instant whatever their size, instead of deleting their rows.
+"""
+
+import logging
+import re
+from datetime import UTC, date, datetime
+
+from app.modules.reports import cruds_reports, models_reports
+from app.utils import sharding
+from app.utils.config import Settings
+from sqlalchemy.ext.asyncio import AsyncSession
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+PARTITION_NAME_PATTERN = re.compile(
+    rf"^{models_reports.ReportHistory.__tablename__}_(\d{{4}})_(\d{{2}})$"
+)
+
+
+def add_months(month: date, months: int) -> date:
+    """Return the first day of the month `months` after `month`"""
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_partition_name(month: date) -> str:
+    return f"{models_reports.ReportHistory.__tablename__}_{month.year:04d}_{month.month:02d}"
+
+
+def get_partition_month(name: str) -> date | None:
+    match = PARTITION_NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+async def maintain_report_history_partitions(settings: Settings) -> None:
+    """
+    Create the partitions of the current and next months, and drop the partitions older than the retention,
+    on every shard
+    """
+    current_month = datetime.now(UTC).date().replace(day=1)
+    for shard in sharding.get_shard_names():
+        async with sharding.get_shard_session(shard) as db_session:
+            await _maintain_shard_partitions(
+                db_session=db_session,
+                settings=settings,
+                shard=shard,
+                current_month=current_month,
+            )
+
+
+async def _maintain_shard_partitions(
+    db_session: AsyncSession, settings: Settings, shard: str, current_month: date
+) -> None:
+    for months in range(settings.REPORT_HISTORY_PARTITIONS_AHEAD + 1):
+        month = add_months(current_month, months)
+        await cruds_reports.create_report_history_partition(
+            db_session=db_session,
+            name=get_partition_name(month),
+            start=month,
+            end=add_months(month, 1),
+        )
+
+    if settings.REPORT_HISTORY_RETENTION_MONTHS <= 0:
+        return
+    oldest_kept_month = add_months(
+        current_month, -settings.REPORT_HISTORY_RETENTION_MONTHS
+    )
+    for name in await cruds_reports.get_report_history_partitions(
+        db_session=db_session
+    ):
+        month = get_partition_month(name)
+        if month is not None and month < oldest_kept_month:
+            await cruds_reports.drop_report_history_partition(
+                db_session=db_session, name=name
+            )
+            points_cimes_error_logger.info(
+                f"Report history: partition {name} of shard {shard} dropped"
+            )
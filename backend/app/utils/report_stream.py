@@ -0,0 +1,197 @@
+"""
+Push of report changes to the clients displaying a viewport of the map, with server-sent events.
+
+Changes are received from the cache bus, so that changes made by any worker are pushed.
+Subscriptions are indexed by the cells of a grid covering their bounding box: a change is only matched
+against the subscriptions of the cells of its old and new locations. Subscriptions covering too many cells,
+which are rare zoomed out viewports, are matched against every change.
+
+Each subscription has a bounded queue. When a client does not read its events fast enough, its pending
+events are replaced by a single `resync` event, asking it to reload its viewport with `GET /reports/`.
+"""
+
+import asyncio
+import json
+import math
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+
+from app.utils import cache_bus, metrics
+from app.utils.config import Settings
+
+Cell = tuple[int, int]
+
+RESYNC_EVENT = "resync"
+
+cell_degrees = 0.1
+max_cells_per_subscription = 400
+queue_size = 100
+max_subscribers = 10_000
+
+_cell_subscriptions: defaultdict[Cell, set["Subscription"]] = defaultdict(set)
+# Subscriptions covering more than `max_cells_per_subscription` cells
+_wide_subscriptions: set["Subscription"] = set()
+subscriber_count = 0
+pushed_events = 0
+resyncs = 0
+
+
+@dataclass(eq=False)
+class Subscription:
+    min_longitude: float
+    min_latitude: float
+    max_longitude: float
+    max_latitude: float
+    # None to receive all types
+    report_types: frozenset[str] | None
+    queue: asyncio.Queue[tuple[str, str]] = field(
+        default_factory=lambda: asyncio.Queue(maxsize=queue_size)
+    )
+    cells: list[Cell] = field(default_factory=list)
+
+    def contains(self, longitude: float, latitude: float) -> bool:
+        return (
+            self.min_longitude <= longitude <= self.max_longitude
+            and self.min_latitude <= latitude <= self.max_latitude
+        )
+
+    def push(self, event: str, data: str) -> None:
+        global pushed_events, resyncs
+        try:
+            self.queue.put_nowait((event, data))
+            pushed_events += 1
+        except asyncio.QueueFull:
+            # The client will reload its viewport, the pending events are useless
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait((RESYNC_EVENT, "{}"))
+            resyncs += 1
+
+
+def init_report_stream(settings: Settings) -> None:
+    """
+    Configure the stream, this should be called in the application lifespan
+    """
+    global cell_degrees, max_cells_per_subscription, queue_size, max_subscribers
+    cell_degrees = settings.REPORT_STREAM_CELL_DEGREES
+    max_cells_per_subscription = settings.REPORT_STREAM_MAX_CELLS_PER_SUBSCRIPTION
+    queue_size = settings.REPORT_STREAM_QUEUE_SIZE
+    max_subscribers = settings.REPORT_STREAM_MAX_SUBSCRIBERS
+
+
+def get_cell(longitude: float, latitude: float) -> Cell:
+    return (math.floor(longitude / cell_degrees), math.floor(latitude / cell_degrees))
+
+
+def is_full() -> bool:
+    return subscriber_count >= max_subscribers
+
+
+def subscribe(subscription: Subscription) -> None:
+    global subscriber_count
+    min_x, min_y = get_cell(subscription.min_longitude, subscription.min_latitude)
+    max_x, max_y = get_cell(subscription.max_longitude, subscription.max_latitude)
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > max_cells_per_subscription:
+        _wide_subscriptions.add(subscription)
+    else:
+        subscription.cells = [
+            (x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)
+        ]
+        for cell in subscription.cells:
+            _cell_subscriptions[cell].add(subscription)
+    subscriber_count += 1
+
+
+def unsubscribe(subscription: Subscription) -> None:
+    global subscriber_count
+    _wide_subscriptions.discard(subscription)
+    for cell in subscription.cells:
+        subscriptions = _cell_subscriptions[cell]
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del _cell_subscriptions[cell]
+    subscriber_count -= 1
+
+
+def push_report_changes(changes: list[dict]) -> None:
+    """Push report changes published on the cache bus to the matching subscriptions"""
+    for change in changes:
+        locations = [(change["longitude"], change["latitude"])]
+        if "previous_longitude" in change:
+            # A report moved out of a viewport is removed by its clients
+            locations.append(
+                (change["previous_longitude"], change["previous_latitude"])
+            )
+        subscriptions = set(_wide_subscriptions)
+        for longitude, latitude in locations:
+            subscriptions.update(
+                _cell_subscriptions.get(get_cell(longitude, latitude), ())
+            )
+        if not subscriptions:
+            continue
+        data = json.dumps(change, separators=(",", ":"))
+        for subscription in subscriptions:
+            if (
+                subscription.report_types is None
+                or change["report_type"] in subscription.report_types
+            ) and any(
+                subscription.contains(longitude, latitude)
+                for longitude, latitude in locations
+            ):
+                subscription.push(change["action"], data)
+
+
+def resync_all() -> None:
+    """Ask all clients to reload their viewport, as changes may have been missed"""
+    for subscription in _wide_subscriptions:
+        subscription.push(RESYNC_EVENT, "{}")
+    for subscription in {
+        subscription
+        for subscriptions in _cell_subscriptions.values()
+        for subscription in subscriptions
+    }:
+        subscription.push(RESYNC_EVENT, "{}")
+
+
+async def stream_events(
+    subscription: Subscription, keepalive_seconds: float
+) -> AsyncIterator[str]:
+    """
+    Subscribe and yield the events of the subscription formatted as server-sent events,
+    until the client disconnects
+    """
+    subscribe(subscription)
+    try:
+        # Clients reconnect after 5 seconds if the connection is lost
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event, data = await asyncio.wait_for(
+                    subscription.queue.get(), timeout=keepalive_seconds
+                )
+            except TimeoutError:
+                # Proxies close idle connections
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event}\ndata: {data}\n\n"
+    finally:
+        unsubscribe(subscription)
+
+
+def get_metrics() -> dict[str, float]:
+    return {
+        "subscribers": subscriber_count,
+        "wide_subscribers": len(_wide_subscriptions),
+        "indexed_cells": len(_cell_subscriptions),
+        "pushed_events": pushed_events,
+        "resyncs": resyncs,
+    }
+
+
+metrics.register_metrics("report_stream", get_metrics)
+# Changes missed while the cache bus was disconnected can not be known
+cache_bus.register_cache(
+    flush=resync_all,
+    handlers={"reports": push_report_changes},
+)
@@ -0,0 +1,55 @@
+"""
+Coalescing of identical concurrent reads.
+
+When many clients send the same query at the same time, only the first one is executed: the others wait for it
+and share its result. Once the query completes, the next identical request executes a new query,
+so results are never staler than for a request which would have run its own query.
+"""
+
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+from app.utils import metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    def __init__(self, name: str):
+        self._in_flight: dict[Hashable, asyncio.Task[T]] = {}
+        self.calls = 0
+        self.executions = 0
+        metrics.register_metrics(f"singleflight.{name}", self.get_metrics)
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        """
+        Return the result of `function`, or of the in-flight call with the same `key`.
+
+        The call runs in its own task: a caller which is cancelled, for example because its client disconnected,
+        does not cancel it for the other callers. `function` must thus not use resources bound to a request,
+        like its database session. Exceptions are raised to all callers.
+        """
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.create_task(function())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task[T]) -> None:
+        self._in_flight.pop(key, None)
+        # Mark the exception as retrieved, in case all callers were cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def get_metrics(self) -> dict[str, float]:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "in_flight": len(self._in_flight),
+            # The share of calls answered by the query of another call
+            "coalescing_ratio": 1 - self.executions / self.calls if self.calls else 0,
+        }
@@ -0,0 +1,200 @@
+"""
+Detection of the trending reports: the reports whose activity, votes and views, increased the most during the last window.
+
+Each worker counts the activity of the reports in memory, with a Space-Saving summary: at most
+`max_pending_reports` reports are counted, and a new report replaces the least active one. It starts from
+the count of the replaced report, so that it is not replaced right away, and this count is kept as its error.
+Only the activity seen since a report entered the summary, its count minus its error, is added to the database:
+an eviction never makes a report look more active than it was. The least active report is found with a min-heap.
+
+The counts are periodically added to time buckets in the database, summing the activity of all the workers,
+with the ranking grid cell of the reports. The trending reports of all the regions are read back from the buckets
+of the last two windows and kept in memory, the trending reports of a viewport are read from the buckets of its cells.
+Buckets are small: a worker adds at most `max_pending_reports` rows per bucket, and buckets older than two windows
+are deleted.
+"""
+
+import asyncio
+import heapq
+import time
+from collections.abc import Sequence
+from datetime import UTC, datetime, timedelta
+from uuid import UUID
+
+from app.dependencies import get_background_db_session, get_report_ids_by_shard
+from app.modules.reports import cruds_reports
+from app.utils import metrics, sharding
+from app.utils.config import Settings
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# A vote shows more interest than a view
+VIEW_WEIGHT = 1
+VOTE_WEIGHT = 5
+
+max_pending_reports = 1000
+
+# Activity counted since the last synchronization, by report id, with the count inherited from evicted reports
+_pending: dict[UUID, int] = {}
+# Count inherited by the reports which replaced an evicted report
+_errors: dict[UUID, int] = {}
+# (count, report id) of the pending reports. Counts only increase, an entry may be lower than the current count
+_heap: list[tuple[int, UUID]] = []
+# Trending reports of all the workers, with their activity increase, most trending first
+_trending: list[tuple[UUID, int]] = []
+recorded_events = 0
+evictions = 0
+last_sync_time = 0.0
+
+
+def init_trending(settings: Settings) -> None:
+    """
+    Configure the detector, this should be called in the application lifespan
+    """
+    global max_pending_reports
+    max_pending_reports = settings.TRENDING_MAX_PENDING_REPORTS
+
+
+def record(report_id: UUID, weight: int = VIEW_WEIGHT) -> None:
+    """Count activity on a report"""
+    global recorded_events, evictions
+    recorded_events += 1
+    if report_id in _pending:
+        _pending[report_id] += weight
+        return
+    if len(_pending) < max_pending_reports:
+        _pending[report_id] = weight
+        heapq.heappush(_heap, (weight, report_id))
+        return
+    # Outdated entries are updated until the least active report is found
+    while True:
+        count, least_active_report_id = heapq.heappop(_heap)
+        if count == _pending[least_active_report_id]:
+            break
+        heapq.heappush(
+            _heap, (_pending[least_active_report_id], least_active_report_id)
+        )
+    del _pending[least_active_report_id]
+    _errors.pop(least_active_report_id, None)
+    _pending[report_id] = count + weight
+    _errors[report_id] = count
+    heapq.heappush(_heap, (count + weight, report_id))
+    evictions += 1
+
+
+def get_trending() -> list[tuple[UUID, int]]:
+    """The trending reports of all the regions, with their activity increase, as of the last synchronization"""
+    return _trending
+
+
+def get_windows(settings: Settings) -> tuple[datetime, datetime, datetime]:
+    """The start of the current bucket, of the last window and of the previous window"""
+    bucket_seconds = settings.TRENDING_BUCKET_SECONDS
+    bucket_start = datetime.fromtimestamp(
+        datetime.now(UTC).timestamp() // bucket_seconds * bucket_seconds, UTC
+    )
+    # Windows are made of whole buckets
+    window_start = bucket_start - timedelta(
+        seconds=settings.TRENDING_WINDOW_SECONDS - bucket_seconds
+    )
+    previous_window_start = window_start - timedelta(
+        seconds=settings.TRENDING_WINDOW_SECONDS
+    )
+    return bucket_start, window_start, previous_window_start
+
+
+async def get_trending_in_cells(
+    db_session: AsyncSession, settings: Settings, cells: Sequence[int]
+) -> list[tuple[UUID, int]]:
+    """The trending reports of the ranking grid cells, with their activity increase, as of the last synchronization"""
+    _, window_start, previous_window_start = get_windows(settings)
+    return await cruds_reports.get_trending_report_activity(
+        db_session=db_session,
+        window_start=window_start,
+        previous_window_start=previous_window_start,
+        limit=settings.TRENDING_TOP_SIZE,
+        cells=cells,
+    )
+
+
+async def _get_report_cells(
+    db_session: AsyncSession, report_ids: Sequence[UUID]
+) -> dict[UUID, int]:
+    report_ids_by_shard = await get_report_ids_by_shard(
+        db_session=db_session, report_ids=report_ids
+    )
+    report_cells: dict[UUID, int] = {}
+    for shard_report_cells in await asyncio.gather(
+        *(
+            sharding.run_in_shard_session(
+                shard, cruds_reports.get_report_cells, report_ids=shard_report_ids
+            )
+            for shard, shard_report_ids in report_ids_by_shard.items()
+        )
+    ):
+        report_cells.update(shard_report_cells)
+    return report_cells
+
+
+async def sync_trending(settings: Settings) -> None:
+    """
+    Add the activity counted by the worker to the current bucket, and read the trending reports of all the workers.
+    This should be run periodically.
+    """
+    global _trending, last_sync_time
+    bucket_start, window_start, previous_window_start = get_windows(settings)
+
+    # The inherited counts are not activity of the reports
+    pending = {
+        report_id: count - _errors.get(report_id, 0)
+        for report_id, count in _pending.items()
+    }
+    _pending.clear()
+    _errors.clear()
+    _heap.clear()
+    async with get_background_db_session() as db_session:
+        if pending:
+            try:
+                # The cells of the reports are read from their shards, deleted reports are dropped
+                report_cells = await _get_report_cells(
+                    db_session=db_session, report_ids=list(pending)
+                )
+                activity = [
+                    (report_id, report_cells[report_id], count)
+                    for report_id, count in pending.items()
+                    if report_id in report_cells
+                ]
+                if activity:
+                    await cruds_reports.add_report_activity(
+                        db_session=db_session,
+                        bucket_start=bucket_start,
+                        activity=activity,
+                    )
+            except Exception:
+                # The activity is added with the next synchronization
+                await db_session.rollback()
+                for report_id, count in pending.items():
+                    record(report_id, weight=count)
+                raise
+        _trending = await cruds_reports.get_trending_report_activity(
+            db_session=db_session,
+            window_start=window_start,
+            previous_window_start=previous_window_start,
+            limit=settings.TRENDING_TOP_SIZE,
+        )
+        await cruds_reports.delete_report_activity(
+            db_session=db_session, before=previous_window_start
+        )
+    last_sync_time = time.time()
+
+
+def get_metrics() -> dict[str, float]:
+    return {
+        "pending_reports": len(_pending),
+        "trending_reports": len(_trending),
+        "recorded_events": recorded_events,
+        "evictions": evictions,
+        "last_sync_time": last_sync_time,
+    }
+
+
+metrics.register_metrics("trending", get_metrics)
@@ -0,0 +1,85 @@
+"""
+Cache of the users loaded to authenticate requests, local to the worker process.
+
+Entries are evicted when a user is changed, by any worker, through the cache bus.
+"""
+
+from uuid import UUID
+
+from app.modules.users import models_users
+from app.utils import cache_bus, metrics
+from app.utils.config import Settings
+from cachetools import TTLCache
+
+cache: TTLCache[UUID, models_users.User] | None = None
+hits = 0
+misses = 0
+# Incremented by every invalidation: a user loaded before an invalidation may be stale and is not stored
+generation = 0
+
+
+def init_user_cache(settings: Settings) -> None:
+    """
+    Create the cache, this should be called in the application lifespan
+    """
+    global cache
+    cache = TTLCache(
+        maxsize=settings.USER_CACHE_MAX_ENTRIES,
+        ttl=settings.USER_CACHE_TTL_SECONDS,
+    )
+
+
+def get_cached_user(user_id: UUID) -> models_users.User | None:
+    global hits, misses
+    user = (
+        cache.get(user_id) if cache is not None and cache_bus.is_coherent() else None
+    )
+    if user is None:
+        misses += 1
+    else:
+        hits += 1
+    return user
+
+
+def store_user(user: models_users.User, loaded_generation: int) -> None:
+    """
+    Store a copy of the user, which is not bound to the session of the request.
+
+    `loaded_generation` is the value of `generation` before the user was loaded.
+    """
+    if cache is None or loaded_generation != generation or not cache_bus.is_coherent():
+        return
+    cache[user.id] = models_users.User(
+        **{
+            column.key: getattr(user, column.key)
+            for column in models_users.User.__table__.columns
+        }
+    )
+
+
+def invalidate_users(user_ids: list[str]) -> None:
+    global generation
+    generation += 1
+    if cache is None:
+        return
+    for user_id in user_ids:
+        cache.pop(UUID(user_id), None)
+
+
+def flush() -> None:
+    global generation
+    generation += 1
+    if cache is not None:
+        cache.clear()
+
+
+def get_metrics() -> dict[str, float]:
+    return {
+        "hits": hits,
+        "misses": misses,
+        "entries": len(cache) if cache is not None else 0,
+    }
+
+
+metrics.register_metrics("user_cache", get_metrics)
+cache_bus.register_cache(flush=flush, handlers={"users": invalidate_users})
@@ -0,0 +1,157 @@
+"""
+Contribution stats of the users, read by the leaderboards: the reports they created and the up votes these received.
+
+The stats are stored in the main database, for all the regions and by region, the geohash of the location
+of the reports. They are updated by the writes of reports and votes, once these are committed on the shard
+of the report. In write-behind mode, up votes are summed by the vote buffer and applied with its flushes.
+A failed update is logged and the stats are fixed by the reconciliation job, which recomputes them
+from the reports of all the shards. Location edits and reports restored from merges are only counted by this job.
+"""
+
+import logging
+from collections.abc import Iterable
+from uuid import UUID
+
+from app.dependencies import get_background_db_session
+from app.modules.reports import cruds_reports
+from app.modules.users import cruds_users, models_users
+from app.utils import sharding
+from app.utils.config import Settings
+from sqlalchemy.ext.asyncio import AsyncSession
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+region_precision = 2
+
+
+def init_user_stats(settings: Settings) -> None:
+    """
+    Configure the regions, this should be called in the application lifespan
+    """
+    global region_precision
+    region_precision = settings.LEADERBOARD_REGION_PRECISION
+
+
+def get_region(longitude: float, latitude: float) -> str:
+    return sharding.encode_geohash(longitude, latitude, precision=region_precision)
+
+
+def get_contribution_changes(
+    author_id: UUID,
+    longitude: float,
+    latitude: float,
+    report_count_change: int = 0,
+    upvote_count_change: int = 0,
+) -> list[tuple[UUID, str, int, int]]:
+    """The changes of the stats of the author of a report, in all the regions and in the region of the report"""
+    return [
+        (author_id, region, report_count_change, upvote_count_change)
+        for region in (models_users.GLOBAL_REGION, get_region(longitude, latitude))
+    ]
+
+
+async def add_contributions(
+    db_session: AsyncSession, changes: Iterable[tuple[UUID, str, int, int]]
+) -> None:
+    """Apply `(user_id, region, report_count_change, upvote_count_change)` changes, with a single statement"""
+    # A row can only be changed once by a statement
+    summed_changes: dict[tuple[UUID, str], tuple[int, int]] = {}
+    for user_id, region, report_count_change, upvote_count_change in changes:
+        previous_report_count_change, previous_upvote_count_change = (
+            summed_changes.get((user_id, region), (0, 0))
+        )
+        summed_changes[user_id, region] = (
+            previous_report_count_change + report_count_change,
+            previous_upvote_count_change + upvote_count_change,
+        )
+    if not summed_changes:
+        return
+    try:
+        await cruds_users.add_user_stats_changes(
+            db_session=db_session,
+            changes=[
+                (user_id, region, report_count_change, upvote_count_change)
+                for (user_id, region), (
+                    report_count_change,
+                    upvote_count_change,
+                ) in summed_changes.items()
+            ],
+        )
+    except Exception:
+        await db_session.rollback()
+        points_cimes_error_logger.exception(
+            f"User stats: could not update the stats of {len(summed_changes)} users and regions"
+        )
+
+
+async def add_contribution(
+    db_session: AsyncSession,
+    author_id: UUID | None,
+    longitude: float,
+    latitude: float,
+    report_count_change: int = 0,
+    upvote_count_change: int = 0,
+) -> None:
+    """Change the stats of the author of a report, in all the regions and in the region of the report"""
+    if author_id is None or not (report_count_change or upvote_count_change):
+        return
+    await add_contributions(
+        db_session=db_session,
+        changes=get_contribution_changes(
+            author_id=author_id,
+            longitude=longitude,
+            latitude=latitude,
+            report_count_change=report_count_change,
+            upvote_count_change=upvote_count_change,
+        ),
+    )
+
+
+async def reconcile_user_stats(settings: Settings) -> None:
+    """
+    Recompute the stats of all the users from their reports, to fix stats which drifted.
+
+    Users are processed in batches, their reports are counted on all the shards concurrently,
+    and their stats are replaced in a single transaction. A change committed while the stats of its user
+    are recomputed may be missed, until the next run.
+    """
+    drifted_count = 0
+    after_id = None
+    async with get_background_db_session() as db_session:
+        while True:
+            user_ids = await cruds_users.get_user_ids(
+                db_session=db_session,
+                after_id=after_id,
+                limit=settings.USER_STATS_RECONCILE_BATCH_SIZE,
+            )
+            if not user_ids:
+                break
+            after_id = user_ids[-1]
+            shards_stats = await sharding.fan_out(
+                sharding.get_shard_names(),
+                cruds_reports.get_author_stats,
+                author_ids=user_ids,
+                region_precision=settings.LEADERBOARD_REGION_PRECISION,
+            )
+            # A region may be stored on several shards
+            stats: dict[tuple[UUID, str], tuple[int, int]] = {}
+            for shard_stats in shards_stats:
+                for author_id, region, report_count, upvote_count in shard_stats:
+                    for key in (
+                        (author_id, models_users.GLOBAL_REGION),
+                        (author_id, region),
+                    ):
+                        previous_report_count, previous_upvote_count = stats.get(
+                            key, (0, 0)
+                        )
+                        stats[key] = (
+                            previous_report_count + report_count,
+                            previous_upvote_count + upvote_count,
+                        )
+            drifted_count += await cruds_users.replace_user_stats(
+                db_session=db_session, user_ids=user_ids, stats=stats
+            )
+    if drifted_count:
+        points_cimes_error_logger.warning(
+            f"User stats: {drifted_count} stats fixed"
+        )
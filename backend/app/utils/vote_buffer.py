@@ -0,0 +1,165 @@
+"""
+Write-behind buffer of the vote counters of the reports.
+
+When a report receives many votes at once, updating its counters with each vote makes all the votes wait
+for the lock of the report row. In write-behind mode, votes are still written and committed one by one,
+but the changes of the counters are summed in memory, by report, and applied every few hundred milliseconds
+with a single statement per shard. The up votes received by the authors of the reports are summed the same way,
+so that votes on a popular report do not wait for the stats of its author either.
+
+Changes are kept in memory until they are flushed: they are lost if the worker crashes, and the counters
+are then fixed by the reconciliation job. The buffer holds a bounded number of reports, votes on other
+reports update their counters synchronously while it is full.
+"""
+
+import asyncio
+import logging
+from uuid import UUID
+
+from app.dependencies import get_background_db_session
+from app.modules.votes import cruds_votes
+from app.utils import metrics, sharding, user_stats
+from app.utils.config import Settings
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+enabled = False
+max_reports = 10_000
+
+# Shard -> report id -> [up_change, down_change]
+_pending: dict[str, dict[UUID, list[int]]] = {}
+pending_report_count = 0
+buffered_votes = 0
+flushes = 0
+failed_flushes = 0
+full_buffer_votes = 0
+
+
+def init_vote_buffer(settings: Settings) -> None:
+    """
+    Configure the buffer, this should be called in the application lifespan
+    """
+    global enabled, max_reports
+    enabled = settings.VOTE_COUNTERS_WRITE_BEHIND
+    max_reports = settings.VOTE_COUNTERS_BUFFER_MAX_REPORTS
+
+
+def reserve(shard: str, report_id: UUID) -> bool:
+    """
+    Whether the counter changes of a vote on the report should be buffered.
+    A slot is reserved for the report, so that the changes can be added once the vote is committed
+    """
+    global pending_report_count, full_buffer_votes
+    if not enabled:
+        return False
+    shard_pending = _pending.setdefault(shard, {})
+    if report_id in shard_pending:
+        return True
+    if pending_report_count >= max_reports:
+        full_buffer_votes += 1
+        return False
+    shard_pending[report_id] = [0, 0]
+    pending_report_count += 1
+    return True
+
+
+def _add_changes(
+    shard: str, report_id: UUID, up_change: int, down_change: int
+) -> None:
+    global pending_report_count
+    changes = _pending.setdefault(shard, {}).get(report_id)
+    if changes is None:
+        changes = _pending[shard][report_id] = [0, 0]
+        pending_report_count += 1
+    changes[0] += up_change
+    changes[1] += down_change
+
+
+def add(shard: str, report_id: UUID, up_change: int, down_change: int) -> None:
+    """
+    Add the counter changes of a committed vote, on a report reserved with `reserve`.
+    If the slot was flushed while the vote was written, it is reserved again
+    """
+    global buffered_votes
+    _add_changes(shard, report_id, up_change, down_change)
+    buffered_votes += 1
+
+
+async def flush() -> None:
+    """
+    Apply the buffered changes, with a single statement per shard,
+    and then the up votes received by the authors of the reports, with a single statement
+    """
+    global pending_report_count, flushes, failed_flushes
+    if not pending_report_count:
+        return
+    pending = dict(_pending)
+    _pending.clear()
+    pending_report_count = 0
+    contribution_changes: list[tuple[UUID, str, int, int]] = []
+    for shard, shard_pending in pending.items():
+        changes = [
+            (report_id, up_change, down_change)
+            for report_id, (up_change, down_change) in shard_pending.items()
+            if up_change or down_change
+        ]
+        if not changes:
+            continue
+        try:
+            updated_reports = await sharding.run_in_shard_session(
+                shard, cruds_votes.add_vote_counter_changes, changes=changes
+            )
+            flushes += 1
+        except Exception:
+            points_cimes_error_logger.exception(
+                f"Vote buffer: could not apply the counter changes of {len(changes)} reports on shard {shard}"
+            )
+            failed_flushes += 1
+            # The changes are retried with the next flush, even if the buffer is full
+            for report_id, up_change, down_change in changes:
+                _add_changes(shard, report_id, up_change, down_change)
+            continue
+        contribution_changes += [
+            change
+            for updated_report in updated_reports
+            if updated_report["author_id"] is not None and updated_report["up_change"]
+            for change in user_stats.get_contribution_changes(
+                author_id=updated_report["author_id"],
+                longitude=updated_report["longitude"],
+                latitude=updated_report["latitude"],
+                upvote_count_change=updated_report["up_change"],
+            )
+        ]
+    if contribution_changes:
+        # The up votes received by the authors, summed over the whole flush
+        async with get_background_db_session() as db_session:
+            await user_stats.add_contributions(
+                db_session=db_session, changes=contribution_changes
+            )
+
+
+async def run_vote_buffer(settings: Settings) -> None:
+    """
+    Flush the buffer periodically, and a last time when the task is cancelled.
+    This coroutine is intended to be started as a task in the application lifespan.
+    """
+    try:
+        while True:
+            await asyncio.sleep(settings.VOTE_COUNTERS_FLUSH_INTERVAL_SECONDS)
+            await flush()
+    finally:
+        # On shutdown, the changes are not lost
+        await asyncio.shield(flush())
+
+
+def get_metrics() -> dict[str, float]:
+    return {
+        "pending_reports": pending_report_count,
+        "buffered_votes": buffered_votes,
+        "flushes": flushes,
+        "failed_flushes": failed_flushes,
+        "full_buffer_votes": full_buffer_votes,
+    }
+
+
+metrics.register_metrics("vote_buffer", get_metrics)
@@ -0,0 +1,32 @@
+import logging
+
+from app.modules.votes import cruds_votes
+from app.utils import sharding
+from app.utils.config import Settings
+
+points_cimes_error_logger = logging.getLogger("points-cimes.error")
+
+
+async def reconcile_vote_counters(settings: Settings) -> None:
+    """
+    Recompute the vote counters of all the reports from their votes, to fix counters which drifted.
+
+    Reports are processed in batches, each in its own transaction, so that votes are only blocked briefly.
+    """
+    for shard in sharding.get_shard_names():
+        drifted_count = 0
+        after_id = None
+        async with sharding.get_shard_session(shard) as db_session:
+            while True:
+                after_id, fixed_count = await cruds_votes.reconcile_vote_counters(
+                    db_session=db_session,
+                    after_id=after_id,
+                    limit=settings.VOTE_COUNTERS_RECONCILE_BATCH_SIZE,
+                )
+                drifted_count += fixed_count
+                if after_id is None:
+                    break
+        if drifted_count:
+            points_cimes_error_logger.warning(
+                f"Vote counters: counters of {drifted_count} reports fixed on shard {shard}"
+            )
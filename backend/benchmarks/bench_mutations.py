@@ -0,0 +1,122 @@
+"""
+Benchmark the latency of the mutation endpoints against a running server.
+
+Each request is sent sequentially, so the latency mostly reflects the number of database round trips
+of the endpoint. Run it before and after a change on the same database to compare them.
+
+The user and vote endpoints need an access token, they are skipped without one.
+
+Usage, from the `backend` directory:
+```bash
+python benchmarks/bench_mutations.py --url http://localhost:8000 --requests 500 --token <access token>
+```
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from collections.abc import Awaitable, Callable
+
+import httpx
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "no values"
+    quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return (
+        f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms "
+        f"max={max(values) * 1000:.1f}ms"
+    )
+
+
+async def measure(
+    name: str,
+    report_ids: list[str],
+    send: Callable[[str], Awaitable[httpx.Response]],
+) -> None:
+    latencies = []
+    status_codes: dict[int, int] = {}
+    for report_id in report_ids:
+        start = time.perf_counter()
+        response = await send(report_id)
+        latencies.append(time.perf_counter() - start)
+        status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+    print(f"{name:<28} {percentiles(latencies)}  status codes: {status_codes}")
+
+
+async def main(url: str, requests: int, token: str | None) -> None:
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    async with httpx.AsyncClient(base_url=url, headers=headers, timeout=60) as client:
+        # Reports are spread so that they are not merged as duplicates
+        report_ids = []
+        for index in range(requests):
+            response = await client.post(
+                "/reports/",
+                json={
+                    "title": "Benchmark",
+                    "report_type": "highlight",
+                    "location": f"POINT({index * 0.01 % 180} {time.time() % 80})",
+                    "description": "Mutation benchmark",
+                },
+            )
+            response.raise_for_status()
+            report_ids.append(response.json()["id"])
+
+        await measure(
+            "PATCH /reports/{id}/status",
+            report_ids,
+            lambda report_id: client.patch(
+                f"/reports/{report_id}/status", params={"new_status": "active"}
+            ),
+        )
+        # The status change incremented the version of each report
+        await measure(
+            "PATCH /reports/{id}",
+            report_ids,
+            lambda report_id: client.patch(
+                f"/reports/{report_id}", json={"title": "Edited", "version": 2}
+            ),
+        )
+        if token:
+            await measure(
+                "PUT /votes/{id} (insert)",
+                report_ids,
+                lambda report_id: client.put(
+                    f"/votes/{report_id}", params={"vote_value": 1}
+                ),
+            )
+            await measure(
+                "PUT /votes/{id} (update)",
+                report_ids,
+                lambda report_id: client.put(
+                    f"/votes/{report_id}", params={"vote_value": -1}
+                ),
+            )
+            await measure(
+                "PUT /votes/{id} (delete)",
+                report_ids,
+                lambda report_id: client.put(f"/votes/{report_id}"),
+            )
+            await measure(
+                "PATCH /users/me",
+                report_ids,
+                lambda report_id: client.patch(
+                    "/users/me", json={"name": f"Benchmark {report_id[:8]}"}
+                ),
+            )
+        await measure(
+            "DELETE /reports/{id}",
+            report_ids,
+            lambda report_id: client.delete(f"/reports/{report_id}"),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--token", default=None)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.url, arguments.requests, arguments.token))
@@ -0,0 +1,109 @@
+"""
+Benchmark concurrent report photo uploads against a running server.
+
+While the uploads are running, the root endpoint is pinged continuously: its latency shows
+whether the event loop is stalled by the uploads or the photo processing.
+
+Usage, from the `backend` directory:
+```bash
+python benchmarks/bench_photo_uploads.py --url http://localhost:8000 --concurrency 16 --size-mb 10
+```
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import time
+
+import httpx
+from PIL import Image
+
+
+def generate_photo(size_mb: int) -> bytes:
+    """Generate a noise PNG, which does not compress, of roughly `size_mb` MB"""
+    side = int((size_mb * 1024 * 1024 / 3) ** 0.5)
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=0)
+    return buffer.getvalue()
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "no values"
+    quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return (
+        f"p50={quantiles[49] * 1000:.0f}ms p95={quantiles[94] * 1000:.0f}ms "
+        f"max={max(values) * 1000:.0f}ms"
+    )
+
+
+async def upload(
+    client: httpx.AsyncClient, report_id: str, photo: bytes
+) -> tuple[float, int]:
+    start = time.perf_counter()
+    response = await client.post(
+        f"/reports/{report_id}/photos",
+        files={"photo": ("photo.png", photo, "image/png")},
+    )
+    return time.perf_counter() - start, response.status_code
+
+
+async def ping(client: httpx.AsyncClient, stop: asyncio.Event) -> list[float]:
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get("/")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+    return latencies
+
+
+async def main(url: str, concurrency: int, size_mb: int) -> None:
+    photo = generate_photo(size_mb)
+    print(f"Photo size: {len(photo) / 1024 / 1024:.1f} MB")
+
+    async with httpx.AsyncClient(base_url=url, timeout=300) as client:
+        # Reports have a limited number of photos, each upload targets its own report.
+        # Reports are spread so that they are not merged as duplicates
+        report_ids = []
+        for index in range(concurrency):
+            response = await client.post(
+                "/reports/",
+                json={
+                    "title": "Benchmark",
+                    "report_type": "highlight",
+                    "location": f"POINT({index * 0.01} {time.time() % 80})",
+                    "description": "Photo upload benchmark",
+                },
+            )
+            response.raise_for_status()
+            report_ids.append(response.json()["id"])
+
+        stop = asyncio.Event()
+        ping_task = asyncio.create_task(ping(client, stop))
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[upload(client, report_id, photo) for report_id in report_ids]
+        )
+        elapsed = time.perf_counter() - start
+        stop.set()
+        ping_latencies = await ping_task
+
+    status_codes: dict[int, int] = {}
+    for _, status_code in results:
+        status_codes[status_code] = status_codes.get(status_code, 0) + 1
+    print(f"{concurrency} uploads in {elapsed:.1f}s, status codes: {status_codes}")
+    print(f"Upload latency: {percentiles([latency for latency, _ in results])}")
+    print(f"Ping latency during uploads: {percentiles(ping_latencies)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--size-mb", type=int, default=10)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.url, arguments.concurrency, arguments.size_mb))
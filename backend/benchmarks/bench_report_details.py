@@ -0,0 +1,102 @@
+"""
+Benchmark opening a report: the serial chain of requests against the composite details endpoint.
+
+The chain is `GET /reports/{id}` then `GET /votes/{id}`, as the app used to do it. An optional delay is added
+before each request to simulate the round trip time of a mobile network.
+
+The vote requests need an access token, only the report is read without one.
+
+Usage, from the `backend` directory:
+```bash
+python benchmarks/bench_report_details.py --url http://localhost:8000 --requests 200 --round-trip-ms 100 --token <access token>
+```
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from collections.abc import Awaitable, Callable
+
+import httpx
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "no values"
+    quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return (
+        f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms "
+        f"max={max(values) * 1000:.1f}ms"
+    )
+
+
+async def measure(
+    name: str,
+    report_ids: list[str],
+    open_report: Callable[[str], Awaitable[None]],
+) -> None:
+    latencies = []
+    for report_id in report_ids:
+        start = time.perf_counter()
+        await open_report(report_id)
+        latencies.append(time.perf_counter() - start)
+    print(f"{name:<34} {percentiles(latencies)}")
+
+
+async def main(
+    url: str, requests: int, round_trip_ms: float, token: str | None
+) -> None:
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    async with httpx.AsyncClient(base_url=url, headers=headers, timeout=60) as client:
+
+        async def get(path: str) -> httpx.Response:
+            await asyncio.sleep(round_trip_ms / 1000)
+            return await client.get(path)
+
+        report_ids = []
+        for index in range(requests):
+            response = await client.post(
+                "/reports/",
+                json={
+                    "title": "Benchmark",
+                    "report_type": "highlight",
+                    "location": f"POINT({index * 0.01 % 180} {time.time() % 80})",
+                    "description": "Report details benchmark",
+                },
+            )
+            response.raise_for_status()
+            report_ids.append(response.json()["id"])
+            if token and index % 2:
+                await client.put(f"/votes/{report_ids[-1]}", params={"vote_value": 1})
+
+        async def open_report_serially(report_id: str) -> None:
+            (await get(f"/reports/{report_id}")).raise_for_status()
+            if token:
+                await get(f"/votes/{report_id}")
+
+        async def open_report_details(report_id: str) -> None:
+            (await get(f"/reports/{report_id}/details")).raise_for_status()
+
+        await measure("GET /reports/{id} + /votes/{id}", report_ids, open_report_serially)
+        await measure("GET /reports/{id}/details", report_ids, open_report_details)
+
+        for report_id in report_ids:
+            await client.delete(f"/reports/{report_id}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--round-trip-ms", type=float, default=0)
+    parser.add_argument("--token", default=None)
+    arguments = parser.parse_args()
+    asyncio.run(
+        main(
+            arguments.url,
+            arguments.requests,
+            arguments.round_trip_ms,
+            arguments.token,
+        )
+    )
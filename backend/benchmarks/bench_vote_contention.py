@@ -0,0 +1,107 @@
+"""
+Benchmark concurrent votes on a single report, to compare the synchronous vote counters with the write-behind buffer.
+
+Every user of the tokens file votes on the same report at the same time, switching its vote between up and down,
+so that each vote changes the counters of the report. Run it once against a server started with
+`VOTE_COUNTERS_WRITE_BEHIND=False`, then once with `VOTE_COUNTERS_WRITE_BEHIND=True`.
+
+The tokens file contains one access token per line, of different users.
+
+Usage, from the `backend` directory:
+```bash
+python benchmarks/bench_vote_contention.py --url http://localhost:8000 --tokens-file tokens.txt --votes 20
+```
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "no values"
+    quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return (
+        f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms "
+        f"max={max(values) * 1000:.1f}ms"
+    )
+
+
+async def vote_repeatedly(
+    client: httpx.AsyncClient,
+    token: str,
+    report_id: str,
+    votes: int,
+    latencies: list[float],
+    status_codes: dict[int, int],
+) -> None:
+    for index in range(votes):
+        start = time.perf_counter()
+        response = await client.put(
+            f"/votes/{report_id}",
+            params={"vote_value": 1 if index % 2 == 0 else -1},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        latencies.append(time.perf_counter() - start)
+        status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+
+
+async def main(url: str, tokens_file: str, votes: int, flush_wait_seconds: float) -> None:
+    with open(tokens_file) as file:
+        tokens = [line.strip() for line in file if line.strip()]
+    limits = httpx.Limits(max_connections=len(tokens))
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as client:
+        response = await client.post(
+            "/reports/",
+            json={
+                "title": "Benchmark",
+                "report_type": "danger",
+                "location": f"POINT({time.time() % 180} {time.time() % 80})",
+                "description": "Vote contention benchmark",
+            },
+        )
+        response.raise_for_status()
+        report_id = response.json()["id"]
+
+        latencies: list[float] = []
+        status_codes: dict[int, int] = {}
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                vote_repeatedly(client, token, report_id, votes, latencies, status_codes)
+                for token in tokens
+            )
+        )
+        duration = time.perf_counter() - start
+        print(
+            f"{len(tokens)} users x {votes} votes: {len(latencies) / duration:.0f} votes/s "
+            f"{percentiles(latencies)}  status codes: {status_codes}"
+        )
+
+        # The last vote of each user is a down vote if `votes` is even
+        await asyncio.sleep(flush_wait_seconds)
+        details = (await client.get(f"/reports/{report_id}/details")).json()
+        print(f"Counters after the flush: {details['votes']}")
+
+        await client.delete(f"/reports/{report_id}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--tokens-file", required=True)
+    parser.add_argument("--votes", type=int, default=20)
+    parser.add_argument("--flush-wait-seconds", type=float, default=1)
+    arguments = parser.parse_args()
+    asyncio.run(
+        main(
+            arguments.url,
+            arguments.tokens_file,
+            arguments.votes,
+            arguments.flush_wait_seconds,
+        )
+    )
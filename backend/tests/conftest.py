@@ -0,0 +1,12 @@
+"""
+The settings are read from the environment when `app.utils.config` is imported.
+Tests only need placeholder values, the databases of the integration tests are configured explicitly.
+"""
+
+import os
+
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("POINTS_CIMES_VERSION", "test")
+os.environ.setdefault("PROJECT_NAME", "points-cimes")
+os.environ.setdefault("POSTGRES_HOST", "localhost")
+os.environ.setdefault("POSTGRES_USER", "points-cimes")
@@ -0,0 +1,158 @@
+import asyncio
+from collections.abc import Iterator
+from uuid import uuid4
+
+import pytest
+from app import dependencies
+from app.modules.reports import cruds_reports
+from app.utils import sharding
+from app.utils.config import Settings
+from shapely.geometry import box
+
+
+class FakeSession:
+    """Stands for the session of a shard, the functions run by the helpers only read its name"""
+
+    def __init__(self, shard: str = sharding.DEFAULT_SHARD) -> None:
+        self.shard = shard
+
+    async def __aenter__(self) -> "FakeSession":
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def shard_map() -> Iterator[None]:
+    """Europe is stored on a shard, except Paris which has its own, the rest of the world on the default shard"""
+    sharding.init_shards(
+        settings=Settings(
+            REPORT_SHARD_DATABASES={
+                "europe": "postgresql://points-cimes@localhost/europe",
+                "paris": "postgresql://points-cimes@localhost/paris",
+            },
+            REPORT_SHARD_MAP={"u": "europe", "u09": "paris"},
+        ),
+        default_session_maker=FakeSession,
+    )
+    # No database is queried, the sessions only carry the name of their shard
+    for shard in ("europe", "paris"):
+        sharding._session_makers[shard] = lambda shard=shard: FakeSession(shard)
+    yield
+    sharding.init_shards(
+        settings=Settings(REPORT_SHARD_DATABASES={}, REPORT_SHARD_MAP={}),
+        default_session_maker=FakeSession,
+    )
+
+
+@pytest.mark.parametrize(
+    ("longitude", "latitude", "precision", "geohash"),
+    [
+        (2.3522, 48.8566, 6, "u09tvw"),
+        (-122.4194, 37.7749, 5, "9q8yy"),
+        (-0.1278, 51.5074, 5, "gcpvj"),
+        (0.0, 0.0, 3, "s00"),
+    ],
+)
+def test_encode_geohash(
+    longitude: float, latitude: float, precision: int, geohash: str
+) -> None:
+    assert sharding.encode_geohash(longitude, latitude, precision) == geohash
+
+
+def test_geohash_bounds_contain_the_encoded_location() -> None:
+    geohash = sharding.encode_geohash(2.3522, 48.8566, precision=4)
+    min_longitude, min_latitude, max_longitude, max_latitude = (
+        sharding.get_geohash_bounds(geohash)
+    )
+    assert min_longitude <= 2.3522 < max_longitude
+    assert min_latitude <= 48.8566 < max_latitude
+    assert sharding.get_geohash_bounds("u09") == (1.40625, 47.8125, 2.8125, 49.21875)
+
+
+def test_location_shard_without_map() -> None:
+    assert sharding.get_location_shard(2.3522, 48.8566) == sharding.DEFAULT_SHARD
+    assert sharding.get_geometry_shards(box(-180, -90, 180, 90)) == [
+        sharding.DEFAULT_SHARD
+    ]
+
+
+@pytest.mark.usefixtures("shard_map")
+@pytest.mark.parametrize(
+    ("longitude", "latitude", "shard"),
+    [
+        # The longest prefix wins
+        (2.3522, 48.8566, "paris"),
+        (13.4050, 52.5200, "europe"),
+        (-74.0060, 40.7128, sharding.DEFAULT_SHARD),
+    ],
+)
+def test_location_shard(longitude: float, latitude: float, shard: str) -> None:
+    assert sharding.get_location_shard(longitude, latitude) == shard
+
+
+@pytest.mark.usefixtures("shard_map")
+@pytest.mark.parametrize(
+    ("bounds", "shards"),
+    [
+        ((2.3, 48.8, 2.4, 48.9), ["paris"]),
+        ((12.0, 50.0, 14.0, 53.0), ["europe"]),
+        ((2.0, 48.0, 14.0, 53.0), ["europe", "paris"]),
+        ((-10.0, 40.0, 10.0, 50.0), [sharding.DEFAULT_SHARD, "europe", "paris"]),
+        ((-80.0, 30.0, -70.0, 40.0), [sharding.DEFAULT_SHARD]),
+    ],
+)
+def test_geometry_shards(
+    bounds: tuple[float, float, float, float], shards: list[str]
+) -> None:
+    assert sharding.get_geometry_shards(box(*bounds)) == shards
+
+
+@pytest.mark.usefixtures("shard_map")
+def test_fan_out_returns_the_results_in_the_order_of_the_shards() -> None:
+    delays = {sharding.DEFAULT_SHARD: 0.03, "europe": 0.0, "paris": 0.01}
+
+    async def get_reports(db_session: FakeSession, limit: int) -> list[str]:
+        await asyncio.sleep(delays[db_session.shard])
+        return [f"{db_session.shard}-{index}" for index in range(limit)]
+
+    shards = [sharding.DEFAULT_SHARD, "europe", "paris"]
+    results = asyncio.run(sharding.fan_out(shards, get_reports, limit=2))
+    assert results == [[f"{shard}-0", f"{shard}-1"] for shard in shards]
+
+
+@pytest.mark.usefixtures("shard_map")
+def test_shard_helpers_forward_a_shard_keyword() -> None:
+    # The rebalance updates the directory with `shard=...`
+    async def set_shard(db_session: FakeSession, shard: str | None) -> tuple:
+        return db_session.shard, shard
+
+    assert asyncio.run(
+        sharding.run_in_shard_session(sharding.DEFAULT_SHARD, set_shard, shard="paris")
+    ) == (sharding.DEFAULT_SHARD, "paris")
+    assert asyncio.run(
+        sharding.fan_out(["europe", "paris"], set_shard, shard=None)
+    ) == [("europe", None), ("paris", None)]
+
+
+@pytest.mark.usefixtures("shard_map")
+def test_report_ids_by_shard(monkeypatch: pytest.MonkeyPatch) -> None:
+    paris_report_id, europe_report_id, default_report_id = uuid4(), uuid4(), uuid4()
+
+    async def get_report_shards(db_session: FakeSession, report_ids: list) -> dict:
+        # Reports of the default shard are not listed in the directory
+        return {paris_report_id: "paris", europe_report_id: "europe"}
+
+    monkeypatch.setattr(cruds_reports, "get_report_shards", get_report_shards)
+    report_ids_by_shard = asyncio.run(
+        dependencies.get_report_ids_by_shard(
+            db_session=FakeSession(),
+            report_ids=[paris_report_id, default_report_id, europe_report_id],
+        )
+    )
+    assert report_ids_by_shard == {
+        "paris": [paris_report_id],
+        sharding.DEFAULT_SHARD: [default_report_id],
+        "europe": [europe_report_id],
+    }